@@ -1,7 +1,8 @@
 import mailbox
 import pygmail.errors
-from pygmail.utilities import extract_data, extract_type, _cmd_cb, _cmd
+from pygmail.utilities import extract_data, extract_type, _cmd_cb, _cmd, _cmd_thread
 from pygmail.errors import is_auth_error, AuthError, check_for_response_error, is_imap_error, IMAPError
+from pygmail.pool import ConnectionPool
 
 
 __version__ = '0.7'
@@ -23,7 +24,8 @@ class Account(object):
 
     HOST = "imap.googlemail.com"
 
-    def __init__(self, email, oauth2_token=None, password=None, id_params=None, imap_class=None):
+    def __init__(self, email, oauth2_token=None, password=None, id_params=None,
+                 imap_class=None, pool_size=1, lazy_connect=False):
         """Creates an Account instances
 
         Args:
@@ -44,27 +46,78 @@ class Account(object):
                               this as None (which will use the default
                               imaplib2.IMAP4_SSL class), but this option can
                               be used to shim in other, API compatible classes.
+            pool_size      -- The maximum number of IMAP connections to keep
+                              open with Gmail.  If greater than 1, each
+                              selected mailbox is pinned to its own connection
+                              so that switching between mailboxes doesn't
+                              require re-selecting them.  Additional
+                              connections are only opened when needed.
+            lazy_connect   -- If True, no connection is opened when the
+                              account is created.  Instead it is opened on
+                              first use, or by calling connect().  When used
+                              in async mode, the DNS lookup and TCP / TLS
+                              handshake are done off of the event loop.
         """
         if not imap_class:
             import imaplib2
             imap_class = imaplib2.IMAP4_SSL
 
         self.email = email
-        self.conn = imap_class(Account.HOST)
+        self.imap_class = imap_class
         self.oauth2_token = oauth2_token
         self.password = password
         self.connected = False
         self.id_params = id_params
 
+        # The collection of IMAP connections held open with gmail.  The
+        # first connection is opened immediately (unless we were asked not
+        # to), and any others are opened lazily, as mailboxes are pinned
+        # to them
+        self.pool = ConnectionPool(pool_size)
+        first_slot = self.pool.slot()
+        if not lazy_connect:
+            first_slot.conn = imap_class(Account.HOST)
+
         # A reference to the last selected / stated mailbox in the current
-        # account.  This reference is kept so that we don't have to do
-        # redundant calls to the IMAP server re-selecting the current mailbox.
+        # account.  The mailbox selected on each connection is tracked by
+        # the connection pool, so that we don't have to do redundant calls
+        # to the IMAP server re-selecting the current mailbox.
         self.last_viewed_mailbox = None
 
         # A lazy-loaded collection of mailbox objects representing
         # the mailboxes in the current account.
         self.boxes = None
 
+    @property
+    def conn(self):
+        """The first (and, unless pooling is enabled, only) imaplib2
+        connection held open with Gmail, or None if it hasn't been opened
+        yet"""
+        return self.pool.slots[0].conn
+
+    def is_selected(self, mailbox):
+        """Checks to see if the given mailbox is the one currently selected on
+        the connection its pinned to
+
+        Args:
+            mailbox -- A pygmail.mailbox.Mailbox instance in the current account
+
+        Returns:
+            True if no SELECT is needed before operating on the mailbox, and
+            otherwise False
+        """
+        return self.pool.slot(mailbox.name).selected is mailbox
+
+    def set_selected(self, mailbox):
+        """Records that the given mailbox was selected on the connection its
+        pinned to.
+
+        Args:
+            mailbox -- A pygmail.mailbox.Mailbox instance in the current account
+        """
+        self.pool.slot(mailbox.name).selected = mailbox
+        self.last_viewed_mailbox = mailbox
+
     def add_mailbox(self, name, callback=None):
         """Creates a new mailbox / folder in the current account. This is
         implemented using the gmail X-GM-LABELS IMAP extension.
@@ -205,7 +258,7 @@ class Account(object):
 
         return _cmd_cb(self.mailboxes, _retreived_mailboxes, bool(callback))
 
-    def connection(self, callback=None):
+    def connection(self, callback=None, mailbox=None):
         """Creates an authenticated connection to gmail over IMAP
 
         Attempts to authenticate a connection with the gmail server using
@@ -216,14 +269,72 @@ class Account(object):
         be taken (so multiplie calls to this method will result in a single
         connection effort, once a connection has been successfully created).
 
+        Keyword Args:
+            mailbox -- If provided, the pygmail.mailbox.Mailbox instance the
+                       connection will be used with.  When the account holds
+                       a pool of connections, this determines which connection
+                       is returned.
+
         Returns:
             pygmail.account.AuthError, if the given connection parameters are
             not accepted by the Gmail server, and otherwise an imaplib2
             connection object.
 
         """
+        slot = self.pool.slot(mailbox.name if mailbox else None)
+        return self.connect_slot(slot, callback=callback)
+
+    def connect_slot(self, slot, callback=None):
+        """Opens and authenticates the IMAP connection held by the given slot,
+        if it hasn't been already.  Most callers should use connection()
+        instead, but this can be used to manage connections that live outside
+        of the account's pool (such as the dedicated connection a
+        pygmail.watch.Watcher keeps in IDLE).
+
+        Args:
+            slot -- A pygmail.pool.PooledConnection instance
+
+        Returns:
+            pygmail.account.AuthError, if the given connection parameters are
+            not accepted by the Gmail server, and otherwise an imaplib2
+            connection object.
+        """
+        if slot.connected:
+            return _cmd(callback, slot.conn)
+
+        # If another request is already opening / authenticating this
+        # connection, just wait for it to finish, instead of opening a second
+        # connection in its place
+        if callback and slot.waiters is not None:
+            slot.waiters.append(callback)
+            return
+
+        if callback:
+            slot.waiters = [callback]
+
+            def callback(connection):
+                waiters, slot.waiters = slot.waiters, None
+                for waiter in waiters:
+                    waiter(connection)
+
         def _on_ids(connection):
-            _cmd(callback, connection)
+            return _cmd(callback, connection)
+
+        def _on_capabilities(imap_response):
+            # Gmail only advertises some extensions (ie MOVE, UIDPLUS and
+            # CONDSTORE) once the connection has been authenticated, so the
+            # capabilities imaplib2 recorded when connecting are replaced with
+            # the full, post-login list.  If the request fails, the
+            # pre-login list is kept.
+            if not check_for_response_error(imap_response):
+                data = extract_data(imap_response)
+                if data and data[0]:
+                    slot.conn.capabilities = tuple(data[0].upper().split())
+            if self.id_params:
+                return _cmd_cb(self._identify, _on_ids, bool(callback),
+                               slot.conn)
+            else:
+                return _cmd(callback, slot.conn)
 
         def _on_authentication(imap_response):
             is_error = check_for_response_error(imap_response)
@@ -237,29 +348,80 @@ class Account(object):
                         self.email, self.password)
                 return _cmd(callback, AuthError(error))
             else:
+                slot.connected = True
                 self.connected = True
-                if self.id_params:
-                    return _cmd_cb(self.id, _on_ids, bool(callback))
-                else:
-                    return _cmd(callback, self.conn)
+                return _cmd_cb(slot.conn.capability, _on_capabilities,
+                               bool(callback))
+
+        def _authenticate(connection):
+            if self.oauth2_token:
+                auth_params = self.email, self.oauth2_token
+                xoauth2_string = 'user=%s\1auth=Bearer %s\1\1' % auth_params
+                try:
+                    return _cmd_cb(connection.authenticate,
+                                   _on_authentication, bool(callback),
+                                   "XOAUTH2", lambda x: xoauth2_string)
+                except:
+                    return _cmd(callback, AuthError(""))
+            else:
+                try:
+                    return _cmd_cb(connection.login, _on_authentication,
+                                   bool(callback), self.email, self.password)
+                except Exception, e:
+                    return _cmd(callback, e)
 
-        if self.connected:
-            return _cmd(callback, self.conn)
-        elif self.oauth2_token:
-            auth_params = self.email, self.oauth2_token
-            xoauth2_string = 'user=%s\1auth=Bearer %s\1\1' % auth_params
-            try:
-                return _cmd_cb(self.conn.authenticate,
-                              _on_authentication, bool(callback),
-                              "XOAUTH2", lambda x: xoauth2_string)
-            except:
-                return _cmd(callback, AuthError(""))
+        @pygmail.errors.check_imap_response(callback)
+        def _on_open(connection):
+            return _authenticate(connection)
+
+        if slot.conn is None:
+            return _cmd_cb(self._open_connection, _on_open, bool(callback),
+                           slot)
         else:
-            try:
-                return _cmd_cb(self.conn.login, _on_authentication,
-                              bool(callback), self.email, self.password)
-            except Exception, e:
-                return _cmd(callback, e)
+            return _authenticate(slot.conn)
+
+    def connect(self, callback=None):
+        """Opens and authenticates the account's primary IMAP connection.
+
+        This is mainly useful for accounts created with lazy_connect=True.
+        When called in async mode, the DNS lookup and TCP / TLS handshake
+        happen on a worker thread and authentication is done through imaplib2's
+        callbacks, so the event loop is never blocked while connecting.
+
+        Returns:
+            The current pygmail.account.Account instance on success, and
+            an error object (such as pygmail.errors.AuthError) otherwise
+        """
+        def _on_connection(connection):
+            if pygmail.errors.is_error(connection):
+                return _cmd(callback, connection)
+            else:
+                return _cmd(callback, self)
+
+        return _cmd_cb(self.connection, _on_connection, bool(callback))
+
+    def _open_connection(self, slot, callback=None):
+        """Opens a new, unauthenticated IMAP connection to gmail and stores it
+        in the given pool slot.  In async mode the connection is opened on a
+        worker thread.
+
+        Args:
+            slot -- A pygmail.pool.PooledConnection instance without an opened
+                    connection
+
+        Returns:
+            An imaplib2 connection object on success, and an IMAPError
+            otherwise
+        """
+        def _on_open(connection):
+            if isinstance(connection, Exception):
+                return _cmd(callback, IMAPError(connection))
+            else:
+                slot.conn = connection
+                return _cmd(callback, connection)
+
+        return _cmd_thread(self.imap_class, _on_open, bool(callback),
+                           Account.HOST)
 
     def clear_mailbox_cache(self):
         """Clears the local cache of mailboxes names / objects. This will
@@ -276,25 +438,57 @@ class Account(object):
     def close(self, callback=None):
         """Closes the IMAP connection to GMail
 
-        Closes and logs out of the IMAP connection to GMail.
+        Closes and logs out of the IMAP connection to GMail.  If the account
+        holds a pool of connections, each opened connection is closed in turn.
 
         Returns:
             True if a connection was closed, and False if this close request
             was a NOOP
         """
+        slots = self.pool.open_slots()
+        results = []
+
+        def _on_slot_closed(was_closed):
+            if pygmail.errors.is_error(was_closed):
+                return _cmd(callback, was_closed)
+            results.append(was_closed)
+            if slots:
+                return _cmd_cb(self._close_slot, _on_slot_closed,
+                               bool(callback), slots.pop(0))
+            else:
+                self.connected = False
+                self.last_viewed_mailbox = None
+                return _cmd(callback, all(results))
+
+        if not slots:
+            return _cmd(callback, False)
+        else:
+            return _cmd_cb(self._close_slot, _on_slot_closed, bool(callback),
+                           slots.pop(0))
+
+    def _close_slot(self, slot, callback=None):
+        """Closes and logs out of a single pooled IMAP connection.
+
+        Args:
+            slot -- A pygmail.pool.PooledConnection instance to close
+
+        Returns:
+            True if the server said goodbye, and otherwise False
+        """
         @pygmail.errors.check_imap_response(callback, require_ok=False)
         def _on_logout(imap_response):
             typ = extract_type(imap_response)
-            self.connected = False
+            slot.connected = False
+            slot.selected = None
             return _cmd(callback, typ == "BYE")
 
         @pygmail.errors.check_imap_response(callback, require_ok=False)
         def _on_close(imap_response):
-            return _cmd_cb(self.conn.logout, _on_logout, bool(callback))
+            return _cmd_cb(slot.conn.logout, _on_logout, bool(callback))
 
-        if self.last_viewed_mailbox:
+        if slot.selected:
             try:
-                return _cmd_cb(self.conn.close, _on_close, bool(callback))
+                return _cmd_cb(slot.conn.close, _on_close, bool(callback))
             except Exception as e:
                 return _cmd(callback, IMAPError(e))
         else:
@@ -314,22 +508,35 @@ class Account(object):
             The imaplib2 connection object on success, and an error object
             otherwise
         """
-        @pygmail.errors.check_imap_response(callback)
-        def _on_id(imap_response):
-            return _cmd(callback, self.conn)
-
         @pygmail.errors.check_imap_state(callback)
         def _on_connection(connection):
-            id_params = []
-            for k, v in self.id_params.items():
-                id_params.append('"' + k + '"')
-                id_params.append('"' + v + '"')
-            # The IMAPlib2 exposed version of the "ID" command doesn't
-            # format the parameters the same way gmail wants them, so
-            # we just do it ourselves (imaplib2 wraps them in an extra
-            # paren)
-            return _cmd_cb(connection._simple_command, _on_id,
-                           bool(callback), 'ID',
-                           "(" + " ".join(id_params) + ")")
+            return self._identify(connection, callback=callback)
 
         return _cmd_cb(self.connection, _on_connection, bool(callback))
+
+    def _identify(self, connection, callback=None):
+        """Sends the ID command, with the account's id_params, over the given
+        connection.
+
+        Args:
+            connection -- An authenticated imaplib2 connection object
+
+        Returns:
+            The imaplib2 connection object on success, and an error object
+            otherwise
+        """
+        @pygmail.errors.check_imap_response(callback)
+        def _on_id(imap_response):
+            return _cmd(callback, connection)
+
+        id_params = []
+        for k, v in self.id_params.items():
+            id_params.append('"' + k + '"')
+            id_params.append('"' + v + '"')
+        # The IMAPlib2 exposed version of the "ID" command doesn't
+        # format the parameters the same way gmail wants them, so
+        # we just do it ourselves (imaplib2 wraps them in an extra
+        # paren)
+        return _cmd_cb(connection._simple_command, _on_id,
+                       bool(callback), 'ID',
+                       "(" + " ".join(id_params) + ")")
@@ -23,9 +23,8 @@ def check_imap_state(callback):
     """
     def decorator(func):
         def inner(*args, **kwargs):
-            conn = args[0]
-            if not isinstance(conn, imaplib.IMAP4) or conn.state == imaplib.imaplib.LOGOUT:
-                rs = IMAPClosedError('IMAP in state LOGOUT', func.__name__)
+            rs = check_connection_state(args[0], func.__name__)
+            if rs:
                 if callback:
                     return _cmd(callback, rs)
                 else:
@@ -36,6 +35,28 @@ def check_imap_state(callback):
     return decorator
 
 
+def check_connection_state(conn, context=None):
+    """Checks to see if the given object is an imaplib2 connection that we
+    can still make requests against (ie its not in LOGOUT).
+
+    Args:
+        conn -- The object to check, usually the result of a call to
+                pygmail.account.Account.connection
+
+    Keyword Args:
+        context -- Optional description of where the check is being made,
+                   included in any returned error
+
+    Returns:
+        An IMAPClosedError object if the connection can't be used, and
+        otherwise None
+    """
+    if not isinstance(conn, imaplib.IMAP4) or conn.state == imaplib.imaplib.LOGOUT:
+        return IMAPClosedError('IMAP in state LOGOUT', context)
+    else:
+        return None
+
+
 def check_imap_response(callback, require_ok=True):
     """Decorator that checks to see if the given imap response is an error.
     If so, it is registered as the only argument to the given callback function
@@ -95,7 +116,7 @@ def check_for_response_error(imap_response, require_ok=True):
         response, cb_arg, error = imap_response
         if response is None:
             if __debug__:
-                _log.error(error[1])
+                _log(error[1])
             return IMAPError(error[1])
         else:
             typ, data = response
@@ -139,6 +160,28 @@ def is_imap_error(response):
     return isinstance(response, IMAPError)
 
 
+class SaveError(IMAPError):
+    """An exception-like object returned when some messages couldn't be
+    written back to the server after their original versions had already
+    been removed (see pygmail.mailbox.Mailbox.save_messages).  The unsaved
+    property holds the pygmail.message.Message objects that weren't
+    written, so that the caller can retry saving them."""
+
+    def __init__(self, desc=None, context=None, type=None, unsaved=None):
+        super(SaveError, self).__init__(desc=desc, context=context, type=type)
+        self.unsaved = unsaved or []
+
+
+def is_save_error(response):
+    """Checks to see if the given object is a SaveError instance
+
+    Returns:
+        True if the given object is a SaveError, and False in all other
+        instances
+    """
+    return isinstance(response, SaveError)
+
+
 class AuthError(ExceptionLike):
     """An exeption-like class signifying that an authentication attempt with the
     gmail server was not accepted. This is handled through a class instead of
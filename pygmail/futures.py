@@ -0,0 +1,343 @@
+"""A Future returning interface to pygmail, for use with tornado.gen coroutines
+(or anything else that can wait on a tornado Future).
+
+The callback based methods on pygmail's classes step through each IMAP
+round trip with a chain of decorated closures, and each step is scheduled
+separately on the event loop.  The coroutines in this module run the same
+IMAP flows, but only return to the event loop once per IMAP round trip.
+
+Each public function returns a Future that resolves to the same value the
+callback version of the same method would pass to its callback, including
+error objects (ie pygmail.errors.IMAPError instances) on failure.  Methods
+that don't have a native coroutine version here can still be called through
+wrap().  Since the Futures are resolved on the event loop, this module should
+be used with the (default) tornado event loop backend.
+
+    inbox = yield futures.wrap(account.get, "INBOX")
+    messages = yield futures.messages(inbox, limit=50)
+"""
+
+import functools
+import string
+import time
+from tornado import gen
+from tornado.concurrent import Future
+from pygmail.errors import check_for_response_error, check_connection_state, is_error
+from pygmail.mailbox import Mailbox, imap_queries, imap_query, page_from_list, page_range, parse_attachment_index, parse_fetch_request, parse_uids
+from pygmail.utilities import extract_data, encode_sequence_set, response_size, schedule_func, _log
+
+
+class _IMAPFailure(Exception):
+    """Raised inside the coroutines in this module to short circuit the
+    remaining steps of an IMAP flow.  The wrapped error object is what is
+    handed back to the caller."""
+
+    def __init__(self, error):
+        Exception.__init__(self)
+        self.error = error
+
+
+def _checkout(mailbox):
+    """Checks the mailbox's connection out of the account's pool (see
+    pygmail.pool.ConnectionPool.checkout), returning a Future that resolves
+    to the pooled connection once one is available"""
+    future = Future()
+    mailbox.account.pool.checkout(mailbox.name, callback=future.set_result)
+    return future
+
+
+def _returns_errors(coroutine):
+    """Wraps a coroutine from this module so that IMAP level failures resolve
+    the returned Future with the error object, instead of raising, matching
+    the behavior of the callback API.  The mailbox's connection is checked
+    out of the account's pool while the coroutine runs"""
+    @functools.wraps(coroutine)
+    @gen.coroutine
+    def inner(mailbox, *args, **kwargs):
+        slot = yield _checkout(mailbox)
+        try:
+            rs = yield coroutine(mailbox, *args, **kwargs)
+        except _IMAPFailure as failure:
+            rs = failure.error
+        finally:
+            mailbox.account.pool.release(slot)
+        raise gen.Return(rs)
+    return inner
+
+
+def wrap(method, *args, **kwargs):
+    """Calls any callback based pygmail method (ie Message.save), returning
+    a Future instead of taking a callback.
+
+    Note that the unnamed and keyword arguments are passed along to the
+    given method
+
+    Args:
+        method -- A pygmail method that accepts a "callback" keyword argument
+
+    Returns:
+        A Future that resolves to the value the method passes to its callback
+    """
+    future = Future()
+    kwargs['callback'] = future.set_result
+    method(*args, **kwargs)
+    return future
+
+
+def _command(func, *args, **kwargs):
+    """Issues an asyncronous imaplib2 command.
+
+    Args:
+        func -- An imaplib2 connection method, such as connection.fetch
+
+    Keyword Args:
+        require_ok -- Whether responses other than "OK" from the IMAP server
+                      should be treated as errors (default True)
+
+    Returns:
+        A Future that resolves to the raw imaplib2 response, or raises
+        _IMAPFailure if the server returned an error
+    """
+    require_ok = kwargs.pop('require_ok', True)
+    future = Future()
+
+    # imaplib2 calls us back from its own thread, so the response is
+    # handed over to the event loop here, once per round trip
+    def _on_response(imap_response):
+        error = check_for_response_error(imap_response, require_ok=require_ok)
+        if error:
+            schedule_func(lambda: future.set_exception(_IMAPFailure(error)))
+        else:
+            schedule_func(lambda: future.set_result(imap_response))
+
+    kwargs['callback'] = _on_response
+    func(*args, **kwargs)
+    return future
+
+
+@gen.coroutine
+def _connection(mailbox):
+    slot = mailbox.account.pool.slot(mailbox.name)
+    if slot.connected:
+        conn = slot.conn
+    else:
+        conn = yield wrap(mailbox.connection)
+        if is_error(conn):
+            raise _IMAPFailure(conn)
+
+    error = check_connection_state(conn, "connection")
+    if error:
+        raise _IMAPFailure(error)
+    raise gen.Return(conn)
+
+
+@gen.coroutine
+def _count(mailbox, conn):
+    imap_response = yield _command(conn.select, mailbox.name)
+    mailbox.account.set_selected(mailbox)
+    data = extract_data(imap_response)
+    raise gen.Return(int(Mailbox.COUNT_PATTERN.sub("", str(data))))
+
+
+@gen.coroutine
+def _selected_connection(mailbox):
+    conn = yield _connection(mailbox)
+    if not mailbox.account.is_selected(mailbox):
+        yield _count(mailbox, conn)
+    raise gen.Return(conn)
+
+
+@gen.coroutine
+def _fetch_in_chunks(mailbox, conn, ids, request, use_uids=False,
+                     max_retries=2):
+    """Coroutine version of pygmail.mailbox.fetch_in_chunks, which issues
+    each FETCH directly instead of stepping through its callback chain.
+    Chunks are sized by the mailbox's chunker for the request, and a chunk
+    that fails is split in half and retried the same way."""
+    chunker = mailbox.chunker(request)
+    results = []
+    retries = []
+    position = 0
+    while retries or position < len(ids):
+        if retries:
+            chunk, attempts = retries.pop()
+        else:
+            chunk = ids[position:position + chunker.size]
+            position += len(chunk)
+            attempts = 0
+
+        sequence_set = encode_sequence_set(chunk)
+        started = time.time()
+        try:
+            if use_uids:
+                imap_response = yield _command(conn.uid, "FETCH",
+                                               sequence_set, request)
+            else:
+                imap_response = yield _command(conn.fetch, sequence_set,
+                                               request)
+        except _IMAPFailure as failure:
+            chunker.failed()
+            if attempts >= max_retries:
+                raise
+            if __debug__:
+                _log("Retrying FETCH of {num} messages after error: {msg}".format(
+                    num=len(chunk), msg=failure.error.msg))
+            middle = len(chunk) / 2
+            if middle:
+                retries.append((chunk[middle:], attempts + 1))
+                retries.append((chunk[:middle], attempts + 1))
+            else:
+                retries.append((chunk, attempts + 1))
+            continue
+
+        data = extract_data(imap_response)
+        chunker.record(len(chunk), time.time() - started, response_size(data))
+        results.extend(part for part in data if part is not None)
+    raise gen.Return(results)
+
+
+@gen.coroutine
+def _messages_by_id(mailbox, conn, ids, only_uids=False, full=False, **kwargs):
+    if len(ids) == 0:
+        raise gen.Return([])
+
+    teasers = kwargs.get("teaser")
+    gm_ids = kwargs.get('gm_ids')
+    request = imap_query(gm_ids=gm_ids, only_uids=only_uids, full=full,
+                         teaser=teasers, structure=kwargs.get('structure'),
+                         only_headers=kwargs.get('only_headers'),
+                         metadata_items=kwargs.get('metadata_items'))
+    data = yield _fetch_in_chunks(mailbox, conn, ids, request)
+    if only_uids:
+        raise gen.Return(parse_uids(data))
+    else:
+        raise gen.Return(parse_fetch_request(data, mailbox, teasers, full, gm_ids,
+                                             structure=kwargs.get('structure')))
+
+
+@_returns_errors
+@gen.coroutine
+def connection(mailbox):
+    """Future version of pygmail.mailbox.Mailbox.connection"""
+    conn = yield _connection(mailbox)
+    raise gen.Return(conn)
+
+
+@_returns_errors
+@gen.coroutine
+def count(mailbox):
+    """Future version of pygmail.mailbox.Mailbox.count"""
+    conn = yield _connection(mailbox)
+    msg_count = yield _count(mailbox, conn)
+    raise gen.Return(msg_count)
+
+
+@_returns_errors
+@gen.coroutine
+def select(mailbox):
+    """Future version of pygmail.mailbox.Mailbox.select"""
+    if mailbox.account.is_selected(mailbox):
+        raise gen.Return(False)
+    yield _selected_connection(mailbox)
+    raise gen.Return(True)
+
+
+@_returns_errors
+@gen.coroutine
+def messages(mailbox, limit=100, offset=0, **kwargs):
+    """Future version of pygmail.mailbox.Mailbox.messages"""
+    conn = yield _connection(mailbox)
+    num_messages = yield _count(mailbox, conn)
+    page = page_range(num_messages, limit, offset, kwargs.get('newest_first'))
+    if page is None:
+        raise gen.Return([])
+    ids = [str(an_id) for an_id in xrange(page[0], page[1] + 1)]
+    rs = yield _messages_by_id(mailbox, conn, ids,
+                               only_uids=kwargs.get('only_uids'),
+                               full=kwargs.get('full'),
+                               teaser=kwargs.get('teaser'),
+                               gm_ids=kwargs.get('gm_ids'),
+                               structure=kwargs.get('structure'),
+                               only_headers=kwargs.get('only_headers'),
+                               metadata_items=kwargs.get('metadata_items'))
+    if kwargs.get('newest_first'):
+        rs.reverse()
+    raise gen.Return(rs)
+
+
+@_returns_errors
+@gen.coroutine
+def search(mailbox, term, limit=100, offset=0, only_uids=False, full=False,
+           **kwargs):
+    """Future version of pygmail.mailbox.Mailbox.search"""
+    conn = yield _selected_connection(mailbox)
+    imap_response = yield _command(conn.search, None, 'X-GM-RAW', term)
+    ids = string.split(extract_data(imap_response)[0])
+    rs = yield _messages_by_id(mailbox, conn, page_from_list(ids, limit, offset),
+                               only_uids=only_uids, full=full,
+                               teaser=kwargs.get('teaser'),
+                               gm_ids=kwargs.get('gm_ids'),
+                               structure=kwargs.get('structure'),
+                               only_headers=kwargs.get('only_headers'),
+                               metadata_items=kwargs.get('metadata_items'))
+    raise gen.Return(rs)
+
+
+@_returns_errors
+@gen.coroutine
+def messages_by_id(mailbox, ids, only_uids=False, full=False, **kwargs):
+    """Future version of pygmail.mailbox.Mailbox.messages_by_id"""
+    if len(ids) == 0:
+        raise gen.Return([])
+    conn = yield _selected_connection(mailbox)
+    rs = yield _messages_by_id(mailbox, conn, ids, only_uids=only_uids,
+                               full=full, **kwargs)
+    raise gen.Return(rs)
+
+
+@_returns_errors
+@gen.coroutine
+def fetch_all(mailbox, uids, full=False, **kwargs):
+    """Future version of pygmail.mailbox.Mailbox.fetch_all"""
+    if not uids:
+        raise gen.Return(None)
+    teasers = kwargs.get("teaser")
+    gm_ids = kwargs.get('gm_ids')
+    conn = yield _selected_connection(mailbox)
+    request = imap_query(gm_ids=gm_ids, full=full, teaser=teasers,
+                         structure=kwargs.get('structure'),
+                         only_headers=kwargs.get('only_headers'),
+                         metadata_items=kwargs.get('metadata_items'))
+    data = yield _fetch_in_chunks(mailbox, conn, uids, request, use_uids=True)
+    raise gen.Return(parse_fetch_request(data, mailbox, teasers, full, gm_ids,
+                                         structure=kwargs.get('structure')))
+
+
+@_returns_errors
+@gen.coroutine
+def attachment_index(mailbox, uids):
+    """Future version of pygmail.mailbox.Mailbox.attachment_index"""
+    if not uids:
+        raise gen.Return({})
+    conn = yield _selected_connection(mailbox)
+    data = yield _fetch_in_chunks(mailbox, conn, uids,
+                                  imap_queries["attachments"], use_uids=True)
+    raise gen.Return(parse_attachment_index(data))
+
+
+@_returns_errors
+@gen.coroutine
+def fetch(mailbox, uid, full=False, **kwargs):
+    """Future version of pygmail.mailbox.Mailbox.fetch"""
+    teasers = kwargs.get("teaser")
+    gm_ids = kwargs.get('gm_ids')
+    conn = yield _selected_connection(mailbox)
+    request = imap_query(gm_ids=gm_ids, full=full, teaser=teasers,
+                         structure=kwargs.get('structure'),
+                         only_headers=kwargs.get('only_headers'),
+                         metadata_items=kwargs.get('metadata_items'))
+    imap_response = yield _command(conn.uid, "FETCH", uid, request)
+    data = extract_data(imap_response)
+    messages = parse_fetch_request(data, mailbox, teasers, full, gm_ids,
+                                   structure=kwargs.get('structure'))
+    raise gen.Return(messages[0] if len(messages) > 0 else None)
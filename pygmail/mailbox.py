@@ -1,10 +1,25 @@
 import re
 import string
+import time
 import message as GM
-from pygmail.utilities import extract_data, _cmd_cb, _cmd, _cmd_in, _log
+import sync
+import watch
+from pygmail.pool import checked_out
+from pygmail.structure import parse_bodystructure
+from pygmail.utilities import extract_data, response_size, encode_sequence_set, decode_sequence_set, quote_astring, AdaptiveChunker, ParseError, _cmd_cb, _cmd, _cmd_retry, _log
+from pygmail.errors import check_for_response_error
 import pygmail.errors
 
 GM_ID_EXTRACTOR = re.compile(r'\d+ \(X-GM-MSGID (\d+)\)')
+GM_ID_PATTERN = re.compile(r'X-GM-MSGID (\d+)')
+
+# The most UIDs to include in the sequence set of a single STORE command
+STORE_CHUNK_SIZE = 10000
+
+# Extracts the UIDs copied messages were given in the destination mailbox,
+# from the UIDPLUS response code to a COPY command, such as
+# '[COPYUID 38505 304,319:320 3956:3958] Done'
+COPYUID_PATTERN = re.compile(r'\[COPYUID \d+ [\d:,]+ ([\d:,]+)\]')
 
 uid_fields = 'X-GM-MSGID UID'
 meta_fields = 'INTERNALDATE X-GM-MSGID X-GM-LABELS UID FLAGS'
@@ -19,117 +34,513 @@ imap_queries = dict(
     teaser='({meta} BODYSTRUCTURE {header} {teaser})'.format(meta=meta_fields,
                                                              header=header_fields,
                                                              teaser=teaser_fields),
-    header='({meta} {header})'.format(meta=meta_fields, header=header_fields)
+    header='({meta} {header})'.format(meta=meta_fields, header=header_fields),
+    structure='({meta} BODYSTRUCTURE {header})'.format(meta=meta_fields,
+                                                       header=header_fields),
+    attachments='(UID BODYSTRUCTURE)'
 )
 
-METADATA = 0
-HEADERS = 1
-BODY = 2
+# The headers pygmail.message.MessageBase reads, which are what's fetched
+# when only_headers=True is passed to imap_query
+DEFAULT_HEADER_FIELDS = ('Date', 'Subject', 'From', 'To', 'Cc', 'Message-Id')
+
+# The names the server gives the literal data items requested by the
+# queries above, in its FETCH responses
+HEADER_SECTION = 'BODY[HEADER]'
+HEADER_FIELDS_SECTION = 'BODY[HEADER.FIELDS'
+BODY_SECTION = 'BODY[]'
+TEASER_SECTION = 'BODY[1]'
+PARTIAL_TEASER_SECTION = 'BODY[1]<0>'
+
+# Extracts the name of the data item a literal in a FETCH response belongs
+# to, from the text that comes before it, such as '1 (UID 5 BODY[HEADER] {342}'
+LITERAL_ITEM_PATTERN = re.compile(r'(BODY\[[^\]]*\](?:<\d+>)?|RFC822(?:\.HEADER|\.TEXT)?) \{\d+\}$')
+
+
+def imap_query(gm_ids=False, only_uids=False, full=False, structure=False,
+               teaser=False, only_headers=None, metadata_items=None):
+    """Returns the FETCH data items to request from the IMAP server, based on
+    the kind of message objects the caller wants back.  Options are considered
+    in the order listed below, so, for example, gm_ids takes precedence over
+    full.
+
+    >>> imap_query(only_headers=['Subject', 'From'])
+    '(INTERNALDATE X-GM-MSGID X-GM-LABELS UID FLAGS BODY.PEEK[HEADER.FIELDS (Subject From)])'
+
+    >>> imap_query(metadata_items=['FLAGS'], only_headers=True)
+    '(FLAGS UID BODY.PEEK[HEADER.FIELDS (Date Subject From To Cc Message-Id)])'
+
+    >>> imap_query(metadata_items=['UID'], teaser=2048)
+    '(UID BODYSTRUCTURE BODY.PEEK[HEADER] BODY.PEEK[1]<0.2048>)'
+
+    >>> imap_query(metadata_items=['UID'], structure=True)
+    '(UID BODYSTRUCTURE BODY.PEEK[HEADER])'
+
+    Keyword Args:
+        gm_ids         -- Whether only X-GM-MSGID values are needed
+        only_uids      -- Whether only message UIDs are needed
+        full           -- Whether the entire message should be fetched
+        structure      -- Whether the message's MIME structure should be
+                          fetched along with its headers, so that parts of
+                          its body can be fetched later, as needed
+        teaser         -- Whether a teaser version of the body should be
+                          fetched.  If a number is given instead of True,
+                          only that many bytes of the first part of the
+                          body are fetched (BODY.PEEK[1]<0.N>)
+        only_headers   -- For header and teaser queries, a list of the names
+                          of the only headers to fetch, instead of the entire
+                          header block, or True to fetch just the headers
+                          message objects read (DEFAULT_HEADER_FIELDS)
+        metadata_items -- For header, teaser and full queries, a list of the
+                          only metadata items (ie "FLAGS", "X-GM-LABELS") to
+                          fetch, instead of all of the items in meta_fields.
+                          UID is always fetched
+
+    Returns:
+        A parenthesized string of IMAP FETCH data items
+    """
+    if gm_ids:
+        return imap_queries["gm_id"]
+    elif only_uids:
+        return imap_queries["uid"]
+    elif not only_headers and not metadata_items and not is_partial(teaser):
+        if full:
+            return imap_queries["body"]
+        elif structure:
+            return imap_queries["structure"]
+        elif teaser:
+            return imap_queries["teaser"]
+        else:
+            return imap_queries["header"]
+
+    if metadata_items:
+        items = [item.upper() for item in metadata_items]
+        if 'UID' not in items:
+            items.append('UID')
+        meta = ' '.join(items)
+    else:
+        meta = meta_fields
 
+    if only_headers is True:
+        only_headers = DEFAULT_HEADER_FIELDS
+    if only_headers:
+        header = 'BODY.PEEK[HEADER.FIELDS (%s)]' % (
+            ' '.join(quote_astring(field) for field in only_headers),)
+    else:
+        header = header_fields
 
-def parse_fetch_request(response, mailbox, teaser=False, full=False, gm_id=False):
+    if full:
+        return '({meta} {body})'.format(meta=meta, body=body_fields)
+    elif structure:
+        return '({meta} BODYSTRUCTURE {header})'.format(meta=meta, header=header)
+    elif teaser:
+        if is_partial(teaser):
+            teaser_item = '%s<0.%d>' % (teaser_fields, teaser)
+        else:
+            teaser_item = teaser_fields
+        return '({meta} BODYSTRUCTURE {header} {teaser})'.format(
+            meta=meta, header=header, teaser=teaser_item)
+    else:
+        return '({meta} {header})'.format(meta=meta, header=header)
 
-    messages = []
 
-    # Quickly we can search for the simplest case, where we have no
-    # message parts to return
-    if not response or not response[0]:
-        return messages
+def is_partial(teaser):
+    """Returns whether the given teaser argument (see imap_query) asks for
+    only part of the teaser section to be fetched"""
+    return not isinstance(teaser, bool) and isinstance(teaser, (int, long))
 
-    message_complete = False
 
-    if gm_id:
-        for part in response:
-            gm_id_match = GM_ID_EXTRACTOR.match(part)
+def parse_uids(response):
+    """Extracts the UIDs from the response to a FETCH request for the
+    imap_queries["uid"] data items
+
+    Args:
+        response -- The data section of an imaplib2 FETCH response
+
+    Returns:
+        A list of zero or more UIDs, as strings
+    """
+    return [string.split(elm, " ")[4][:-1] for elm in response]
+
+
+def parse_attachment_index(response):
+    """Lists the attachments of each message described by the response to
+    a FETCH request for the imap_queries["attachments"] data items
+
+    Args:
+        response -- The data section of an imaplib2 FETCH response
+
+    Returns:
+        A dict mapping the UID of each message (as a string) to a list of
+        zero or more pygmail.structure.BodyPart objects, one for each of the
+        message's attachments.  Messages whose structure couldn't be parsed
+        are left out
+    """
+    index = {}
+    for fetched in split_fetch_response(response or ()):
+        record = GM.parse_metadata(fetched.metadata)
+        if record is None or record.uid is None or record.bodystructure is None:
+            continue
+        try:
+            root = parse_bodystructure(record.bodystructure)
+        except ParseError:
+            _log("Bad formatted body structure: %s" % (record.bodystructure,))
+            continue
+        index[record.uid] = root.attachments()
+    return index
+
+
+class FetchedMessage(object):
+    """The data the server returned for a single message in a FETCH response.
+
+    Instances have the following properties:
+        metadata -- the text of the response, with the contents of each
+                    literal removed (so, the message's sequence number and
+                    its non-literal data items, such as UID, FLAGS and
+                    X-GM-LABELS, along with the names of the literal items)
+        sections -- a dict mapping the name of each data item returned as a
+                    literal (ie "BODY[HEADER]", "BODY[1]") to its contents
+    """
+
+    def __init__(self, metadata, sections):
+        self.metadata = metadata
+        self.sections = sections
+
+    def __str__(self):
+        return "<FetchedMessage: %s>" % (", ".join(sorted(self.sections)),)
+
+    def section(self, name, default=''):
+        """Returns the contents of the named literal data item, or the given
+        default if the server didn't return it (or returned it as NIL)"""
+        return self.sections.get(name, default)
+
+    def headers(self):
+        """Returns the message's header block, whether the whole block
+        (BODY[HEADER]) or only some of its fields (BODY[HEADER.FIELDS (...)])
+        were requested, or an empty string if neither was returned"""
+        try:
+            return self.sections[HEADER_SECTION]
+        except KeyError:
+            for name, value in self.sections.iteritems():
+                if name.startswith(HEADER_FIELDS_SECTION):
+                    return value
+            return ''
+
+
+def split_fetch_response(response):
+    """Groups the data section of an imaplib2 FETCH response into the data
+    returned for each message, reading through the response only once.
+
+    imaplib2 returns each message as zero or more (text, literal) tuples,
+    one for each data item the server sent as a literal, followed by a
+    string with the rest of the message's response line (ie ")" or
+    " UID 12 FLAGS (\\Seen))").  Messages without any literal data items
+    (such as the response to imap_queries["gm_id"]) are returned as just
+    that string.
+
+    Args:
+        response -- The data section of an imaplib2 FETCH response
+
+    Returns:
+        A generator of pygmail.mailbox.FetchedMessage objects, in the order
+        the server returned them
+    """
+    metadata = []
+    sections = {}
+    for part in response:
+        if part is None:
+            continue
+        if isinstance(part, basestring):
+            metadata.append(part)
+            yield FetchedMessage(''.join(metadata), sections)
+            metadata = []
+            sections = {}
+            continue
+        text, literal = part
+        metadata.append(text)
+        item_match = LITERAL_ITEM_PATTERN.search(text)
+        if item_match:
+            sections[item_match.group(1)] = literal
+        else:
+            # A literal in the metadata itself (such as a label with unusual
+            # characters in it), which is kept in place, along with the line
+            # break that follows the literal's size on the wire
+            metadata.append('\r\n')
+            metadata.append(literal)
+    if metadata:
+        yield FetchedMessage(''.join(metadata), sections)
+
+
+def iter_fetch_request(response, mailbox, teaser=False, full=False, gm_id=False,
+                       records=False, structure=False):
+    """Builds message objects out of the data section of an imaplib2 FETCH
+    response, yielding each one as soon as its section of the response
+    has been read.
+
+    Args:
+        response -- The data section of an imaplib2 FETCH response
+        mailbox  -- The pygmail.mailbox.Mailbox instance the messages were
+                    fetched from
+
+    Keyword Args:
+        teaser  -- Whether the response is for imap_queries["teaser"], or
+                   the teaser length given to imap_query
+        full    -- Whether the response is for imap_queries["body"]
+        gm_id   -- Whether the response is for imap_queries["gm_id"]
+        records -- Whether to build compact pygmail.message.HeaderRecord
+                   objects, instead of MessageHeaders objects, for responses
+                   to imap_queries["header"]
+        structure -- Whether the response is for imap_queries["structure"]
+
+    Returns:
+        A generator of message objects (or X-GM-MSGID strings, if gm_id is
+        True)
+    """
+    for fetched in split_fetch_response(response or ()):
+        if gm_id:
+            gm_id_match = GM_ID_EXTRACTOR.match(fetched.metadata)
             if gm_id_match:
-                messages.append(gm_id_match.group(1))
-    elif teaser:
-        end_metadata = False
-        end_header = False
-        metadata_section = ''
-        header_section = ''
-        body_section = ''
-        for part in response:
-            if isinstance(part, basestring):
-                message_complete = True
+                yield gm_id_match.group(1)
+        elif teaser:
+            if is_partial(teaser):
+                body = fetched.section(PARTIAL_TEASER_SECTION)
+                truncated = len(body) >= teaser
             else:
-                for sub_part in part:
-                    if not end_metadata:
-                        metadata_section += sub_part
-                        if 'BODY[HEADER]' in sub_part:
-                            end_metadata = True
-                    elif not end_header:
-                        if 'BODY[1]' in sub_part:
-                            end_header = True
-                        else:
-                            header_section += sub_part
-                        if 'BODY[1] NIL)' in sub_part:
-                            message_complete = True
-                    else:
-                        body_section += sub_part
-            if message_complete:
-                messages.append(GM.MessageTeaser(mailbox,
-                                                 metadata=metadata_section,
-                                                 headers=header_section,
-                                                 body=body_section))
-                message_complete = False
-                end_metadata = False
-                end_header = False
-                metadata_section = ''
-                header_section = ''
-                body_section = ''
-    # Full messages just come in two tuples, the first being the full message
-    # test, and the second a terminator
-    elif full:
-        message_parts = []
-        for part in response:
-            # The first thing we expect to see when iterating over parts of
-            # a fill message is a single tuple, with two parts in it (ie
-            # a nested tuple).  The first part will be the metadata, the second
-            # will be both the headers and the body (since the message class
-            # parses both from the same contents)
-            if len(message_parts) == 0:
-                message_parts.append(part[0])
-                message_parts.append(part[1])
-                message_parts.append(part[1])
-            # Before we complete the message though, we need to read off the
-            # terminating section of the complete message. The below check
-            # has the effect of ignoring every part of a set of full messages
-            elif len(message_parts) == 3:
-                message_complete = True
-
-            if message_complete:
-                messages.append(GM.Message(mailbox,
-                                           metadata=message_parts[METADATA],
-                                           headers=message_parts[HEADERS],
-                                           body=message_parts[BODY]))
-                message_parts[:] = []
-                message_complete = False
-    # The remaining option is that we're only reading headers from the mailbox
-    # in this case, we also expect pairs of values, the first being a nested
-    # tuple of headers and metadata (ie [(metadata, headers)]), and following
-    # that a terminating paren character
+                body = fetched.section(TEASER_SECTION)
+                truncated = False
+            yield GM.MessageTeaser(mailbox, metadata=fetched.metadata,
+                                   headers=fetched.headers(), body=body,
+                                   truncated=truncated)
+        # Full messages are returned as a single literal, which the message
+        # class parses both the headers and the body out of
+        elif full:
+            body = fetched.section(BODY_SECTION)
+            yield GM.Message(mailbox, metadata=fetched.metadata,
+                             headers=body, body=body)
+        elif structure:
+            yield GM.MessageStructure(mailbox, metadata=fetched.metadata,
+                                      headers=fetched.headers())
+        elif records:
+            record = GM.HeaderRecord.from_response(
+                fetched.metadata, fetched.headers())
+            if record is not None:
+                yield record
+        else:
+            yield GM.MessageHeaders(mailbox, metadata=fetched.metadata,
+                                    headers=fetched.headers())
+
+
+def parse_fetch_request(response, mailbox, teaser=False, full=False, gm_id=False,
+                        records=False, structure=False):
+    """Returns a list of the message objects described by the data section
+    of an imaplib2 FETCH response.  See iter_fetch_request for a description
+    of the arguments"""
+    return list(iter_fetch_request(response, mailbox, teaser=teaser,
+                                   full=full, gm_id=gm_id, records=records,
+                                   structure=structure))
+
+
+def fetch_in_chunks(connection, ids, request, chunker, use_uids=False,
+                    max_retries=2, callback=None):
+    """Fetches the given messages with a series of FETCH commands, instead
+    of a single command for every message.  The number of messages requested
+    in each command is picked by the given chunker, which adapts to how
+    quickly, and how many bytes, the server responds with.  A chunk that fails
+    is split in half and retried on its own, up to max_retries times.
+
+    Args:
+        connection -- An authenticated imaplib2 connection, with the mailbox
+                      the messages are in selected
+        ids        -- A list of message ids (or uids) to fetch
+        request    -- The FETCH data items to request, as from imap_query
+        chunker    -- A pygmail.utilities.AdaptiveChunker instance
+
+    Keyword Args:
+        use_uids    -- Whether the given ids are UIDs (UID FETCH) instead of
+                       message sequence numbers (FETCH)
+        max_retries -- The number of times any message will be re-requested
+                       after a failed request before giving up
+
+    Returns:
+        The combined data sections of the FETCH responses on success, and
+        an IMAPError otherwise
+    """
+    results = []
+    retries = []
+    position = [0]
+
+    def _next_chunk():
+        if retries:
+            return retries.pop()
+        elif position[0] < len(ids):
+            chunk = ids[position[0]:position[0] + chunker.size]
+            position[0] += len(chunk)
+            return chunk, 0
+        else:
+            return None
+
+    def _fetch_args(chunk):
+        sequence_set = encode_sequence_set(chunk)
+        if use_uids:
+            return connection.uid, ("FETCH", sequence_set, request)
+        else:
+            return connection.fetch, (sequence_set, request)
+
+    def _record(imap_response, chunk, attempts, started):
+        error = check_for_response_error(imap_response)
+        if not error:
+            data = extract_data(imap_response)
+            chunker.record(len(chunk), time.time() - started, response_size(data))
+            results.extend(part for part in data if part is not None)
+            return None
+
+        chunker.failed()
+        if attempts >= max_retries:
+            return error
+        if __debug__:
+            _log("Retrying FETCH of {num} messages after error: {msg}".format(
+                num=len(chunk), msg=error.msg))
+        middle = len(chunk) / 2
+        if middle:
+            retries.append((chunk[middle:], attempts + 1))
+            retries.append((chunk[:middle], attempts + 1))
+        else:
+            retries.append((chunk, attempts + 1))
+        return None
+
+    def _on_fetch(imap_response, chunk, attempts, started):
+        error = _record(imap_response, chunk, attempts, started)
+        if error:
+            return _cmd(callback, error)
+        else:
+            return _fetch_next()
+
+    def _fetch_next():
+        next_chunk = _next_chunk()
+        if next_chunk is None:
+            return _cmd(callback, results)
+        chunk, attempts = next_chunk
+        func, args = _fetch_args(chunk)
+        cbp = dict(chunk=chunk, attempts=attempts, started=time.time())
+        return _cmd_cb(func, _on_fetch, True, *args, callback_args=cbp)
+
+    if callback:
+        return _fetch_next()
+
+    # In blocking mode we loop instead of chaining callbacks, so that
+    # fetching a long list of messages doesn't recurse once per chunk
+    next_chunk = _next_chunk()
+    while next_chunk is not None:
+        chunk, attempts = next_chunk
+        func, args = _fetch_args(chunk)
+        started = time.time()
+        try:
+            imap_response = func(*args)
+        except Exception as e:
+            imap_response = ("NO", [str(e)])
+        error = _record(imap_response, chunk, attempts, started)
+        if error:
+            return error
+        next_chunk = _next_chunk()
+    return results
+
+
+def format_labels(labels):
+    """Formats a list of gmail labels as a parenthesized list of astrings,
+    for use with the X-GM-LABELS STORE data items.
+
+    >>> print format_labels(['Receipts', '\\\\Important', 'Paid bills'])
+    (Receipts "\\\\Important" "Paid bills")
+
+    Args:
+        labels -- A label, or list of labels, as strings, unicode strings or
+                  parsed values (see pygmail.utilities.quote_astring)
+
+    Returns:
+        The formatted string
+    """
+    if isinstance(labels, basestring):
+        labels = [labels]
+    return '(%s)' % (' '.join(quote_astring(label) for label in labels),)
+
+
+def parse_copyuid(response):
+    """Finds the UIDs that copied messages were given in the destination
+    mailbox, from the response to a UID COPY command, if the server
+    supports UIDPLUS (as Gmail does)
+
+    Args:
+        response -- The data section of an imaplib2 COPY response
+
+    Returns:
+        A list of the new UIDs (as strings), or None if the response didn't
+        include a COPYUID response code
+    """
+    for line in response:
+        if isinstance(line, basestring):
+            match = COPYUID_PATTERN.search(line)
+            if match:
+                return decode_sequence_set(match.group(1))
+    return None
+
+
+def pop_copyuid(connection):
+    """Reads, and clears, the COPYUID response code the server sent with the
+    last UID COPY or UID MOVE on the given connection.  imaplib2 hands back
+    the untagged data for those commands, not the tagged response, but
+    keeps its response codes (such as "COPYUID 38505 304 3956") among the
+    connection's untagged responses
+
+    Args:
+        connection -- An imaplib2 connection
+
+    Returns:
+        A list of the new UIDs (as strings), or None if no COPYUID response
+        code has been received since it was last read
+    """
+    try:
+        typ, data = connection.response('COPYUID')
+    except Exception:
+        return None
+    for line in data or ():
+        if isinstance(line, basestring):
+            fields = line.split()
+            if len(fields) == 3:
+                return decode_sequence_set(fields[2])
+    return None
+
+
+def page_range(count, limit, offset, newest_first=False):
+    """Computes the range of message sequence numbers that make up a page of
+    a mailbox, using just the number of messages in the mailbox (ie the
+    EXISTS count returned when selecting it).  This lets us paginate without
+    searching for the id of every message in the mailbox.
+
+    Args:
+        count  -- The number of messages in the mailbox
+        limit  -- The maximum number of messages in the page.  If None or
+                  False, the page includes every message after offset
+        offset -- The number of messages to skip before the page begins
+
+    Keyword Args:
+        newest_first -- If True, offset is counted back from the newest
+                        (highest numbered) message, instead of forward from
+                        the oldest
+
+    Returns:
+        A (first, last) tuple of sequence numbers, inclusive, or None if the
+        page contains no messages
+    """
+    no_limit = limit is None or limit is False
+    if newest_first:
+        last = count - offset
+        first = 1 if no_limit else max(1, last - limit + 1)
     else:
-        message_parts = []
-        for part in response:
-            # If we don't currently have any message parts capture,
-            # we expect the next chunk to be a tuple, which is nested and
-            # contains two subparts, the metadata and the headers
-            if len(message_parts) == 0:
-                message_parts.append(part[0])
-                message_parts.append(part[1])
-            # Otherwise, we expect to see a terminator character, which we
-            # ignore / don't store, and complete the message
-            elif len(message_parts) == 2:
-                message_complete = True
-
-            if message_complete:
-                messages.append(GM.MessageHeaders(mailbox,
-                                                  metadata=message_parts[METADATA],
-                                                  headers=message_parts[HEADERS]))
-                message_parts[:] = []
-                message_complete = False
-    return messages
+        first = offset + 1
+        last = count if no_limit else min(count, offset + limit)
+    if first > last:
+        return None
+    return first, last
 
 
 def page_from_list(a_list, limit, offset):
@@ -192,13 +603,48 @@ class Mailbox(object):
 
         """
         self.account = account
-        self.conn = account.connection
+        self.conn = self.connection
         self.full_name = full_name
         self.name = Mailbox.NAME_PATTERN.match(full_name).groups()[2]
 
+        # Lazy-loaded collection of pygmail.utilities.AdaptiveChunker
+        # objects, keyed by the FETCH data items they're used to request,
+        # since the best chunk size depends on how much data is requested
+        # per message
+        self._chunkers = {}
+
     def __str__(self):
         return "<Mailbox: %s>" % (self.name,)
 
+    def connection(self, callback=None):
+        """Returns an authenticated connection to gmail that should be used
+        for operations on this mailbox.  If the account is holding a pool of
+        connections, this will be the connection this mailbox is pinned to.
+
+        Returns:
+            pygmail.account.AuthError, if the account's connection parameters
+            are not accepted by the Gmail server, and otherwise an imaplib2
+            connection object.
+        """
+        return self.account.connection(callback=callback, mailbox=self)
+
+    def chunker(self, request):
+        """Returns the object used to pick how many messages are requested
+        at a time when fetching the given data items from this mailbox
+
+        Args:
+            request -- A string of IMAP FETCH data items, as from imap_query
+
+        Returns:
+            A pygmail.utilities.AdaptiveChunker instance
+        """
+        try:
+            return self._chunkers[request]
+        except KeyError:
+            self._chunkers[request] = AdaptiveChunker()
+            return self._chunkers[request]
+
+    @checked_out
     def count(self, callback=None):
         """Returns a count of the number of emails in the mailbox
 
@@ -210,7 +656,7 @@ class Mailbox(object):
         @pygmail.errors.check_imap_response(callback)
         def _on_select_complete(imap_response):
             data = extract_data(imap_response)
-            self.account.last_viewed_mailbox = self
+            self.account.set_selected(self)
             msg_count = int(Mailbox.COUNT_PATTERN.sub("", str(data)))
             return _cmd(callback, msg_count)
 
@@ -219,123 +665,663 @@ class Mailbox(object):
             return _cmd_cb(connection.select, _on_select_complete,
                            bool(callback), self.name)
 
-        return _cmd_cb(self.account.connection, _on_connection, bool(callback))
+        return _cmd_cb(self.conn, _on_connection, bool(callback))
+
+    @checked_out
+    def sync(self, state=None, callback=None):
+        """Finds what changed in the mailbox since the last time it was synced,
+        without refetching anything about messages that didn't change.
+
+        The mailbox's UIDVALIDITY, UIDNEXT and (where the server supports
+        CONDSTORE) HIGHESTMODSEQ are compared against the given state.
+        Only UIDs at or above the old UIDNEXT are searched for, only messages
+        with a mod-sequence above the old HIGHESTMODSEQ have their flags and
+        labels fetched (with CHANGEDSINCE), and the old UIDs are only checked
+        for vanished messages if the message count shows that some were
+        removed.
+
+        Keyword Args:
+            state -- The pygmail.sync.SyncState returned from the previous
+                     sync (as SyncResult.state), or None to start a new sync
+
+        Returns:
+            A pygmail.sync.SyncResult object on success, and an error object
+            otherwise
+        """
+        previous = state
+        result = []
+
+        def _uid_list(imap_response):
+            data = extract_data(imap_response)
+            return sorted(int(uid) for uid in string.split(data[0] or ''))
+
+        def _finish():
+            sync_result = result[0]
+            sync_result.new = [str(uid) for uid in sync_result.new]
+            sync_result.vanished = [str(uid) for uid in sync_result.vanished]
+            return _cmd(callback, sync_result)
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_remaining_uids(imap_response):
+            sync_result = result[0]
+            remaining = set(_uid_list(imap_response))
+            sync_result.vanished = sorted(previous.uids - remaining)
+            sync_result.state.uids -= set(sync_result.vanished)
+            return _finish()
+
+        def _check_vanished(connection, num_messages):
+            sync_result = result[0]
+            if sync_result.reset or not previous.uids:
+                return _finish()
+            expected = len(previous.uids) + len(sync_result.new)
+            if num_messages == expected:
+                return _finish()
+            return _cmd_cb(connection.uid, _on_remaining_uids, bool(callback),
+                           'SEARCH', 'UID', encode_sequence_set(previous.uids))
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_changes(imap_response, connection, num_messages):
+            result[0].changed = sync.parse_changes(extract_data(imap_response))
+            return _check_vanished(connection, num_messages)
+
+        def _check_changes(connection, num_messages):
+            sync_result = result[0]
+            new_state = sync_result.state
+            if sync_result.reset or not previous.uids:
+                return _check_vanished(connection, num_messages)
+            elif new_state.highestmodseq is None or previous.highestmodseq is None:
+                sync_result.changed = None
+                return _check_vanished(connection, num_messages)
+            elif new_state.highestmodseq <= previous.highestmodseq:
+                return _check_vanished(connection, num_messages)
+            cbp = dict(connection=connection, num_messages=num_messages)
+            return _cmd_cb(connection.uid, _on_changes, bool(callback),
+                           'FETCH', encode_sequence_set(previous.uids),
+                           '(UID FLAGS X-GM-LABELS)',
+                           '(CHANGEDSINCE %d)' % (previous.highestmodseq,),
+                           callback_args=cbp)
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_new_uids(imap_response, connection, num_messages):
+            sync_result = result[0]
+            # "n:*" always matches the last message in the mailbox, even if
+            # its uid is below n, so we need to filter the results here
+            minimum = 0 if sync_result.reset else previous.uidnext
+            sync_result.new = [uid for uid in _uid_list(imap_response)
+                               if uid >= minimum]
+            sync_result.state.uids.update(sync_result.new)
+            return _check_changes(connection, num_messages)
+
+        @pygmail.errors.check_imap_state(callback)
+        def _on_selected_connection(connection, num_messages):
+            sync_result = result[0]
+            cbp = dict(connection=connection, num_messages=num_messages)
+            if sync_result.reset:
+                return _cmd_cb(connection.uid, _on_new_uids, bool(callback),
+                               'SEARCH', None, 'ALL', callback_args=cbp)
+            elif sync_result.state.uidnext > previous.uidnext:
+                return _cmd_cb(connection.uid, _on_new_uids, bool(callback),
+                               'SEARCH', 'UID', '%d:*' % (previous.uidnext,),
+                               callback_args=cbp)
+            else:
+                return _check_changes(connection, num_messages)
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_select(num_messages):
+            cbp = dict(num_messages=num_messages)
+            return _cmd_cb(self.conn, _on_selected_connection, bool(callback),
+                           callback_args=cbp)
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_status(imap_response):
+            status = sync.parse_status(extract_data(imap_response))
+            new_state = sync.SyncState(uidvalidity=status.get('UIDVALIDITY'),
+                                       uidnext=status.get('UIDNEXT'),
+                                       highestmodseq=status.get('HIGHESTMODSEQ'))
+            reset = (previous is None or
+                     previous.uidvalidity != new_state.uidvalidity)
+            if not reset:
+                new_state.uids.update(previous.uids)
+            result.append(sync.SyncResult(new_state, reset=reset))
+            return _cmd_cb(self.count, _on_select, bool(callback))
+
+        @pygmail.errors.check_imap_state(callback)
+        def _on_connection(connection):
+            items = 'UIDNEXT UIDVALIDITY'
+            if 'CONDSTORE' in getattr(connection, 'capabilities', ()):
+                items += ' HIGHESTMODSEQ'
+            return _cmd_cb(connection.status, _on_status, bool(callback),
+                           self.name, '(%s)' % (items,))
+
+        return _cmd_cb(self.conn, _on_connection, bool(callback))
+
+    def watch(self, on_event, callback=None, **kwargs):
+        """Watches the mailbox for changes with IMAP IDLE, so that new, removed
+        and changed messages are reported as they happen, instead of needing
+        to poll count() or messages() on a timer.
 
-    def delete_message(self, uid, message_id, trash_folder, callback=None):
+        The mailbox is watched on its own IMAP connection, which is kept open
+        (re-issuing IDLE before Gmail times it out, and reconnecting if the
+        connection is dropped) until the watcher is stopped.  See
+        pygmail.watch.Watcher for details.
+
+        Args:
+            on_event -- A function that will be called with a list of
+                        pygmail.watch.MailboxEvent objects each time the
+                        server reports changes to the mailbox
+
+        Keyword Args:
+            refresh_secs       -- How long to stay in a single IDLE command
+                                  before re-issuing it (default 9 minutes)
+            reconnect_secs     -- How long to wait before reconnecting after
+                                  the connection has been dropped
+            max_reconnect_secs -- The longest to wait between reconnection
+                                  attempts
+
+        Returns:
+            In async mode, the pygmail.watch.Watcher instance is returned
+            immediately (call its stop() method to stop watching), and the
+            callback receives True once the watcher is stopped, or an error
+            object if the mailbox couldn't be watched.  In blocking mode this
+            call doesn't return until the watcher is stopped, and then
+            returns the same value the callback would receive (create a
+            pygmail.watch.Watcher directly to keep a reference to it for
+            stopping it).
+        """
+        watcher = watch.Watcher(self, on_event, **kwargs)
+        rs = watcher.start(callback=callback)
+        return watcher if callback else rs
+
+    @checked_out
+    def delete_message(self, uid, message_id, trash_folder, callback=None,
+                       permanent=True):
         """Allows for deleting a message by UID, without needing to pulldown
-        and populate a Message object first.
+        and populate a Message object first.  This is a single message
+        version of delete_messages.
 
         Args:
             uid          -- the uid for a message in the current mailbox
             message_id   -- the message id, from the email headers of the
-                            message to delete
+                            message to delete (only used for logging)
             trash_folder -- the name of the folder / label that is, in the
                             current account, the trash container
 
+        Keyword Args:
+            permanent -- If False, the message is only moved to the trash,
+                         which usually takes a single round trip to the
+                         server (default True)
+
         Returns:
-            A boolean description of whether a message was successfully deleted
+            A boolean description of whether a message was successfully
+            deleted, or an error object
         """
         @pygmail.errors.check_imap_response(callback)
-        def _on_original_mailbox_reselected(imap_response):
-            return _cmd(callback, True)
+        def _on_delete(num_deleted):
+            if not num_deleted and __debug__:
+                _log("Giving up trying to delete message {id}".format(id=message_id))
+            return _cmd(callback, num_deleted > 0)
+
+        return _cmd_cb(self.delete_messages, _on_delete, bool(callback),
+                       [uid], trash_folder=trash_folder, permanent=permanent)
+
+    @checked_out
+    def delete_messages(self, uids, trash_folder=None, callback=None,
+                        permanent=True):
+        """Deletes many messages from the account at once, by UID, without
+        needing to pulldown and populate Message objects first.
+
+        The messages are moved to the trash in the cheapest way the server
+        supports (see pygmail.message.delete_strategy): with UID MOVE, by
+        adding the \\Trash label, or with UID COPY.  If permanent is False,
+        that single command is the whole delete.
+
+        Otherwise, the messages are then expunged from the trash.  This takes
+        a fixed number of round trips regardless of how many messages are
+        deleted: the gmail ids of the messages are fetched, the messages are
+        moved and the trash is selected, the messages are found in it (using
+        the COPYUID response code if the server sent one, and otherwise a
+        single OR-combined X-GM-MSGID search for the gmail ids), flagged as
+        deleted with a single STORE, expunged, and then the current mailbox
+        is reselected.
 
-        @pygmail.errors.check_imap_state(callback)
-        def _on_recevieved_connection_7(connection):
-            return _cmd_cb(connection.select, _on_original_mailbox_reselected,
-                           bool(callback))
+        Args:
+            uids -- A list of uids of messages in the current mailbox
+
+        Keyword Args:
+            trash_folder -- the name of the folder / label that is, in the
+                            current account, the trash container.  If not
+                            provided, it is looked up with
+                            pygmail.account.Account.trash_mailbox
+            permanent    -- If False, the messages are only moved to the
+                            trash (default True)
+
+        Returns:
+            The number of messages that were deleted, and an error object
+            otherwise
+        """
+        if not uids:
+            return _cmd(callback, 0)
+
+        uid_set = encode_sequence_set(uids)
+        gm_ids = []
+        attempts = [0]
 
         @pygmail.errors.check_imap_response(callback)
-        def _on_expunge_complete(imap_response):
-            return _cmd_cb(self.conn, _on_recevieved_connection_7, bool(callback))
+        def _on_original_mailbox_reselected(imap_response, num_deleted):
+            self.account.set_selected(self)
+            return _cmd(callback, num_deleted)
 
-        @pygmail.errors.check_imap_state(callback)
-        def _on_recevieved_connection_6(connection):
-            return _cmd_cb(connection.expunge, _on_expunge_complete, bool(callback))
+        def _reselect(connection, num_deleted):
+            return _cmd_cb(connection.select, _on_original_mailbox_reselected,
+                           bool(callback), self.name,
+                           callback_args=dict(num_deleted=num_deleted))
 
         @pygmail.errors.check_imap_response(callback)
-        def _on_delete_complete(imap_response):
-            return _cmd_cb(self.conn, _on_recevieved_connection_6, bool(callback))
+        def _on_expunge_complete(imap_response, connection, num_deleted):
+            return _reselect(connection, num_deleted)
 
-        @pygmail.errors.check_imap_state(callback)
-        def _on_received_connection_4(connection, deleted_uid):
-            del self.num_tries
+        @pygmail.errors.check_imap_response(callback)
+        def _on_delete_complete(imap_response, connection, num_deleted):
+            cbp = dict(connection=connection, num_deleted=num_deleted)
+            return _cmd_cb(connection.expunge, _on_expunge_complete,
+                           bool(callback), callback_args=cbp)
+
+        def _delete_from_trash(connection, trash_uids):
+            if not trash_uids:
+                return _reselect(connection, 0)
+            cbp = dict(connection=connection, num_deleted=len(trash_uids))
             return _cmd_cb(connection.uid, _on_delete_complete, bool(callback),
-                            'STORE', deleted_uid, 'FLAGS', '\\Deleted')
+                           'STORE', encode_sequence_set(trash_uids), '+FLAGS',
+                           '(\\Deleted)', callback_args=cbp)
 
         @pygmail.errors.check_imap_response(callback)
-        def _on_search_for_message_complete(imap_response):
-            data = extract_data(imap_response)
+        def _on_search_complete(imap_response, connection):
+            trash_uids = string.split(extract_data(imap_response)[0] or '')
+
+            # Gmail can take a moment to list messages in the trash after
+            # they've been copied there, so if some are missing, wait (until
+            # the server reports new messages in the trash, or the retry
+            # delay runs out) and search again, up to the number of times
+            # allowed by GM.TRASH_SEARCH_RETRIES.  After that, delete
+            # whatever was found.
+            if len(trash_uids) < len(gm_ids):
+                attempts[0] += 1
+                if GM.TRASH_SEARCH_RETRIES.should_retry(attempts[0]):
+                    if __debug__:
+                        _log("Try {num}: found {found} of {total} messages "
+                             "in the trash.  Waiting".format(
+                                 num=attempts[0], found=len(trash_uids),
+                                 total=len(gm_ids)))
+                    return _cmd_retry(_search_trash,
+                                      GM.TRASH_SEARCH_RETRIES.delay(attempts[0]),
+                                      bool(callback), connection, connection)
+            return _delete_from_trash(connection, trash_uids)
+
+        def _search_trash(connection):
+            criteria = ['OR'] * (len(gm_ids) - 1)
+            for gm_id in gm_ids:
+                criteria.extend(('X-GM-MSGID', gm_id))
+            return _cmd_cb(connection.uid, _on_search_complete, bool(callback),
+                           'SEARCH', None, *criteria,
+                           callback_args=dict(connection=connection))
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_trash_selected(imap_response, connection, trash_uids):
+            if trash_uids is not None:
+                return _delete_from_trash(connection, trash_uids)
+            else:
+                return _search_trash(connection)
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_messages_trashed(imap_response, connection, trash_name):
+            if not permanent:
+                return _cmd(callback, len(uids))
+
+            trash_uids = (parse_copyuid(extract_data(imap_response)) or
+                          pop_copyuid(connection))
+            if trash_uids is None and not gm_ids:
+                return _cmd(callback, pygmail.errors.IMAPError(
+                    "Server didn't report where the messages were moved",
+                    "delete_messages"))
+            self.account.pool.slot(self.name).selected = None
+            cbp = dict(connection=connection, trash_uids=trash_uids)
+            return _cmd_cb(connection.select, _on_trash_selected,
+                           bool(callback), trash_name, callback_args=cbp)
+
+        def _trash_messages(connection, trash_name, strategy):
+            if strategy == GM.DELETE_MOVE:
+                args = ('MOVE', uid_set, trash_name)
+            elif strategy == GM.DELETE_LABELS:
+                args = ('STORE', uid_set, '+X-GM-LABELS', '(\\Trash)')
+            else:
+                args = ('COPY', uid_set, trash_name)
+            cbp = dict(connection=connection, trash_name=trash_name)
+
+            # Drop any COPYUID left over from an earlier command, so that it
+            # isn't mistaken for the response to this one
+            pop_copyuid(connection)
 
-            # Its possible here that we've tried to select the message
-            # we want to delete from the trash bin before google has
-            # registered it there for us.  If our search attempt returned
-            # a uid, then we're good to go and can continue.
+            # imaplib2 refuses UID commands it doesn't know about, so if it
+            # predates MOVE, fall back to COPY
             try:
-                deleted_uid = data[0].split()[-1]
-                cbp = dict(deleted_uid=deleted_uid)
-                return _cmd_cb(self.conn, _on_received_connection_4,
-                               bool(callback), callback_args=cbp)
-
-            # If not though, we should wait a couple of seconds and try
-            # again.  We'll do this a maximum of 5 times.  If we still
-            # haven't had any luck at this point, we give up and return
-            # False, indiciating we weren't able to delete the message
-            # fully.
-            except IndexError:
-                self.num_tries += 1
-
-                # If this is the 5th time we're trying to delete this
-                # message, we're going to call it a loss and stop trying.
-                # We do some minimal clean up and then just bail out
-                # Otherwise, schedule another attempt in 2 seconds and
-                # hope that gmail has updated its indexes by then
-                if self.num_tries == 5:
-                    del self.num_tries
-                    if __debug__:
-                        _log.error("Giving up trying to delete message")
-                        _log.error("got response: {response}".format(response=str(imap_response)))
-                    return _cmd(callback, False)
-                else:
-                    if __debug__:
-                        _log.error("Try {num} to delete deleting message.  Waiting".format(num=self.num_tries))
-                        _log.error("got response: {response}".format(response=str(imap_response)))
-                    return _cmd_in(_on_trash_selected, 2, bool(callback))
+                return _cmd_cb(connection.uid, _on_messages_trashed,
+                               bool(callback), *args, callback_args=cbp)
+            except connection.error:
+                if strategy == GM.DELETE_COPY:
+                    raise
+                return _trash_messages(connection, trash_name, GM.DELETE_COPY)
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_gm_ids(data, connection, trash_name, strategy):
+            for line in data:
+                if isinstance(line, basestring):
+                    gm_ids.extend(GM_ID_PATTERN.findall(line))
+            return _trash_messages(connection, trash_name, strategy)
 
         @pygmail.errors.check_imap_state(callback)
-        def _on_received_connection_3(connection):
-            return _cmd_cb(connection.uid, _on_search_for_message_complete,
-                           bool(callback), 'search', None, 'X-GM-RAW',
-                            '"rfc822msgid:{msg_id}"'.format(msg_id=message_id))
+        def _on_connection(connection, trash_name):
+            capabilities = getattr(connection, 'capabilities', ())
+            strategy = GM.delete_strategy(capabilities, permanent)
+
+            # The gmail ids are needed for finding the messages in the trash
+            # whenever the server doesn't say where it put them, which can
+            # only be known once the messages have been moved
+            if not permanent:
+                return _trash_messages(connection, trash_name, strategy)
+
+            request = '(X-GM-MSGID)'
+            cbp = dict(connection=connection, trash_name=trash_name,
+                       strategy=strategy)
+            return _cmd_cb(fetch_in_chunks, _on_gm_ids, bool(callback),
+                           connection, uids, request, self.chunker(request),
+                           use_uids=True, callback_args=cbp)
 
         @pygmail.errors.check_imap_response(callback)
-        def _on_trash_selected(imap_response):
-            # It can take several attempts for the deleted message to show up
-            # in the trash label / folder.  We'll try 5 times, waiting
-            # two sec between each attempt
-            return _cmd_cb(self.conn, _on_received_connection_3, bool(callback))
+        def _on_select(was_selected, trash_name):
+            return _cmd_cb(self.conn, _on_connection, bool(callback),
+                           callback_args=dict(trash_name=trash_name))
 
-        @pygmail.errors.check_imap_state(callback)
-        def _on_received_connection_2(connection):
-            self.num_tries = 0
-            return _cmd_cb(connection.select, _on_trash_selected, bool(callback))
+        @pygmail.errors.check_imap_response(callback)
+        def _on_trash_mailbox(trash):
+            if trash is None:
+                return _cmd(callback, pygmail.errors.IMAPError(
+                    "Unable to find the trash mailbox", "delete_messages"))
+            return _cmd_cb(self.select, _on_select, bool(callback),
+                           callback_args=dict(trash_name=trash.name))
+
+        if trash_folder:
+            return _cmd_cb(self.select, _on_select, bool(callback),
+                           callback_args=dict(trash_name=trash_folder))
+        else:
+            return _cmd_cb(self.account.trash_mailbox, _on_trash_mailbox,
+                           bool(callback))
+
+    def add_labels(self, uids, labels, callback=None):
+        """Adds one or more gmail labels to many messages at once, without
+        needing to pulldown and populate Message objects first.
+
+        Args:
+            uids   -- A list of uids of messages in the current mailbox
+            labels -- A label, or list of labels, to add.  Labels can be given
+                      as strings (ie "Receipts" or "\\Important"), or as
+                      values taken from pygmail.message.Message.labels
+
+        Returns:
+            True on success, and an error object otherwise
+        """
+        return self._store(uids, '+X-GM-LABELS', format_labels(labels),
+                           callback=callback)
+
+    def remove_labels(self, uids, labels, callback=None):
+        """Removes one or more gmail labels from many messages at once.
+
+        Args:
+            uids   -- A list of uids of messages in the current mailbox
+            labels -- A label, or list of labels, to remove (see add_labels)
+
+        Returns:
+            True on success, and an error object otherwise
+        """
+        return self._store(uids, '-X-GM-LABELS', format_labels(labels),
+                           callback=callback)
+
+    def set_flags(self, uids, flags, value=True, callback=None):
+        """Sets or clears one or more IMAP flags on many messages at once (ie
+        marking messages as read by setting "\\Seen").
+
+        Args:
+            uids  -- A list of uids of messages in the current mailbox
+            flags -- A flag, or list of flags, such as "\\Seen" or
+                     "\\Flagged"
+
+        Keyword Args:
+            value -- If True, the flags are added to the messages, and if
+                     False they are removed (default True)
+
+        Returns:
+            True on success, and an error object otherwise
+        """
+        if isinstance(flags, basestring):
+            flags = [flags]
+        item = '+FLAGS.SILENT' if value else '-FLAGS.SILENT'
+        return self._store(uids, item, '(%s)' % (' '.join(flags),),
+                           callback=callback)
+
+    @checked_out
+    def _store(self, uids, item, value, callback=None):
+        """Issues UID STORE commands changing the given data item for each
+        of the given messages.  The uids are sent as compressed sequence sets,
+        with one command per STORE_CHUNK_SIZE messages.
+
+        Args:
+            uids  -- A list of uids of messages in the current mailbox
+            item  -- The STORE data item, such as "+X-GM-LABELS"
+            value -- The already formatted value for the data item
+
+        Returns:
+            True on success, and an error object otherwise
+        """
+        uids = sorted(set(int(uid) for uid in uids))
+        sequence_sets = [encode_sequence_set(uids[i:i + STORE_CHUNK_SIZE])
+                         for i in xrange(0, len(uids), STORE_CHUNK_SIZE)]
+
+        def _store_next(connection):
+            if not sequence_sets:
+                return _cmd(callback, True)
+            return _cmd_cb(connection.uid, _on_store, bool(callback), 'STORE',
+                           sequence_sets.pop(0), item, value,
+                           callback_args=dict(connection=connection))
 
         @pygmail.errors.check_imap_response(callback)
-        def _on_message_moved(imap_response):
-            return _cmd_cb(self.conn, _on_received_connection_2, bool(callback))
+        def _on_store(imap_response, connection):
+            return _store_next(connection)
 
         @pygmail.errors.check_imap_state(callback)
         def _on_connection(connection):
-            return _cmd_cb(connection.uid, _on_message_moved, bool(callback),
-                            'COPY', uid, trash_folder)
+            return _store_next(connection)
 
         @pygmail.errors.check_imap_response(callback)
         def _on_select(was_selected):
-            # self.account.connection(callback=_on_connection)
-            return _cmd_cb(self.account.connection, _on_connection,
-                           bool(callback))
+            return _cmd_cb(self.conn, _on_connection, bool(callback))
 
+        if not sequence_sets:
+            return _cmd(callback, True)
         return _cmd_cb(self.select, _on_select, bool(callback))
 
+    @checked_out
+    def save_messages(self, messages, trash_folder, safe_label=None,
+                      header_label="PyGmail", callback=None):
+        """Copies changes to many messages in the mailbox to the server.  This
+        is a batch version of pygmail.message.Message.save.
+
+        As with Message.save, the original versions of the messages are
+        removed first, since gmail won't keep a new version of a message next
+        to an original with the same Message-ID.  Here they're removed with a
+        single call to delete_messages.  The new versions are then APPENDed
+        one at a time (imaplib2 runs APPEND synchronously, so appends can't
+        be pipelined), and their labels are restored with one STORE per
+        distinct set of labels, instead of one per message.
+
+        Since every original is removed before any new version is written,
+        an APPEND that fails would lose its message.  Appending carries on
+        past failed messages, and the ones that couldn't be written are
+        returned in a pygmail.errors.SaveError.  If safe_label is given, a
+        transactional copy of every message is saved before anything is
+        removed (see pygmail.message.Message.save_copy), and the copies are
+        only deleted once every message has been saved.
+
+        Args:
+            messages     -- A list of pygmail.message.Message objects in the
+                            current mailbox
+            trash_folder -- the name of the folder / label that is, in the
+                            current account, the trash container
+
+        Keyword Args:
+            safe_label   -- If not None, a copy of each message is saved into
+                            a label with the given name before the originals
+                            are removed.  If any message can't be saved, the
+                            copies are kept
+            header_label -- The label to use when writing serialized state into
+                            the headers of the safe copies. If safe_label is
+                            None, this argument will have no effect.
+
+        Returns:
+            True on success, a pygmail.errors.SaveError listing the messages
+            that weren't written back if the originals were removed but some
+            new versions couldn't be appended, and in all other instances an
+            error object.  The uid of each message that was written back is
+            updated to the uid of its new version
+        """
+        copy_uids = []
+        saved = []
+        unsaved = []
+        groups = {}
+
+        def _on_appended(message, uid):
+            if pygmail.errors.is_error(uid):
+                unsaved.append(message)
+                return
+            message.uid = uid
+            saved.append(message)
+            if message.labels_raw:
+                groups.setdefault(message.labels_raw, []).append(uid)
+
+        def _finish():
+            if unsaved:
+                desc = ("%d of %d messages couldn't be saved after their "
+                        "originals were removed" % (len(unsaved), len(messages)))
+                if copy_uids:
+                    desc += " (their safe copies were kept in %s)" % (safe_label,)
+                return _cmd(callback, pygmail.errors.SaveError(
+                    desc, "save_messages", unsaved=unsaved))
+            if not copy_uids:
+                return _cmd(callback, True)
+            return _cmd_cb(self.delete_messages, _on_copies_deleted,
+                           bool(callback), copy_uids,
+                           trash_folder=trash_folder)
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_copies_deleted(num_deleted):
+            return _cmd(callback, True)
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_labels(result):
+            return _store_labels()
+
+        def _store_labels():
+            if not groups:
+                return _finish()
+            labels_raw, uids = groups.popitem()
+            return _cmd_cb(self._store, _on_labels, bool(callback), uids,
+                           '+X-GM-LABELS', '(%s)' % (labels_raw,))
+
+        def _on_append(uid):
+            _on_appended(messages[len(saved) + len(unsaved)], uid)
+            return _next_append()
+
+        def _next_append():
+            position = len(saved) + len(unsaved)
+            if position < len(messages):
+                return _cmd_cb(self._append_message, _on_append, bool(callback),
+                               messages[position])
+            return _store_labels()
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_delete(num_deleted):
+            if callback:
+                return _next_append()
+
+            # In blocking mode, loop over the messages instead of chaining
+            # callbacks, so that saving many messages doesn't recurse once
+            # per message
+            for message in messages:
+                _on_appended(message, self._append_message(message))
+            return _store_labels()
+
+        def _delete_originals():
+            return _cmd_cb(self.delete_messages, _on_delete, bool(callback),
+                           [message.uid for message in messages],
+                           trash_folder=trash_folder)
+
+        def _on_copy(copy):
+            # Nothing has been removed yet, so a failed copy can just be
+            # reported
+            if not copy or pygmail.errors.is_error(copy):
+                return _cmd(callback, copy or pygmail.errors.IMAPError(
+                    "Couldn't save a safe copy of a message", "save_messages"))
+            copy_uids.append(copy[0])
+            return _next_copy()
+
+        def _next_copy():
+            if len(copy_uids) < len(messages):
+                return _cmd_cb(messages[len(copy_uids)].save_copy, _on_copy,
+                               bool(callback), safe_label,
+                               header_label=header_label)
+            return _delete_originals()
+
+        if not messages:
+            return _cmd(callback, True)
+        if not safe_label:
+            return _delete_originals()
+        if callback:
+            return _next_copy()
+
+        for message in messages:
+            copy = message.save_copy(safe_label, header_label=header_label)
+            if not copy or pygmail.errors.is_error(copy):
+                return _on_copy(copy)
+            copy_uids.append(copy[0])
+        return _delete_originals()
+
+    def _append_message(self, message, callback=None):
+        """APPENDs a new version of the given message to the mailbox, with
+        its current flags and internal date.
+
+        Args:
+            message -- A pygmail.message.Message object
+
+        Returns:
+            The uid of the newly appended message, or an error object
+        """
+        @pygmail.errors.check_imap_response(callback)
+        def _on_append(imap_response):
+            uid = GM.parse_appenduid(extract_data(imap_response))
+            if uid is None:
+                return _cmd(callback, pygmail.errors.IMAPError(
+                    "Server didn't report the UID of an appended message",
+                    "append"))
+            return _cmd(callback, uid)
+
+        @pygmail.errors.check_imap_state(callback)
+        def _on_connection(connection):
+            flags_string = '(%s)' % (' '.join(message.flags),) if message.flags else "()"
+            return _cmd_cb(connection.append, _on_append, bool(callback),
+                           self.name, flags_string,
+                           message.internal_date or time.gmtime(),
+                           message.raw.as_string())
+
+        return _cmd_cb(self.conn, _on_connection, bool(callback))
+
     def delete(self, callback=None):
         """Removes the mailbox / folder from the current gmail account. In
         Gmail's implementation, this translates into deleting a Gmail label.
@@ -348,6 +1334,8 @@ class Mailbox(object):
         def _on_mailbox_deletion(imap_response):
             data = extract_data(imap_response)
             was_success = data[0] == "Success"
+            if was_success:
+                self.account.pool.unpin(self.name)
             return _cmd(callback, was_success)
 
         @pygmail.errors.check_imap_state(callback)
@@ -360,6 +1348,7 @@ class Mailbox(object):
 
         return _cmd_cb(self.account.connection, _on_connection, bool(callback))
 
+    @checked_out
     def select(self, callback=None):
         """Sets this mailbox as the current active one on the IMAP connection
 
@@ -373,14 +1362,15 @@ class Mailbox(object):
 
         """
         def _on_count_complete(num):
-            self.account.last_viewed_mailbox = self
+            self.account.set_selected(self)
             return _cmd(callback, True)
 
-        if self is self.account.last_viewed_mailbox:
+        if self.account.is_selected(self):
             return _cmd(callback, False)
         else:
             return _cmd_cb(self.count, _on_count_complete, bool(callback))
 
+    @checked_out
     def search(self, term, limit=100, offset=0, only_uids=False,
                full=False, callback=None, **kwargs):
         """Searches for messages in the inbox that contain a given phrase
@@ -411,7 +1401,7 @@ class Mailbox(object):
                             body (ie the first mime section).  Note that this
                             option is incompatible with the full
                             option, and the former will take precedence
-
+            structure, only_headers, metadata_items -- See messages()
 
         Returns:
             A list of messages or uids (depending on the call arguments) in case
@@ -430,7 +1420,10 @@ class Mailbox(object):
             ids_to_fetch = page_from_list(ids, limit, offset)
             return _cmd_cb(self.messages_by_id, _on_messages_by_id,
                            bool(callback), ids_to_fetch, only_uids=only_uids,
-                           full=full, teaser=teasers, gm_ids=gm_ids)
+                           full=full, teaser=teasers, gm_ids=gm_ids,
+                           structure=kwargs.get('structure'),
+                           only_headers=kwargs.get('only_headers'),
+                           metadata_items=kwargs.get('metadata_items'))
 
         @pygmail.errors.check_imap_state(callback)
         def _on_connection(connection):
@@ -439,10 +1432,11 @@ class Mailbox(object):
 
         @pygmail.errors.check_imap_response(callback)
         def _on_mailbox_selected(was_changed):
-            return _cmd_cb(self.account.connection, _on_connection, bool(callback))
+            return _cmd_cb(self.conn, _on_connection, bool(callback))
 
         return _cmd_cb(self.select, _on_mailbox_selected, bool(callback))
 
+    @checked_out
     def messages(self, limit=100, offset=0, callback=None, **kwargs):
         """Returns a list of all the messages in the inbox
 
@@ -466,6 +1460,26 @@ class Mailbox(object):
                          body (ie the first mime section).  Note that this
                          option is incompatible with the full
                          option, and the former will take precedence
+            newest_first -- If True, pages are counted back from the newest
+                         message in the mailbox, and messages are returned
+                         newest first
+            records   -- If True, and only headers are being fetched,
+                         compact pygmail.message.HeaderRecord objects are
+                         returned instead of MessageHeaders objects
+            structure -- If True, each message's MIME structure is fetched
+                         along with its headers, and
+                         pygmail.message.MessageStructure objects are
+                         returned, whose text and attachments can then be
+                         fetched part by part
+            only_headers -- A list of the names of the only headers to
+                         fetch (ie ["Subject", "From"]), instead of the
+                         entire header block, or True to fetch only the
+                         headers message objects read.  Headers that aren't
+                         fetched read as empty on the returned messages.
+                         See imap_query
+            metadata_items -- A list of the only metadata items (ie
+                         ["FLAGS"]) to fetch for each message.  See
+                         imap_query
 
         Return:
 
@@ -480,29 +1494,202 @@ class Mailbox(object):
         full = kwargs.get('full')
         only_uids = kwargs.get('only_uids')
         gm_ids = kwargs.get('gm_ids')
+        newest_first = kwargs.get('newest_first')
+        records = kwargs.get('records')
 
+        @pygmail.errors.check_imap_response(callback)
         def _on_messages_by_id(messages):
+            if newest_first:
+                messages.reverse()
             return _cmd(callback, messages)
 
+        # The EXISTS count returned when selecting the mailbox is enough to
+        # figure out which sequence numbers are on the requested page, so
+        # there's no need to SEARCH for the id of every message in the mailbox
         @pygmail.errors.check_imap_response(callback)
-        def _on_search(imap_response):
-            data = extract_data(imap_response)
-            ids = string.split(data[0])
-            ids_to_fetch = page_from_list(ids, limit, offset)
+        def _on_count(num_messages):
+            page = page_range(num_messages, limit, offset, newest_first)
+            if page is None:
+                return _cmd(callback, [])
+            ids_to_fetch = [str(an_id) for an_id in xrange(page[0], page[1] + 1)]
             return _cmd_cb(self.messages_by_id, _on_messages_by_id,
                            bool(callback), ids_to_fetch, only_uids=only_uids,
-                           full=full, teaser=teasers, gm_ids=gm_ids)
+                           full=full, teaser=teasers, gm_ids=gm_ids,
+                           records=records,
+                           structure=kwargs.get('structure'),
+                           only_headers=kwargs.get('only_headers'),
+                           metadata_items=kwargs.get('metadata_items'))
+
+        return _cmd_cb(self.count, _on_count, bool(callback))
+
+    @checked_out
+    def _fetch_range(self, first, last, only_uids=False, full=False,
+                     callback=None, **kwargs):
+        """Fetches the raw FETCH response for a contiguous range of messages
+        in the mailbox, by message sequence number.
+
+        Args:
+            first -- The sequence number of the first message to fetch
+            last  -- The sequence number of the last message to fetch
+
+        Keyword Args:
+            See messages_by_id
+
+        Returns:
+            The data section of the imaplib2 FETCH response on success, and
+            an error object otherwise
+        """
+        @pygmail.errors.check_imap_response(callback)
+        def _on_fetch(imap_response):
+            return _cmd(callback, extract_data(imap_response))
 
         @pygmail.errors.check_imap_state(callback)
         def _on_connection(connection):
-            return _cmd_cb(connection.search, _on_search, bool(callback), None, 'ALL')
+            request = imap_query(gm_ids=kwargs.get('gm_ids'),
+                                 only_uids=only_uids, full=full,
+                                 structure=kwargs.get('structure'),
+                                 teaser=kwargs.get('teaser'),
+                                 only_headers=kwargs.get('only_headers'),
+                                 metadata_items=kwargs.get('metadata_items'))
+            return _cmd_cb(connection.fetch, _on_fetch, bool(callback),
+                           "%d:%d" % (first, last), request)
 
         @pygmail.errors.check_imap_response(callback)
-        def _on_select_complete(result):
-            return _cmd_cb(self.account.connection, _on_connection, bool(callback))
+        def _on_select(result):
+            return _cmd_cb(self.conn, _on_connection, bool(callback))
+
+        return _cmd_cb(self.select, _on_select, bool(callback))
+
+    def _chunk_ranges(self, total, limit, offset, chunk_size,
+                      newest_first=False):
+        """Returns a list of (first, last) sequence number pairs covering the
+        messages described by the given limit and offset, with no pair
+        including more than chunk_size messages.  If newest_first is True,
+        the pairs are walked down from the top of the page instead"""
+        page = page_range(total, limit, offset, newest_first)
+        if page is None:
+            return []
+        if newest_first:
+            return [(max(last - chunk_size + 1, page[0]), last)
+                    for last in xrange(page[1], page[0] - 1, -chunk_size)]
+        return [(first, min(first + chunk_size - 1, page[1]))
+                for first in xrange(page[0], page[1] + 1, chunk_size)]
+
+    def _parse_chunk(self, data, only_uids=False, full=False, **kwargs):
+        if only_uids:
+            messages = parse_uids(data)
+        else:
+            messages = iter_fetch_request(data, self, kwargs.get('teaser'),
+                                          full, kwargs.get('gm_ids'),
+                                          records=kwargs.get('records'),
+                                          structure=kwargs.get('structure'))
+        if kwargs.get('newest_first'):
+            messages = list(messages)
+            messages.reverse()
+        return iter(messages)
+
+    def iter_messages(self, limit=None, offset=0, chunk_size=100, **kwargs):
+        """Iterates over the messages in the mailbox, fetching them from the
+        server in bounded chunks.  Only one chunk of messages is held in
+        memory at a time, so this can be used to scan very large mailboxes.
+        This method is blocking only; see stream_messages for the async
+        version.
+
+        Messages are returned in the same order as messages().  Since
+        messages are requested by sequence number, messages expunged from the
+        mailbox while the iteration is in progress may cause other messages
+        to be skipped.
+
+        Keyword Args:
+            limit      -- The maximum number of messages to return.  If None,
+                          every message after offset is returned
+            offset     -- The first message to return out of the entire set
+                          of messages in the mailbox
+            chunk_size -- The maximum number of messages to fetch with
+                          each FETCH request
+            only_uids, full, teaser, gm_ids, newest_first, records,
+            structure, only_headers, metadata_items -- See messages()
+
+        Returns:
+            A generator of pygmail.message.Message objects (or uids).  If an
+            error is encountered, the error object is yielded and the
+            iteration stops.
+        """
+        total = self.count()
+        if pygmail.errors.is_error(total):
+            yield total
+            return
+
+        ranges = self._chunk_ranges(total, limit, offset, chunk_size,
+                                    kwargs.get('newest_first'))
+        for first, last in ranges:
+            data = self._fetch_range(first, last, **kwargs)
+            if pygmail.errors.is_error(data):
+                yield data
+                return
+            for message in self._parse_chunk(data, **kwargs):
+                yield message
+            del data
+
+    @checked_out
+    def stream_messages(self, on_message, limit=None, offset=0,
+                        chunk_size=100, callback=None, **kwargs):
+        """Delivers each message in the mailbox to the given function, fetching
+        them from the server in bounded chunks.  The next chunk is only
+        requested once every message in the current chunk has been handed to
+        on_message, so only one chunk of messages is held in memory at a time.
+
+        Args:
+            on_message -- A function that is called with each message object
+                          (or uid) in the mailbox, in the same order as
+                          messages()
+
+        Keyword Args:
+            See iter_messages
 
-        return _cmd_cb(self.select, _on_select_complete, bool(callback))
+        Returns:
+            The number of messages delivered to on_message on success, and
+            an error object otherwise
+        """
+        ranges = []
+        delivered = [0]
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_chunk(data):
+            for message in self._parse_chunk(data, **kwargs):
+                delivered[0] += 1
+                on_message(message)
+            return _next_chunk()
+
+        def _next_chunk():
+            if not ranges:
+                return _cmd(callback, delivered[0])
+            else:
+                first, last = ranges.pop(0)
+                return _cmd_cb(self._fetch_range, _on_chunk, bool(callback),
+                               first, last, **kwargs)
 
+        @pygmail.errors.check_imap_response(callback)
+        def _on_count(total):
+            ranges.extend(self._chunk_ranges(total, limit, offset, chunk_size,
+                                             kwargs.get('newest_first')))
+            return _next_chunk()
+
+        # In blocking mode, loop over the generator version instead of
+        # chaining callbacks, so that scanning a large mailbox doesn't
+        # recurse once per chunk
+        if not callback:
+            for message in self.iter_messages(limit=limit, offset=offset,
+                                              chunk_size=chunk_size, **kwargs):
+                if pygmail.errors.is_error(message):
+                    return message
+                delivered[0] += 1
+                on_message(message)
+            return delivered[0]
+
+        return _cmd_cb(self.count, _on_count, bool(callback))
+
+    @checked_out
     def fetch_all(self, uids, full=False, callback=None, **kwargs):
         """Returns a list of messages, each specified by their UID
 
@@ -522,6 +1709,7 @@ class Mailbox(object):
                        body (ie the first mime section).  Note that this
                        option is incompatible with the full
                        option, and the former will take precedence
+            structure, only_headers, metadata_items -- See messages()
 
         Returns:
             Zero or more pygmail.message.Message objects, representing any
@@ -529,34 +1717,70 @@ class Mailbox(object):
         """
         teasers = kwargs.get("teaser")
         gm_ids = kwargs.get('gm_ids')
+        structure = kwargs.get('structure')
 
         @pygmail.errors.check_imap_response(callback)
-        def _on_fetch(imap_response):
-            data = extract_data(imap_response)
-            messages = parse_fetch_request(data, self, teasers, full, gm_ids)
+        def _on_fetch(data):
+            messages = parse_fetch_request(data, self, teasers, full, gm_ids,
+                                           structure=structure)
             return _cmd(callback, messages)
 
         @pygmail.errors.check_imap_state(callback)
         def _on_connection(connection):
-            if gm_ids:
-                request = imap_queries["gm_id"]
-            elif full:
-                request = imap_queries["body"]
-            elif teasers:
-                request = imap_queries["teaser"]
-            else:
-                request = imap_queries["header"]
-            return _cmd_cb(connection.uid, _on_fetch, bool(callback),
-                           "FETCH", ",".join(uids), request)
+            request = imap_query(gm_ids=gm_ids, full=full, teaser=teasers,
+                                 structure=structure,
+                                 only_headers=kwargs.get('only_headers'),
+                                 metadata_items=kwargs.get('metadata_items'))
+            return _cmd_cb(fetch_in_chunks, _on_fetch, bool(callback),
+                           connection, uids, request, self.chunker(request),
+                           use_uids=True)
 
         def _on_select(result):
-            return _cmd_cb(self.account.connection, _on_connection, bool(callback))
+            return _cmd_cb(self.conn, _on_connection, bool(callback))
 
         if uids:
             return _cmd_cb(self.select, _on_select, bool(callback))
         else:
             return _cmd(callback, None)
 
+    @checked_out
+    def attachment_index(self, uids, callback=None):
+        """Lists the attachments of each of the given messages, using only
+        their BODYSTRUCTURE, so that no message bodies are downloaded.  The
+        messages are fetched in bulk, with as few FETCH commands as possible
+        (see fetch_in_chunks)
+
+        Arguments:
+            uids -- A list of zero or more email uids
+
+        Returns:
+            A dict mapping the uid of each message that was found (as a
+            string) to a list of pygmail.structure.BodyPart objects, one for
+            each of its attachments.  Each part's filename, content_type,
+            size and section (which can be passed to fetch_parts) describe
+            the attachment.  If an error is encountered, an IMAPError object
+            will be returned.
+        """
+        @pygmail.errors.check_imap_response(callback)
+        def _on_fetch(data):
+            return _cmd(callback, parse_attachment_index(data))
+
+        @pygmail.errors.check_imap_state(callback)
+        def _on_connection(connection):
+            request = imap_queries["attachments"]
+            return _cmd_cb(fetch_in_chunks, _on_fetch, bool(callback),
+                           connection, uids, request, self.chunker(request),
+                           use_uids=True)
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_select(result):
+            return _cmd_cb(self.conn, _on_connection, bool(callback))
+
+        if not uids:
+            return _cmd(callback, {})
+        return _cmd_cb(self.select, _on_select, bool(callback))
+
+    @checked_out
     def fetch(self, uid, full=False, callback=None, **kwargs):
         """Returns a single message from the mailbox by UID
 
@@ -576,6 +1800,7 @@ class Mailbox(object):
                        body (ie the first mime section).  Note that this
                        option is incompatible with the full
                        option, and the former will take precedence
+            structure, only_headers, metadata_items -- See messages()
 
         Returns:
             A pygmail.message.Message object representing the email message, or
@@ -584,32 +1809,75 @@ class Mailbox(object):
         """
         teasers = kwargs.get("teaser")
         gm_ids = kwargs.get('gm_ids')
+        structure = kwargs.get('structure')
 
         @pygmail.errors.check_imap_response(callback)
         def _on_fetch(imap_response):
             data = extract_data(imap_response)
-            messages = parse_fetch_request(data, self, teasers, full, gm_ids)
+            messages = parse_fetch_request(data, self, teasers, full, gm_ids,
+                                           structure=structure)
             return _cmd(callback, messages[0] if len(messages) > 0 else None)
 
         @pygmail.errors.check_imap_state(callback)
         def _on_connection(connection):
-            if gm_ids:
-                request = imap_queries["gm_id"]
-            elif full:
-                request = imap_queries["body"]
-            elif teasers:
-                request = imap_queries["teaser"]
-            else:
-                request = imap_queries["header"]
+            request = imap_query(gm_ids=gm_ids, full=full, teaser=teasers,
+                                 structure=structure,
+                                 only_headers=kwargs.get('only_headers'),
+                                 metadata_items=kwargs.get('metadata_items'))
+            return _cmd_cb(connection.uid, _on_fetch, bool(callback),
+                           "FETCH", uid, request)
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_select(result):
+            return _cmd_cb(self.conn, _on_connection, bool(callback))
+
+        return _cmd_cb(self.select, _on_select, bool(callback))
+
+    @checked_out
+    def fetch_parts(self, uid, parts, callback=None):
+        """Fetches just the given parts of a single message, such as its
+        text/html part or one of its attachments, in one FETCH command,
+        without downloading the rest of the message
+
+        Arguments:
+            uid   -- the numeric, unique identifier of the message in the
+                     mailbox
+            parts -- a list of pygmail.structure.BodyPart objects, from the
+                     message's structure (see
+                     pygmail.message.MessageStructure)
+
+        Returns:
+            A dict mapping the section of each part (ie "1.2") to its
+            contents, with its content transfer encoding undone, as a byte
+            string.  If an error is encountered, an IMAPError object will be
+            returned.
+        """
+        @pygmail.errors.check_imap_response(callback)
+        def _on_fetch(imap_response):
+            bodies = {}
+            for fetched in split_fetch_response(extract_data(imap_response)):
+                for part in parts:
+                    body = fetched.section('BODY[%s]' % (part.section,), None)
+                    if body is not None:
+                        bodies[part.section] = GM.decode_partial(body, part.encoding)
+            return _cmd(callback, bodies)
+
+        @pygmail.errors.check_imap_state(callback)
+        def _on_connection(connection):
+            request = '(%s)' % ' '.join('BODY.PEEK[%s]' % (part.section,)
+                                        for part in parts)
             return _cmd_cb(connection.uid, _on_fetch, bool(callback),
                            "FETCH", uid, request)
 
         @pygmail.errors.check_imap_response(callback)
         def _on_select(result):
-            return _cmd_cb(self.account.connection, _on_connection, bool(callback))
+            return _cmd_cb(self.conn, _on_connection, bool(callback))
 
+        if not parts:
+            return _cmd(callback, {})
         return _cmd_cb(self.select, _on_select, bool(callback))
 
+    @checked_out
     def fetch_gm_id(self, gm_id, full=False, callback=None, **kwargs):
         """Fetches a single message from the mailbox, specified by the
         given X-GM-MSGID.
@@ -651,10 +1919,11 @@ class Mailbox(object):
 
         @pygmail.errors.check_imap_response(callback)
         def _on_select(result):
-            return _cmd_cb(self.account.connection, _on_connection, bool(callback))
+            return _cmd_cb(self.conn, _on_connection, bool(callback))
 
         return _cmd_cb(self.select, _on_select, bool(callback))
 
+    @checked_out
     def messages_by_id(self, ids, only_uids=False, full=False, callback=None, **kwargs):
         """Fetches messages in the mailbox by their id
 
@@ -676,6 +1945,10 @@ class Mailbox(object):
                             body (ie the first mime section).  Note that this
                             option is incompatible with the full
                             option, and the former will take precedence
+            records      -- If True, and only headers are being fetched,
+                            compact pygmail.message.HeaderRecord objects are
+                            returned instead of MessageHeaders objects
+            structure, only_headers, metadata_items -- See messages()
 
         Returns:
             A list of zero or more message objects (or uids) if success, and
@@ -683,6 +1956,8 @@ class Mailbox(object):
         """
         teasers = kwargs.get("teaser")
         gm_ids = kwargs.get('gm_ids')
+        records = kwargs.get('records')
+        structure = kwargs.get('structure')
 
         # If we were told to fetch no messages, fast "callback" and don't
         # bother doing any network io
@@ -690,32 +1965,28 @@ class Mailbox(object):
             return _cmd(callback, [])
 
         @pygmail.errors.check_imap_response(callback)
-        def _on_fetch(imap_response):
-            data = extract_data(imap_response)
+        def _on_fetch(data):
             if only_uids:
-                uids = [string.split(elm, " ")[4][:-1] for elm in data]
+                uids = parse_uids(data)
                 return _cmd(callback, uids)
             else:
-                messages = parse_fetch_request(data, self, teasers, full, gm_ids)
+                messages = parse_fetch_request(data, self, teasers, full,
+                                               gm_ids, records=records,
+                                               structure=structure)
                 return _cmd(callback, messages)
 
         @pygmail.errors.check_imap_state(callback)
         def _on_connection(connection):
-            if gm_ids:
-                request = imap_queries["gm_id"]
-            elif only_uids:
-                request = imap_queries["uid"]
-            elif full:
-                request = imap_queries["body"]
-            elif teasers:
-                request = imap_queries["teaser"]
-            else:
-                request = imap_queries["header"]
-            return _cmd_cb(connection.fetch, _on_fetch, bool(callback),
-                           ",".join(ids), request)
+            request = imap_query(gm_ids=gm_ids, only_uids=only_uids,
+                                 full=full, teaser=teasers,
+                                 structure=structure,
+                                 only_headers=kwargs.get('only_headers'),
+                                 metadata_items=kwargs.get('metadata_items'))
+            return _cmd_cb(fetch_in_chunks, _on_fetch, bool(callback),
+                           connection, ids, request, self.chunker(request))
 
         @pygmail.errors.check_imap_response(callback)
         def _on_select(result):
-            return _cmd_cb(self.account.connection, _on_connection, bool(callback))
+            return _cmd_cb(self.conn, _on_connection, bool(callback))
 
         return _cmd_cb(self.select, _on_select, bool(callback))
@@ -1,3 +1,4 @@
+import codecs
 import email
 import re
 import email.utils
@@ -6,30 +7,328 @@ import email.encoders as ENC
 import email.charset
 import time
 import pygmail.errors
-from imaplib import Internaldate2tuple, ParseFlags
+from imaplib import Internaldate2tuple
 from base64 import b64decode
 from datetime import datetime
 from quopri import encodestring, decodestring
 from email.parser import HeaderParser
 from email.Iterators import typed_subpart_iterator
 from pygmail.address import Address
-from pygmail.utilities import extract_data, extract_first_bodystructure, parse, ParseError, _cmd_in, _cmd_cb, _cmd, _log
-from pygmail.errors import is_encoding_error, check_for_response_error
+from pygmail.pool import checked_out
+from pygmail.structure import parse_bodystructure
+from pygmail.utilities import extract_data, parse, ParseError, RetrySchedule, _cmd_cb, _cmd, _log
+from pygmail.errors import is_encoding_error
 from hashlib import sha1
 
 
-# A regular expression used for extracting metadata information out
-# of the raw IMAP returned string.
-METADATA_PATTERN = re.compile(r'(\d*) \(X-GM-MSGID (\d*) X-GM-LABELS \((.*)\) UID (\d*) INTERNALDATE "(.*?)"')
+# Matches the start of a message's FETCH response, such as '12 (UID 5 ...',
+# capturing the message's sequence number
+METADATA_START_PATTERN = re.compile(r'\s*(\d+) \(')
 
-METADATA_TEASER_PATTERN = re.compile(r'(\d*) \(X-GM-MSGID (\d*) X-GM-LABELS \((.*)\) UID (\d*) INTERNALDATE "(.*?)"')
+# Matches a single data item (and its value) in a FETCH response, starting
+# at a given position.  Items whose values are nested lists (ie
+# BODYSTRUCTURE) only have their opening paren matched, and are skipped
+# over with skip_list
+METADATA_ITEM_PATTERN = re.compile(r'''
+    \ *(?P<name>[A-Z0-9.\-]+(?:\[[^\]]*\](?:<[\d.]+>)?)?)\ 
+    (?:(?P<number>\d+)
+      |"(?P<quoted>[^"\\]*(?:\\.[^"\\]*)*)"
+      |\((?P<list>[^()"]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^()"]*)*)\)
+      |\{\d+\}
+      |NIL
+      |(?P<nested>\())
+''', re.VERBOSE)
+
+# Matches the quoted strings and parens in a nested list (see skip_list)
+NESTED_TOKEN_PATTERN = re.compile(r'"(?:[^"\\]|\\.)*"|[()]')
 
-BODY_STRUCTRUE = re.compile(r'BODYSTRUCTURE \((.*?)\) BODY\[HEADER\]')
-CHARSET_EXTRACTOR = re.compile(r'\("charset" "(.*?)"')
 HEADER_PARSER = HeaderParser()
-BOUNDARY_EXTRACTOR = re.compile(r'\("BOUNDARY" "(.*?)"\)', re.I)
 SECTION_HEADERS_ENDING = re.compile(r'\n\n|\r\r|\r\n\r\n', re.M)
-ENCODING_EXTRACTOR = re.compile(r'7bit|8bit|base64|quoted-printable')
+
+# Matches a quoted-printable escape sequence or soft line break that was
+# cut off by the end of a partial fetch, such as the "=C" in "caf=C" or
+# the "=\r" in "caf=\r"
+TRUNCATED_QP_PATTERN = re.compile(r'=(?:[0-9A-Fa-f]|\r)?\Z')
+
+# How often to search the trash for a message that was just copied there,
+# but hasn't shown up yet, when deleting messages
+TRASH_SEARCH_RETRIES = RetrySchedule(attempts=5)
+
+# Extracts the UID an appended message was given, from the UIDPLUS response
+# code to an APPEND command, such as '[APPENDUID 38505 3955] (Success)'
+APPENDUID_PATTERN = re.compile(r'\[APPENDUID \d+ (\d+)\]')
+
+# The ways messages can be moved to the trash, from cheapest to most
+# expensive (see delete_strategy)
+DELETE_MOVE = "MOVE"
+DELETE_LABELS = "LABELS"
+DELETE_COPY = "COPY"
+
+
+class MessageMetadata(object):
+    """The data items (other than headers and bodies) returned for a single
+    message in a FETCH response.
+
+    Instances have the following properties, each of which is None if the
+    server didn't return the matching data item:
+        seq          -- the message's sequence number in the mailbox, as a
+                        string
+        uid          -- the message's UID, as a string
+        gm_id        -- the message's X-GM-MSGID, as a string
+        thrid        -- the X-GM-THRID of the message's thread, as a string
+        labels       -- the raw, unparsed contents of the message's
+                        X-GM-LABELS list (see MessageBase.labels)
+        flags        -- a tuple of the message's flags (ie "\\Seen")
+        internaldate -- the message's INTERNALDATE, as the string the server
+                        sent (see parse_internaldate)
+        size         -- the message's RFC822.SIZE, as an int
+        modseq       -- the message's MODSEQ, as an int
+        bodystructure -- the unparsed, parenthesized value of the message's
+                        BODYSTRUCTURE (see pygmail.structure)
+    """
+
+    __slots__ = ('seq', 'uid', 'gm_id', 'thrid', 'labels', 'flags',
+                 'internaldate', 'size', 'modseq', 'bodystructure')
+
+    def __init__(self, seq=None):
+        self.seq = seq
+        self.uid = None
+        self.gm_id = None
+        self.thrid = None
+        self.labels = None
+        self.flags = None
+        self.internaldate = None
+        self.size = None
+        self.modseq = None
+        self.bodystructure = None
+
+    def __str__(self):
+        return "<MessageMetadata: %s/%s>" % (self.seq, self.uid)
+
+
+class HeaderRecord(MessageMetadata):
+    """A compact version of a pygmail.message.MessageHeaders object, for
+    callers that hold very large numbers of messages in memory at once (such
+    as when indexing a whole account).  Records only keep the message's
+    metadata and its raw, unparsed header block, and don't hold references
+    to the mailbox or connection the message was fetched with.  Label and
+    flag values are interned, so that messages with the same labels share
+    the same strings.
+
+    Instances have the properties of pygmail.message.MessageMetadata, plus:
+        headers_raw -- the message's header block, as returned by the server
+
+    Instances of this class are returned by the mailbox listing methods
+    when called with records=True
+    """
+
+    __slots__ = ('headers_raw',)
+
+    # Shared copies of every combination of flags seen so far, so that
+    # records with the same flags share a single tuple
+    _flag_sets = {}
+
+    def __init__(self, headers_raw=None):
+        super(HeaderRecord, self).__init__()
+        self.headers_raw = headers_raw
+
+    def __str__(self):
+        return "<HeaderRecord: %s/%s>" % (self.seq, self.uid)
+
+    @classmethod
+    def from_response(cls, metadata, headers):
+        """Builds a record out of a message's section of a FETCH response
+
+        Args:
+            metadata -- The text of the message's FETCH response (see
+                        parse_metadata)
+            headers  -- The message's header block
+
+        Returns:
+            A pygmail.message.HeaderRecord object, or None if the metadata
+            couldn't be parsed
+        """
+        record = parse_metadata(metadata, record=cls(headers))
+        if record is None:
+            return None
+        if record.labels is not None:
+            record.labels = intern(record.labels)
+        if record.flags is not None:
+            flags = tuple(intern(flag) for flag in record.flags)
+            record.flags = cls._flag_sets.setdefault(flags, flags)
+        return record
+
+    def to_message(self, mailbox):
+        """Builds the full message headers object this record describes
+
+        Args:
+            mailbox -- The pygmail.mailbox.Mailbox instance the message is in
+
+        Returns:
+            A pygmail.message.MessageHeaders object
+        """
+        return MessageHeaders(mailbox, self, self.headers_raw)
+
+
+def skip_list(data, start):
+    """Finds the end of the parenthesized list starting at the given index,
+    skipping over any nested lists and quoted strings in it.
+
+    >>> skip_list('(("a" ("b)")) NIL) UID 5', 0)
+    18
+
+    Args:
+        data  -- A string containing a FETCH response
+        start -- The index of the list's opening paren
+
+    Returns:
+        The index just past the list's closing paren, or the length of the
+        string if the list isn't closed
+    """
+    depth = 0
+    for match in NESTED_TOKEN_PATTERN.finditer(data, start):
+        token = match.group()
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    return len(data)
+
+
+def parse_internaldate(value):
+    """Converts the string value of an INTERNALDATE data item, such as
+    "17-Jul-1996 02:44:25 -0700", into a local time tuple
+
+    Args:
+        value -- The INTERNALDATE string, or None
+
+    Returns:
+        A time.struct_time, or None if the value couldn't be parsed
+    """
+    if value is None:
+        return None
+    return Internaldate2tuple('INTERNALDATE "%s"' % (value,))
+
+
+def parse_metadata(metadata, record=None):
+    """Parses the data items describing a message out of its FETCH response,
+    in a single pass, and regardless of the order the server returned them
+    in.
+
+    >>> meta = parse_metadata('3 (X-GM-THRID 9 UID 12 FLAGS (\\\\Seen) '
+    ...                       'X-GM-LABELS ("\\\\\\\\Inbox" "a (b)") '
+    ...                       'RFC822.SIZE 2048 BODY[HEADER] {10})')
+    >>> meta.seq, meta.uid, meta.thrid, meta.flags, meta.size
+    ('3', '12', '9', ('\\\\Seen',), 2048)
+    >>> print meta.labels
+    "\\\\Inbox" "a (b)"
+
+    Args:
+        metadata -- The text of a message's FETCH response, with the contents
+                    of any literals removed (see
+                    pygmail.mailbox.FetchedMessage)
+
+    Keyword Args:
+        record -- A MessageMetadata (or subclass) instance to fill in,
+                  instead of creating a new one
+
+    Returns:
+        A pygmail.message.MessageMetadata object, or None if the string
+        doesn't look like a FETCH response
+    """
+    start_match = METADATA_START_PATTERN.match(metadata)
+    if not start_match:
+        return None
+
+    if record is None:
+        record = MessageMetadata(start_match.group(1))
+    else:
+        record.seq = start_match.group(1)
+    match_item = METADATA_ITEM_PATTERN.scanner(metadata, start_match.end()).match
+    while True:
+        match = match_item()
+        if not match:
+            break
+        name, number, quoted, values, nested = match.groups()
+        if nested is not None:
+            index = skip_list(metadata, match.start('nested'))
+            match_item = METADATA_ITEM_PATTERN.scanner(metadata, index).match
+            if name == 'BODYSTRUCTURE':
+                record.bodystructure = metadata[match.start('nested'):index]
+        elif name == 'UID':
+            record.uid = number
+        elif name == 'FLAGS':
+            record.flags = tuple(values.split())
+        elif name == 'X-GM-LABELS':
+            record.labels = values
+        elif name == 'X-GM-MSGID':
+            record.gm_id = number
+        elif name == 'X-GM-THRID':
+            record.thrid = number
+        elif name == 'INTERNALDATE':
+            record.internaldate = quoted
+        elif name == 'RFC822.SIZE':
+            record.size = int(number)
+        elif name == 'MODSEQ':
+            record.modseq = int(values)
+        elif name == 'BODYSTRUCTURE':
+            record.bodystructure = '(%s)' % (values,)
+    return record
+
+
+def parse_appenduid(response):
+    """Finds the UID an appended message was given, from the response to an
+    APPEND command, if the server supports UIDPLUS (as Gmail does)
+
+    Args:
+        response -- The data section of an imaplib2 APPEND response
+
+    Returns:
+        The new UID, as a string, or None if the response didn't include an
+        APPENDUID response code
+    """
+    for line in response:
+        if isinstance(line, basestring):
+            match = APPENDUID_PATTERN.search(line)
+            if match:
+                return match.group(1)
+    return None
+
+
+def delete_strategy(capabilities, permanent=True):
+    """Picks the cheapest way to move messages to the trash, based on the
+    extensions the IMAP server advertises.
+
+    >>> delete_strategy(('IMAP4REV1', 'X-GM-EXT-1', 'MOVE'))
+    'MOVE'
+    >>> delete_strategy(('IMAP4REV1', 'X-GM-EXT-1'), permanent=False)
+    'LABELS'
+    >>> delete_strategy(('IMAP4REV1', 'X-GM-EXT-1'))
+    'COPY'
+
+    Args:
+        capabilities -- The capabilities of an authenticated imaplib2
+                        connection
+
+    Keyword Args:
+        permanent -- Whether the messages will also be expunged from the
+                     trash.  Adding the \\Trash label moves a message to the
+                     trash in one step, but (unlike MOVE and COPY) doesn't
+                     report where the message ended up, so it's only used
+                     when the message is being left in the trash
+
+    Returns:
+        One of DELETE_MOVE (UID MOVE, RFC 6851), DELETE_LABELS (UID STORE
+        +X-GM-LABELS (\\Trash)) or DELETE_COPY (UID COPY)
+    """
+    if 'MOVE' in capabilities:
+        return DELETE_MOVE
+    elif 'X-GM-EXT-1' in capabilities and not permanent:
+        return DELETE_LABELS
+    else:
+        return DELETE_COPY
 
 
 def extract_first_subsection(message, boundary):
@@ -49,8 +348,12 @@ def extract_first_subsection(message, boundary):
         full_boundary = "--" + boundary
         boundary_length = len(full_boundary) + 1
         first_instance = message.index(full_boundary)
-        next_instance = message.index(full_boundary, first_instance + boundary_length)
-        message_section = message[first_instance + boundary_length:next_instance + 1].strip()
+        # If the message was only partially fetched, the first subpart may
+        # run to the end of what was fetched
+        next_instance = message.find(full_boundary, first_instance + boundary_length)
+        if next_instance == -1:
+            next_instance = len(message)
+        message_section = message[first_instance + boundary_length:next_instance].strip()
         header_matches = SECTION_HEADERS_ENDING.search(message_section)
         if not header_matches:
             return message
@@ -60,6 +363,47 @@ def extract_first_subsection(message, boundary):
         return message
 
 
+def decode_partial(body, encoding, truncated=False):
+    """Undoes the content transfer encoding of a message part, where the
+    part may have been cut off at an arbitrary byte by a partial fetch
+    (ie BODY.PEEK[1]<0.2048>).  Base64 text is trimmed to a whole number of
+    4 character groups, and a cut off quoted-printable escape is dropped.
+
+    >>> decode_partial('aGVsbG8g\\r\\nd29ybG', 'base64', truncated=True)
+    'hello wor'
+
+    >>> decode_partial('caf=C3=A9 cr=C3=A', 'quoted-printable', truncated=True)
+    'caf\\xc3\\xa9 cr\\xc3'
+
+    >>> decode_partial('a long li=\\r', 'quoted-printable', truncated=True)
+    'a long li'
+
+    Args:
+        body     -- The (possibly partial) encoded text of the message part
+        encoding -- The part's Content-Transfer-Encoding (ie "base64")
+
+    Keyword Args:
+        truncated -- Whether the body may have been cut off
+
+    Returns:
+        The decoded bytes of the part, as a str
+    """
+    if encoding == "quoted-printable":
+        if truncated:
+            body = TRUNCATED_QP_PATTERN.sub('', body)
+        return decodestring(body)
+    elif encoding == "base64":
+        if truncated:
+            body = ''.join(body.split())
+            body = body[:len(body) - len(body) % 4]
+        try:
+            return b64decode(body)
+        except TypeError:
+            return ""
+    else:
+        return body
+
+
 def message_part_charset(part, message):
     """Get the charset of the a part of the message"""
     message_part_charset = part.get_content_charset() or part.get_charset()
@@ -165,38 +509,34 @@ def utf8_encode_message_part(message_part, message, default="ascii"):
 class MessageBase(object):
     """A root class, containing some shared functionality between the full
     and message teaser instances"""
-    def __init__(self, mailbox, metadata, headers, metadata_pattern):
+    def __init__(self, mailbox, metadata, headers):
         self.mailbox = mailbox
         self.account = mailbox.account
-        self.conn = self.account.connection
-        metadata_rs = metadata_pattern.match(metadata)
-
-        if not metadata_rs:
-            _log.error("Bad formatted metadata string")
-            _log.error(metadata)
+        self.conn = mailbox.conn
 
-        self.id, self.gmail_id, labels, self.uid, internal_date = metadata_rs.groups()
-        self.internal_date = Internaldate2tuple(metadata)
-
-        self.flags = ParseFlags(metadata) or []
-        self.labels_raw = labels
-
-        ### First parse out the metadata about the email message
-        self.headers = HEADER_PARSER.parsestr(headers)
-
-        for attr, single_header in (('date', 'Date'), ('subject', 'Subject')):
-            header_value = self.get_header(single_header)
-            setattr(self, attr, header_value[0] if header_value else '')
-
-        self.sender = self.get_header("From")
-        self.to = self.get_header('To')
-        self.cc = self.get_header("Cc")
-
-        message_ids = self.get_header('Message-Id')
-        if len(message_ids) == 0:
-            self.message_id = None
+        if isinstance(metadata, MessageMetadata):
+            record = metadata
         else:
-            self.message_id = message_ids[0]
+            record = parse_metadata(metadata)
+        if record is None:
+            _log("Bad formatted metadata string: %s" % (metadata,))
+            record = MessageMetadata()
+
+        self.id = record.seq
+        self.uid = record.uid
+        self.gmail_id = record.gm_id
+        self.thread_id = record.thrid
+        self.internal_date_raw = record.internaldate
+        self.size = record.size
+        self.flags = record.flags or []
+        self.labels_raw = record.labels
+        self.bodystructure_raw = record.bodystructure
+
+        # The header block is only parsed, and individual headers only
+        # decoded, the first time they're needed, since callers listing
+        # many messages often only look at a few headers (or none at all)
+        self.headers_raw = headers
+        self._decoded_headers = {}
 
     def __eq__(self, other):
         """ Overrides equality operator to check by uid and mailbox name """
@@ -207,6 +547,59 @@ class MessageBase(object):
     def __str__(self):
         return "<Message %s: Message-ID: '%s'>" % (self.uid, self.message_id)
 
+    @property
+    def headers(self):
+        """Lazy parse the message's raw header block into an
+        email.message.Message object (which only contains headers)"""
+        try:
+            return self._headers
+        except AttributeError:
+            self._headers = HEADER_PARSER.parsestr(self.headers_raw)
+            self.headers_raw = None
+            return self._headers
+
+    def _decoded_header(self, key):
+        """Returns the decoded values of the given header (see get_header),
+        only decoding the header the first time it's requested"""
+        try:
+            return self._decoded_headers[key]
+        except KeyError:
+            self._decoded_headers[key] = self.get_header(key)
+            return self._decoded_headers[key]
+
+    @property
+    def date(self):
+        """The value of the message's Date header, or an empty string"""
+        values = self._decoded_header('Date')
+        return values[0] if values else ''
+
+    @property
+    def subject(self):
+        """The value of the message's Subject header, or an empty string"""
+        values = self._decoded_header('Subject')
+        return values[0] if values else ''
+
+    @property
+    def sender(self):
+        """The decoded value(s) of the message's From header"""
+        return self._decoded_header('From')
+
+    @property
+    def to(self):
+        """The decoded value(s) of the message's To header"""
+        return self._decoded_header('To')
+
+    @property
+    def cc(self):
+        """The decoded value(s) of the message's Cc header"""
+        return self._decoded_header('Cc')
+
+    @property
+    def message_id(self):
+        """The value of the message's Message-Id header, or None"""
+        values = self._decoded_header('Message-Id')
+        return values[0] if values else None
+
     def get_header(self, key):
         """Returns a unicode version of the requested header value, properly
         decoded
@@ -233,6 +626,40 @@ class MessageBase(object):
         except Exception:
             return ()
 
+    @property
+    def internal_date(self):
+        """Lazy parse the INTERNALDATE the server recorded for the message
+        (when it was received) into a local time tuple, or None if it
+        wasn't fetched"""
+        try:
+            return self._internal_date
+        except AttributeError:
+            self._internal_date = parse_internaldate(self.internal_date_raw)
+            return self._internal_date
+
+    @property
+    def structure(self):
+        """Lazy parse the message's BODYSTRUCTURE into a tree of
+        pygmail.structure.BodyPart objects, which is only done once no matter
+        how many times the structure is read (by the teaser body, attachment
+        listing, part fetching, etc.)
+
+        Returns:
+            The pygmail.structure.BodyPart at the root of the message, or
+            None if the BODYSTRUCTURE wasn't fetched or couldn't be parsed
+        """
+        try:
+            return self._structure
+        except AttributeError:
+            self._structure = None
+            if self.bodystructure_raw is not None:
+                try:
+                    self._structure = parse_bodystructure(self.bodystructure_raw)
+                except ParseError:
+                    _log("Bad formatted body structure: %s" % (self.bodystructure_raw,))
+            self.bodystructure_raw = None
+            return self._structure
+
     @property
     def from_address(self):
         if not hasattr(self, '_from_address'):
@@ -248,21 +675,18 @@ class MessageBase(object):
     @property
     def labels(self):
         """Lazy parse the stored raw string of gmail labels, which is in
-        gmail's combination of ASTRING, STRING and ATOM formats.  Occasionally
-        the parser we're using here falls into an infinite loop, so this can
-        throw a 'RuntimeError' exception.
+        gmail's combination of ASTRING, STRING and ATOM formats.
 
         Returns:
             A list of X-GM-LABELS if we can parse them correctly, and otherwise
-            None
-
-        Raises:
-            RuntimeError if there is an error parsing the labels (ie if the
-            library we're using falls into an infinite loop)
+            None (including when the labels weren't fetched)
         """
         try:
             return self._labels
         except AttributeError:
+            if self.labels_raw is None:
+                self._labels = None
+                return self._labels
             try:
                 self._labels = list(parse(self.labels_raw))
             except ParseError:
@@ -305,121 +729,34 @@ class MessageBase(object):
             self._sent_datetime = datetime.fromtimestamp(time.mktime(date_parts)) if date_parts else None
         return self._sent_datetime
 
-    def delete(self, trash_folder, callback=None):
-        """Deletes the message from the IMAP server
+    def delete(self, trash_folder, callback=None, permanent=True):
+        """Deletes the message from the IMAP server.  The message is moved
+        to the trash in the cheapest way the server supports (see
+        delete_strategy), and then, unless permanent is False, expunged from
+        the trash.  See pygmail.mailbox.Mailbox.delete_messages for details.
 
         Args:
             trash_folder -- the name of the folder / label that is, in the
                             current account, the trash container
 
+        Keyword Args:
+            permanent -- If False, the message is only moved to the trash,
+                         which usually takes a single round trip to the
+                         server (default True)
+
         Returns:
-            True on success, and in all other instances an error object
+            True on success, False if the message couldn't be found in the
+            trash to be expunged, and in all other instances an error object
         """
         @pygmail.errors.check_imap_response(callback)
-        def _on_original_mailbox_reselected(imap_response):
-            return _cmd(callback, True)
-
-        @pygmail.errors.check_imap_state(callback)
-        def _on_recevieved_connection_6(connection):
-            return _cmd_cb(connection.select, _on_original_mailbox_reselected,
-                           bool(callback), self.mailbox.name)
+        def _on_delete(num_deleted):
+            if not num_deleted and __debug__:
+                _log(u"Giving up trying to delete message {subject} - {id}".format(subject=self.subject, id=self.message_id))
+            return _cmd(callback, num_deleted > 0)
 
-        @pygmail.errors.check_imap_response(callback)
-        def _on_expunge_complete(imap_response):
-            return _cmd_cb(self.conn, _on_recevieved_connection_6, bool(callback))
-
-        @pygmail.errors.check_imap_state(callback)
-        def _on_recevieved_connection_5(connection):
-            return _cmd_cb(connection.expunge, _on_expunge_complete, bool(callback))
-
-        @pygmail.errors.check_imap_response(callback)
-        def _on_delete_complete(imap_response):
-            return _cmd_cb(self.conn, _on_recevieved_connection_5, bool(callback))
-
-        @pygmail.errors.check_imap_state(callback)
-        def _on_received_connection_4(connection, deleted_uid):
-            del self.num_tries
-            return _cmd_cb(connection.uid, _on_delete_complete,
-                           bool(callback), 'STORE', deleted_uid,
-                           '+FLAGS', '\\Deleted')
-
-        @pygmail.errors.check_imap_response(callback)
-        def _on_search_for_message_complete(imap_response):
-            data = extract_data(imap_response)
-
-            # Its possible here that we've tried to select the message
-            # we want to delete from the trash bin before google has
-            # registered it there for us.  If our search attempt returned
-            # a uid, then we're good to go and can continue.
-            try:
-                deleted_uid = data[0].split()[-1]
-                cbp = dict(deleted_uid=deleted_uid)
-                return _cmd_cb(self.conn, _on_received_connection_4,
-                               bool(callback), callback_args=cbp)
-
-            # If not though, we should wait a couple of seconds and try
-            # again.  We'll do this a maximum of 5 times.  If we still
-            # haven't had any luck at this point, we give up and return
-            # False, indiciating we weren't able to delete the message
-            # fully.
-            except IndexError:
-                self.num_tries += 1
-
-                # If this is the 5th time we're trying to delete this
-                # message, we're going to call it a loss and stop trying.
-                # We do some minimal clean up and then just bail out
-                # Otherwise, schedule another attempt in 2 seconds and
-                # hope that gmail has updated its indexes by then
-                if self.num_tries == 5:
-                    del self.num_tries
-                    if __debug__:
-                        _log.error(u"Giving up trying to delete message {subject} - {id}".format(subject=self.subject, id=self.message_id))
-                        _log.error("got response: {response}".format(response=str(imap_response)))
-                    return _cmd(callback, False)
-                else:
-                    if __debug__:
-                        _log.error("Try {num} to delete deleting message {subject} - {id} failed.  Waiting".format(num=self.num_tries, subject=self.subject, id=self.message_id))
-                        _log.error("got response: {response}".format(response=str(imap_response)))
-                    return _cmd_in(_on_trash_selected, 2, bool(callback), force_success=True)
-
-        @pygmail.errors.check_imap_state(callback)
-        def _on_received_connection_3(connection):
-            return _cmd_cb(connection.uid, _on_search_for_message_complete,
-                           bool(callback), 'search', None, 'X-GM-RAW',
-                            '"rfc822msgid:{msg_id}"'.format(msg_id=self.message_id))
-
-        def _on_trash_selected(imap_response, force_success=False):
-            # It can take several attempts for the deleted message to show up
-            # in the trash label / folder.  We'll try 5 times, waiting
-            # two sec between each attempt
-            if force_success:
-                return _cmd_cb(self.conn, _on_received_connection_3, bool(callback))
-            else:
-                is_error = check_for_response_error(imap_response)
-                if is_error:
-                    return _cmd(callback, is_error)
-                else:
-                    return _cmd_cb(self.conn, _on_received_connection_3, bool(callback))
-
-        @pygmail.errors.check_imap_state(callback)
-        def _on_received_connection_2(connection):
-            self.num_tries = 0
-            return _cmd_cb(connection.select, _on_trash_selected, bool(callback), trash_folder)
-
-        @pygmail.errors.check_imap_response(callback)
-        def _on_message_moved(imap_response):
-            return _cmd_cb(self.conn, _on_received_connection_2, bool(callback))
-
-        @pygmail.errors.check_imap_state(callback)
-        def _on_received_connection(connection):
-            return _cmd_cb(connection.uid, _on_message_moved, bool(callback),
-                           'COPY', self.uid, trash_folder)
-
-        @pygmail.errors.check_imap_response(callback)
-        def _on_mailbox_select(is_selected):
-            return _cmd_cb(self.conn, _on_received_connection, bool(callback))
-
-        return _cmd_cb(self.mailbox.select, _on_mailbox_select, bool(callback))
+        return _cmd_cb(self.mailbox.delete_messages, _on_delete,
+                       bool(callback), [self.uid], trash_folder=trash_folder,
+                       permanent=permanent)
 
 
 class MessageHeaders(MessageBase):
@@ -428,16 +765,20 @@ class MessageHeaders(MessageBase):
     return by default"""
 
     def __init__(self, mailbox, metadata, headers):
-        super(MessageHeaders, self).__init__(mailbox, metadata, headers, METADATA_PATTERN)
+        super(MessageHeaders, self).__init__(mailbox, metadata, headers)
 
-    def teaser(self, callback=None):
+    def teaser(self, callback=None, length=None):
         """Fetches an abbreviated, teaser version of the message, containing
         just the text of the first text or html part of the message body
+
+        Keyword Args:
+            length -- If given, only about this many bytes of the part are
+                      fetched (see pygmail.mailbox.imap_query)
         """
         def _on_teaser_fetched(teaser):
             return _cmd(callback, teaser)
 
-        return _cmd_cb(self.mailbox.fetch, _on_teaser_fetched, bool(callback), self.uid, teaser=True)
+        return _cmd_cb(self.mailbox.fetch, _on_teaser_fetched, bool(callback), self.uid, teaser=length or True)
 
     def full_message(self, callback=None):
         """Fetches the full version of the message that this message is a teaser
@@ -460,7 +801,7 @@ class MessageTeaser(MessageBase):
     Instances of this class aren't intended to be constructed directly, but
     instead managed by the pygmail.mailbox.Message instances
     """
-    def __init__(self, mailbox, metadata, headers, body):
+    def __init__(self, mailbox, metadata, headers, body, truncated=False):
         """
 
         Args:
@@ -472,49 +813,44 @@ class MessageTeaser(MessageBase):
             headers  -- The email headers of the message, including information
                         such as encoding type, the to and from addresses, etc.
             body     -- The body of the first section of the email message
+
+        Keyword Args:
+            truncated -- Whether the body was cut off by a partial fetch
+                         (see pygmail.mailbox.imap_query)
         """
-        super(MessageTeaser, self).__init__(mailbox, metadata, headers, METADATA_TEASER_PATTERN)
+        super(MessageTeaser, self).__init__(mailbox, metadata, headers)
+
+        self.truncated = truncated
 
         self.charset = 'utf-8'
         self.encoding = '8bit'
-        body_structure = None
-        first_structure = None
         boundary = None
 
-        body_structure_match = BODY_STRUCTRUE.search(metadata)
-        if body_structure_match:
-            body_structure = body_structure_match.group(1)
-
-            boundary_matches = BOUNDARY_EXTRACTOR.search(body_structure)
-            if boundary_matches:
-                boundary = boundary_matches.group(1)
-            first_structure = extract_first_bodystructure(body_structure.lower())
-
-            if first_structure:
-                charset_match = CHARSET_EXTRACTOR.search(first_structure)
-                if charset_match:
-                    self.charset = charset_match.group(1)
-
-                encoding_match = ENCODING_EXTRACTOR.search(first_structure)
-                if not encoding_match:
-                    encoding_match = ENCODING_EXTRACTOR.search(body_structure.lower())
-                self.encoding = encoding_match.group(0) if encoding_match else "8bit"
+        # The body is BODY[1]: the first part of a multipart message (which
+        # may itself be multipart, in which case only its first subpart is
+        # kept), or the entire body of a single part message
+        root = self.structure
+        if root is not None:
+            first_part = root.parts[0] if root.is_multipart and root.parts else root
+            if first_part.is_multipart:
+                boundary = first_part.boundary
+            leaf = first_part.first_leaf()
+            self.charset = leaf.charset or self.charset
+            self.encoding = leaf.encoding or self.encoding
 
         if boundary:
             body = extract_first_subsection(body, boundary)
 
-        if self.encoding == "quoted-printable":
-            body_decoded = decodestring(body)
-        elif self.encoding == "base64":
-            try:
-                body_decoded = b64decode(body)
-            except TypeError:
-                body_decoded = ""
-        else:
-            body_decoded = body
+        body_decoded = decode_partial(body, self.encoding, truncated)
 
         try:
-            self.body = unicode(body_decoded, self.charset, errors='replace')
+            if truncated:
+                # An incremental decoder holds back (and so drops) a
+                # multibyte character that was cut off at the end
+                decoder = codecs.getincrementaldecoder(self.charset)(errors='replace')
+                self.body = decoder.decode(body_decoded)
+            else:
+                self.body = unicode(body_decoded, self.charset, errors='replace')
         except LookupError as error:
             self.body = error
         except UnicodeDecodeError as error:
@@ -530,6 +866,117 @@ class MessageTeaser(MessageBase):
         return _cmd_cb(self.mailbox.fetch, _on_full_msg_fetched, bool(callback), self.uid, full=True)
 
 
+class MessageStructure(MessageBase):
+    """A message fetched with a description of its MIME structure
+    (BODYSTRUCTURE) instead of its body.  The text of the message, and any
+    of its attachments, are then fetched part by part, as needed, so that
+    reading the text of a message doesn't require downloading its
+    attachments.
+
+    Instances of this class aren't intended to be constructed directly, but
+    are returned by pygmail.mailbox.Mailbox methods when called with
+    structure=True
+    """
+
+    def __init__(self, mailbox, metadata, headers):
+        super(MessageStructure, self).__init__(mailbox, metadata, headers)
+        self._text_bodies = {}
+
+    def fetch_parts(self, parts, callback=None):
+        """Fetches the decoded contents of the given parts of the message.
+        See pygmail.mailbox.Mailbox.fetch_parts
+
+        Args:
+            parts -- A list of pygmail.structure.BodyPart objects from this
+                     message's structure
+
+        Returns:
+            A dict mapping the section of each part to its decoded contents
+            (as a byte string) on success, and an error object otherwise
+        """
+        return self.mailbox.fetch_parts(self.uid, parts, callback=callback)
+
+    def _text_body(self, subtype, callback=None):
+        """Fetches and decodes the non-attachment text parts of the message
+        in the given subtype, joining them together if there are several"""
+        if subtype in self._text_bodies:
+            return _cmd(callback, self._text_bodies[subtype])
+
+        parts = self.structure.text_parts(subtype) if self.structure else []
+        if not parts:
+            return _cmd(callback, None)
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_parts(bodies):
+            text = u''
+            for part in parts:
+                charset = part.charset or 'ascii'
+                try:
+                    text += unicode(bodies.get(part.section, ''), charset,
+                                    errors='replace')
+                except LookupError:
+                    text += unicode(bodies.get(part.section, ''), 'ascii',
+                                    errors='replace')
+            self._text_bodies[subtype] = text
+            return _cmd(callback, text)
+
+        return _cmd_cb(self.fetch_parts, _on_parts, bool(callback), parts)
+
+    def html_body(self, callback=None):
+        """Fetches the HTML version of the message body, if available,
+        without downloading any other part of the message
+
+        Returns:
+            The HTML version of the email body, or None if the message has no
+            HTML body, on success, and an error object otherwise
+        """
+        return self._text_body('html', callback=callback)
+
+    def plain_body(self, callback=None):
+        """Fetches the plain text version of the message body, if available,
+        without downloading any other part of the message
+
+        Returns:
+            The plain text version of the email body, or None if the message
+            has no plain text body, on success, and an error object otherwise
+        """
+        return self._text_body('plain', callback=callback)
+
+    def attachments(self, callback=None):
+        """Returns the parts of the message that are attachments.  Nothing
+        is downloaded; the contents of an attachment can be fetched with
+        attachment_body.
+
+        Returns:
+            A list of zero or more pygmail.structure.BodyPart objects
+        """
+        return _cmd(callback, self.structure.attachments() if self.structure else [])
+
+    def attachment_body(self, attachment, callback=None):
+        """Fetches the decoded contents of a single attachment
+
+        Args:
+            attachment -- A pygmail.structure.BodyPart object, as returned by
+                          attachments()
+
+        Returns:
+            The contents of the attachment, as a byte string, on success,
+            and an error object otherwise
+        """
+        @pygmail.errors.check_imap_response(callback)
+        def _on_parts(bodies):
+            return _cmd(callback, bodies.get(attachment.section))
+
+        return _cmd_cb(self.fetch_parts, _on_parts, bool(callback), [attachment])
+
+    def full_message(self, callback=None):
+        """Fetches the full version of the message"""
+        def _on_full_msg_fetched(full_msg):
+            return _cmd(callback, full_msg)
+
+        return _cmd_cb(self.mailbox.fetch, _on_full_msg_fetched, bool(callback), self.uid, full=True)
+
+
 class Message(MessageBase):
     """Message objects represent individual emails in a Gmail inbox.
 
@@ -560,7 +1007,7 @@ class Message(MessageBase):
                         represents the mailbox this message exists in
 
         """
-        super(Message, self).__init__(mailbox, metadata, headers, METADATA_PATTERN)
+        super(Message, self).__init__(mailbox, metadata, headers)
 
         self.has_built_body_strings = None
         self.encoding = None
@@ -583,6 +1030,7 @@ class Message(MessageBase):
         """
         unicode_value = unicode(value, current_encoding, errors='replace')
         self.headers[key] = eh.Header(unicode_value, 'utf-8')
+        self._decoded_headers.clear()
 
     def _build_body_strings(self):
         if not self.has_built_body_strings:
@@ -674,6 +1122,7 @@ class Message(MessageBase):
         """
         return self.raw.as_string()
 
+    @checked_out
     def save(self, trash_folder, safe_label=None, header_label="PyGmail", callback=None):
         """Copies changes to the current message to the server
 
@@ -723,22 +1172,14 @@ class Message(MessageBase):
                            "STORE", self.uid, "+X-GM-LABELS", labels_value)
 
         @pygmail.errors.check_imap_response(callback)
-        def _on_append(imap_response):
-            data = extract_data(imap_response)
-            self.uid = data[0].split()[2][:-1]
+        def _on_append(uid):
+            self.uid = uid
             return _cmd_cb(self.conn, _on_post_append_connection, bool(callback))
 
-        @pygmail.errors.check_imap_state(callback)
-        def _on_received_connection(connection):
-            flags_string = '(%s)' % (' '.join(self.flags),) if self.flags else "()"
-            return _cmd_cb(connection.append, _on_append, bool(callback),
-                           self.mailbox.name, flags_string,
-                           self.internal_date or time.gmtime(),
-                           self.raw.as_string())
-
         @pygmail.errors.check_imap_response(callback)
         def _on_select(is_selected):
-            return _cmd_cb(self.conn, _on_received_connection, bool(callback))
+            return _cmd_cb(self.mailbox._append_message, _on_append,
+                           bool(callback), self)
 
         @pygmail.errors.check_imap_response(callback)
         def _on_delete(was_deleted):
@@ -794,7 +1235,7 @@ class Message(MessageBase):
             attach_msg.set_payload("")
         return True
 
-    def replace(self, find, replace, trash_folder, callback=None):
+    def replace(self, find, replace, trash_folder, callback=None, save=True):
         """Performs a body-wide string search and replace
 
         Note that this search-and-replace is pretty dumb, and will fail
@@ -811,6 +1252,12 @@ class Message(MessageBase):
             trash_folder -- the name of the folder / label that is, in the
                             current account, the trash container
 
+        Keyword Args:
+            save -- If False, the message is only changed locally, and not
+                    saved back to the server.  This is useful for changing
+                    many messages and then saving them all at once with
+                    pygmail.mailbox.Mailbox.save_messages (default True)
+
         Returns:
             True on success, and in all other instances an error object
         """
@@ -877,11 +1324,15 @@ class Message(MessageBase):
                 del part._normalized
                 del part._orig_charset
 
+        if not save:
+            return _cmd(callback, True)
+
         def _on_save(was_success):
             return _cmd(callback, was_success)
 
         return _cmd_cb(self.save, _on_save, bool(callback), trash_folder)
 
+    @checked_out
     def save_copy(self, safe_label, header_label="PyGmail", callback=None):
         """Saves a semi-identical copy of the message in another label / mailbox
         in the gmail account. The saved message is intented
@@ -922,8 +1373,9 @@ class Message(MessageBase):
 
         @pygmail.errors.check_imap_response(callback)
         def _on_safe_save_append(imap_response, message_copy):
-            data = extract_data(imap_response)
-            msg_uid = data[0].split()[2][:-1]
+            msg_uid = parse_appenduid(extract_data(imap_response))
+            if msg_uid is None:
+                return _cmd(callback, False)
             cbp = dict(message_uid=msg_uid, message_id=message_copy['Message-Id'])
             return _cmd_cb(self.conn, _post_safe_save_connection, bool(callback),
                            callback_args=cbp)
@@ -0,0 +1,278 @@
+"""Bookkeeping for accounts that keep more than one authenticated IMAP
+connection open with Gmail at a time.  Each selected mailbox is pinned to
+its own connection, so that callers moving back and forth between a few
+mailboxes don't need to re-SELECT on every request."""
+
+import functools
+import itertools
+import threading
+
+
+class PoolBusyError(RuntimeError):
+    """Raised when a connection is needed for a mailbox that isn't pinned to
+    one, and every connection in the pool is in use by another mailbox"""
+
+
+class PooledConnection(object):
+    """A single IMAP connection managed by a ConnectionPool, along with the
+    state pygmail needs to track about it.
+
+    Instances of this class are not intended to be created directly, but
+    managed by pygmail.pool.ConnectionPool instances
+    """
+
+    def __init__(self, conn=None):
+        """
+        Keyword Args:
+            conn -- An imaplib2 connection object, or None if the connection
+                    hasn't been opened yet
+        """
+        self.conn = conn
+
+        # Whether the connection has been authenticated with the gmail
+        # server yet
+        self.connected = False
+
+        # The pygmail.mailbox.Mailbox object currently selected on this
+        # connection, if any
+        self.selected = None
+
+        # Callbacks waiting on the connection to finish opening and
+        # authenticating, or None if no (async) connection attempt
+        # is in progress
+        self.waiters = None
+
+        # The name of the mailbox currently pinned to this connection, if any
+        self.pinned = None
+
+        # A counter value recording how recently this connection was
+        # handed out, used for picking which connection to recycle when all
+        # connections in the pool are pinned
+        self.last_used = 0
+
+        # The number of operations that have checked out this connection
+        # and not yet released it.  Connections in use are never recycled
+        # for another mailbox, since selecting the other mailbox would pull
+        # the selected mailbox out from under the running commands
+        self.busy = 0
+
+    def __str__(self):
+        return "<PooledConnection: %s>" % (self.pinned,)
+
+
+class ConnectionPool(object):
+    """A fixed size collection of IMAP connections to a single gmail account.
+
+    Connections are handed out by mailbox name, with checkout, and returned
+    with release once the operation using them has finished.  The first
+    request for a mailbox pins it to an unused connection (opening new
+    connection slots as needed, up to the size of the pool).  Once every
+    slot is pinned, the least recently used idle connection is recycled for
+    the new mailbox, and if every connection is in use, the request waits
+    until one is released.  Requests that don't concern a specific mailbox
+    (ie LIST, CREATE) are served by the first connection in the pool.
+
+    The pool's bookkeeping is guarded by a lock, since with the threads
+    event loop backend, checkouts and releases happen on many threads at
+    once.  Checkout callbacks are always called outside of the lock.
+    """
+
+    def __init__(self, size=1):
+        """
+        Keyword Args:
+            size -- The maximum number of IMAP connections to keep open
+                    with the gmail server
+        """
+        if size < 1:
+            raise ValueError("Connection pools must have at least one connection")
+        self.size = size
+        self.slots = []
+        self.pins = {}
+        self._clock = itertools.count(1)
+
+        # (mailbox name, callback) pairs for checkouts waiting for a
+        # connection to be released, in the order they were requested
+        self.waiters = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def checkout(self, mailbox_name, callback=None):
+        """Hands out the pooled connection for the given mailbox, pinning the
+        mailbox to a connection if needed, and marks the connection as in
+        use until it's given back with release.
+
+        If the mailbox isn't pinned yet and every connection is pinned to
+        another mailbox and in use, the request is queued (in async mode)
+        and the callback is called once a connection has been released.  In
+        blocking mode there's nothing to wait on, since the operations
+        holding the connections are further up the caller's own stack, so
+        a PoolBusyError is raised instead.
+
+        Args:
+            mailbox_name -- The name of the mailbox the connection will be used
+                            with
+
+        Returns:
+            A pygmail.pool.PooledConnection instance, which may not be opened
+            or authenticated yet
+        """
+        with self._lock:
+            slot = self._claim_slot(mailbox_name)
+            if slot is None:
+                if callback:
+                    self.waiters.append((mailbox_name, callback))
+                    return None
+                raise PoolBusyError(mailbox_name)
+            self._hand_out(slot)
+        return callback(slot) if callback else slot
+
+    def release(self, slot):
+        """Returns a connection handed out by checkout to the pool.  Once
+        the connection is no longer in use, it's handed to the oldest waiting
+        checkout, if any.
+
+        Args:
+            slot -- A pygmail.pool.PooledConnection instance, as returned
+                    by checkout
+        """
+        served = []
+        with self._lock:
+            slot.busy = max(slot.busy - 1, 0)
+            while self.waiters:
+                mailbox_name, callback = self.waiters[0]
+                waiting_slot = self._claim_slot(mailbox_name)
+                if waiting_slot is None:
+                    break
+                self.waiters.pop(0)
+                self._hand_out(waiting_slot)
+                served.append((callback, waiting_slot))
+        for callback, waiting_slot in served:
+            callback(waiting_slot)
+
+    def slot(self, mailbox_name=None):
+        """Returns the pooled connection that should be used for operations
+        against the given mailbox, pinning the mailbox to a connection if
+        needed.  Unlike checkout, the connection isn't marked as in use, so
+        this should only be used for bookkeeping, or by operations that
+        already hold a checkout for the mailbox.  As with checkout, a
+        connection that's in use is never repinned to another mailbox; if
+        every connection is in use, PoolBusyError is raised.
+
+        Keyword Args:
+            mailbox_name -- The name of the mailbox the connection will be used
+                            with, or None if the operation isn't mailbox
+                            specific
+
+        Returns:
+            A pygmail.pool.PooledConnection instance.  Note that the
+            connection held by the slot may not be opened or authenticated yet
+        """
+        with self._lock:
+            if mailbox_name is None:
+                slot = self.slots[0] if self.slots else self._add_slot()
+            else:
+                slot = self._claim_slot(mailbox_name)
+                if slot is None:
+                    raise PoolBusyError(mailbox_name)
+            slot.last_used = next(self._clock)
+            return slot
+
+    def unpin(self, mailbox_name):
+        """Unpins the given mailbox from its connection, so that the connection
+        will be the first to be handed out to the next newly requested mailbox.
+
+        Args:
+            mailbox_name -- The name of a mailbox in the account
+
+        Returns:
+            True if the mailbox was pinned to a connection, and otherwise False
+        """
+        with self._lock:
+            try:
+                slot = self.pins.pop(mailbox_name)
+            except KeyError:
+                return False
+            slot.pinned = None
+            return True
+
+    def open_slots(self):
+        """Returns a list of every slot in the pool that holds an opened
+        IMAP connection"""
+        return [slot for slot in self.slots if slot.conn is not None]
+
+    def _claim_slot(self, mailbox_name):
+        """Returns the slot the given mailbox is pinned to, pinning it to an
+        idle slot if needed, or None if the mailbox isn't pinned and every
+        slot is in use"""
+        if mailbox_name in self.pins:
+            return self.pins[mailbox_name]
+        slot = self._idle_slot()
+        if slot is not None:
+            self._pin(slot, mailbox_name)
+        return slot
+
+    def _hand_out(self, slot):
+        slot.last_used = next(self._clock)
+        slot.busy += 1
+
+    def _pin(self, slot, mailbox_name):
+        if slot.pinned is not None:
+            del self.pins[slot.pinned]
+        slot.pinned = mailbox_name
+        self.pins[mailbox_name] = slot
+
+    def _add_slot(self):
+        slot = PooledConnection()
+        self.slots.append(slot)
+        return slot
+
+    def _idle_slot(self):
+        """Returns an unpinned slot, a new slot (if the pool isn't full yet),
+        or else the least recently used slot that isn't in use, or None if
+        every slot is in use"""
+        for slot in self.slots:
+            if slot.pinned is None and not slot.busy:
+                return slot
+        if len(self.slots) < self.size:
+            return self._add_slot()
+        idle = [slot for slot in self.slots if not slot.busy]
+        return min(idle, key=lambda slot: slot.last_used) if idle else None
+
+
+def checked_out(method):
+    """Decorator for pygmail.mailbox.Mailbox and pygmail.message.Message
+    methods that issue IMAP commands.  The mailbox's connection (for
+    messages, the connection of the mailbox the message lives in) is checked
+    out of the account's pool for as long as the call is running (in async
+    mode, until its callback is called), so that the connection isn't
+    recycled for another mailbox while commands are still in flight on it.
+    The callback must be passed as a keyword argument.
+    """
+    @functools.wraps(method)
+    def inner(self, *args, **kwargs):
+        pool = self.account.pool
+        name = getattr(self, 'mailbox', self).name
+        callback = kwargs.get('callback')
+        if not callback:
+            slot = pool.checkout(name)
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                pool.release(slot)
+
+        def _on_checkout(slot):
+            def _on_complete(result):
+                pool.release(slot)
+                return callback(result)
+
+            kwargs['callback'] = _on_complete
+            try:
+                return method(self, *args, **kwargs)
+            except Exception:
+                pool.release(slot)
+                raise
+
+        return pool.checkout(name, callback=_on_checkout)
+    return inner
@@ -0,0 +1,307 @@
+"""Classes for describing the MIME structure of a message, as reported by
+the server in response to a FETCH for the BODYSTRUCTURE data item.  Knowing
+the structure of a message lets individual parts (ie just the text/html
+part, or a single attachment) be fetched by section number, instead of
+downloading the entire message.
+
+The parsed structure of a message is cached on each message object fetched
+with its BODYSTRUCTURE (see pygmail.message.MessageBase.structure), which
+is the case for pygmail.message.MessageTeaser and
+pygmail.message.MessageStructure objects"""
+
+from pygmail.utilities import parse, Atom, ParseError
+
+
+class BodyPart(object):
+    """A single part of a message's MIME structure.
+
+    Instances have the following properties:
+        section     -- the part's IMAP section number (ie "1", "2.1"), which
+                       can be used to fetch the part with BODY[<section>].
+                       Multipart parts that are the root of the message
+                       have an empty section
+        type        -- the lower case MIME type of the part (ie "text")
+        subtype     -- the lower case MIME subtype of the part (ie "html")
+        params      -- a dict of the part's Content-Type parameters, with
+                       lower case names (ie {"charset": "utf-8"})
+        encoding    -- the lower case Content-Transfer-Encoding of the part
+                       (ie "base64"), or None for multipart parts
+        size        -- the size of the encoded part, in bytes, or None for
+                       multipart parts
+        disposition -- the lower case Content-Disposition of the part (ie
+                       "attachment"), or None if it doesn't have one
+        disposition_params -- a dict of the part's Content-Disposition
+                       parameters, with lower case names
+        content_id  -- the part's Content-ID, if given
+        description -- the part's Content-Description, if given
+        lines       -- the number of lines in the encoded part, for text and
+                       message/rfc822 parts, and otherwise None
+        md5         -- the part's Content-MD5, if given
+        language    -- the part's Content-Language, if given, as a list of
+                       language tags (ie ["en"])
+        location    -- the part's Content-Location, if given
+        parts       -- a list of the part's subparts, if it's a multipart
+                       part, a list holding the body of the enclosed message
+                       for message/rfc822 parts, and otherwise an empty list
+    """
+
+    def __init__(self, section, type, subtype, params=None, encoding=None,
+                 size=None, disposition=None, disposition_params=None,
+                 parts=None, content_id=None, description=None, lines=None,
+                 md5=None, language=None, location=None):
+        self.section = section
+        self.type = type
+        self.subtype = subtype
+        self.params = params or {}
+        self.encoding = encoding
+        self.size = size
+        self.disposition = disposition
+        self.disposition_params = disposition_params or {}
+        self.parts = parts or []
+        self.content_id = content_id
+        self.description = description
+        self.lines = lines
+        self.md5 = md5
+        self.language = language or []
+        self.location = location
+
+    def __str__(self):
+        return "<BodyPart %s: %s>" % (self.section or "-", self.content_type)
+
+    @property
+    def content_type(self):
+        """The part's full MIME type (ie "text/html")"""
+        return "%s/%s" % (self.type, self.subtype)
+
+    @property
+    def is_multipart(self):
+        return self.type == "multipart"
+
+    @property
+    def charset(self):
+        """The charset the part's text is encoded in, if given"""
+        return self.params.get("charset")
+
+    @property
+    def filename(self):
+        """The name of the file the part holds, if given, from either the
+        Content-Disposition or the Content-Type header"""
+        return (self.disposition_params.get("filename") or
+                self.params.get("name"))
+
+    @property
+    def boundary(self):
+        """The string separating the subparts of a multipart part, if given"""
+        return self.params.get("boundary")
+
+    @property
+    def is_attachment(self):
+        """Whether the part is an attachment (as opposed to part of the
+        message's body)"""
+        return (not self.is_multipart and
+                (self.disposition == "attachment" or
+                 (self.type not in ("text", "multipart") and
+                  self.disposition != "inline")))
+
+    def walk(self):
+        """Returns a generator of this part and every part below it, depth
+        first, in section order"""
+        yield self
+        for part in self.parts:
+            for sub_part in part.walk():
+                yield sub_part
+
+    def _walk_body(self):
+        """Like walk(), but doesn't descend into attachments (such as a
+        forwarded message/rfc822 part)"""
+        yield self
+        if not self.is_attachment:
+            for part in self.parts:
+                for sub_part in part._walk_body():
+                    yield sub_part
+
+    def first_leaf(self):
+        """Returns the first part below this one (or this part itself) that
+        isn't multipart, which is the part a reader sees first"""
+        part = self
+        while part.is_multipart and part.parts:
+            part = part.parts[0]
+        return part
+
+    def text_parts(self, subtype):
+        """Returns a list of the parts that make up the body of the message
+        in the given text subtype (ie "plain" or "html"), skipping any that
+        are attachments
+
+        Args:
+            subtype -- A text MIME subtype, such as "html"
+
+        Returns:
+            A list of zero or more pygmail.structure.BodyPart objects
+        """
+        return [part for part in self._walk_body()
+                if part.type == "text" and part.subtype == subtype and
+                not part.is_attachment]
+
+    def attachments(self):
+        """Returns a list of the parts below this part that are attachments.
+        The parts of an attached message aren't listed separately
+
+        Returns:
+            A list of zero or more pygmail.structure.BodyPart objects
+        """
+        return [part for part in self._walk_body() if part.is_attachment]
+
+
+def _string(value):
+    """Returns the string version of a parsed value, or None if it's NIL"""
+    if isinstance(value, Atom):
+        return None if value.value == "NIL" else value.value
+    return value
+
+
+def _lower(value):
+    value = _string(value)
+    return value.lower() if isinstance(value, basestring) else None
+
+
+def _number(value):
+    try:
+        return int(_string(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _params(value):
+    """Converts a parsed parameter list, such as ["charset", "utf-8"], into
+    a dict with lower case names"""
+    if not isinstance(value, list):
+        return {}
+    params = {}
+    for index in xrange(0, len(value) - 1, 2):
+        name = _lower(value[index])
+        if name:
+            params[name] = _string(value[index + 1])
+    return params
+
+
+def _language(value):
+    """Converts the body language extension field, which is either a single
+    string or a list of strings, into a list"""
+    if isinstance(value, list):
+        return [_string(tag) for tag in value if _string(tag)]
+    tag = _string(value)
+    return [tag] if tag else []
+
+
+def _extension_fields(extension, index):
+    """Reads the body language and body location extension fields, which
+    follow the disposition in both single and multipart parts"""
+    language = _language(extension[index]) if index < len(extension) else []
+    location = _string(extension[index + 1]) if index + 1 < len(extension) else None
+    return language, location
+
+
+def _disposition(extension, index):
+    """Reads the disposition out of the extension data of a part, where it's
+    given as a list of the disposition type and its parameters, such as
+    ["attachment", ["filename", "a.pdf"]]"""
+    if index < len(extension):
+        value = extension[index]
+        if isinstance(value, list) and len(value) == 2:
+            return _lower(value[0]), _params(value[1])
+    return None, {}
+
+
+def _build_part(value, section):
+    if value and isinstance(value[0], list):
+        index = 0
+        children = []
+        while index < len(value) and isinstance(value[index], list):
+            child_section = "%s.%d" % (section, index + 1) if section else str(index + 1)
+            children.append(_build_part(value[index], child_section))
+            index += 1
+        subtype = _lower(value[index]) if index < len(value) else None
+        extension = value[index + 1:]
+        params = _params(extension[0]) if extension else {}
+        disposition, disposition_params = _disposition(extension, 1)
+        language, location = _extension_fields(extension, 2)
+        return BodyPart(section, "multipart", subtype or "mixed", params,
+                        disposition=disposition,
+                        disposition_params=disposition_params,
+                        parts=children, language=language, location=location)
+
+    if len(value) < 7:
+        raise ParseError("Incomplete body structure", repr(value), 0)
+    # A body part that isn't itself the child of a multipart part is
+    # always section 1
+    section = section or "1"
+    type, subtype = _lower(value[0]), _lower(value[1])
+    extension = value[7:]
+    lines = None
+    parts = []
+    # text parts include their number of lines, and message/rfc822 parts
+    # include an envelope, a body structure and a number of lines, before
+    # their extension data
+    if type == "text":
+        lines = _number(extension[0]) if extension else None
+        extension = extension[1:]
+    elif type == "message" and subtype == "rfc822":
+        if len(extension) > 1 and isinstance(extension[1], list):
+            # The parts of an enclosed message are numbered below the
+            # message's own section, and a single part body is section 1
+            # of the enclosed message
+            body = extension[1]
+            if body and isinstance(body[0], list):
+                parts.append(_build_part(body, section))
+            else:
+                parts.append(_build_part(body, section + ".1"))
+        lines = _number(extension[2]) if len(extension) > 2 else None
+        extension = extension[3:]
+    disposition, disposition_params = _disposition(extension, 1)
+    language, location = _extension_fields(extension, 2)
+    return BodyPart(section, type, subtype, _params(value[2]),
+                    encoding=_lower(value[5]), size=_number(value[6]),
+                    disposition=disposition,
+                    disposition_params=disposition_params, parts=parts,
+                    content_id=_string(value[3]),
+                    description=_string(value[4]), lines=lines,
+                    md5=_string(extension[0]) if extension else None,
+                    language=language, location=location)
+
+
+def parse_bodystructure(value):
+    """Builds a tree of BodyPart objects out of the value of a BODYSTRUCTURE
+    data item.
+
+    >>> root = parse_bodystructure('(("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL '
+    ...     'NIL "7BIT" 12 1 NIL NIL NIL)("APPLICATION" "PDF" ("NAME" "a.pdf") '
+    ...     'NIL NIL "BASE64" 4096 NIL ("ATTACHMENT" ("FILENAME" "a.pdf")) NIL) '
+    ...     '"MIXED" ("BOUNDARY" "xx") NIL NIL)')
+    >>> [str(part) for part in root.walk()]
+    ['<BodyPart -: multipart/mixed>', '<BodyPart 1: text/plain>', '<BodyPart 2: application/pdf>']
+    >>> [part.filename for part in root.attachments()]
+    ['a.pdf']
+    >>> text = root.first_leaf()
+    >>> text.charset, text.encoding, text.lines, root.boundary
+    ('utf-8', '7bit', 1, 'xx')
+
+    >>> message = parse_bodystructure('("MESSAGE" "RFC822" NIL NIL NIL "7BIT" '
+    ...     '300 NIL ("TEXT" "HTML" NIL NIL NIL "BASE64" 80 2) 9)')
+    >>> [str(part) for part in message.walk()]
+    ['<BodyPart 1: message/rfc822>', '<BodyPart 1.1: text/html>']
+
+    Args:
+        value -- The parenthesized BODYSTRUCTURE value, as a string
+
+    Returns:
+        The pygmail.structure.BodyPart at the root of the message
+
+    Raises:
+        pygmail.utilities.ParseError if the value isn't a well formed
+        body structure
+    """
+    parsed = parse(value)
+    if not parsed or not isinstance(parsed[0], list):
+        raise ParseError("Expected a parenthesized body structure", value, 0)
+    return _build_part(parsed[0], "")
@@ -0,0 +1,136 @@
+"""Classes for incrementally syncing the contents of a mailbox.  A SyncState
+records what a mailbox looked like the last time it was synced (its
+UIDVALIDITY, UIDNEXT and, where the server supports CONDSTORE, its
+HIGHESTMODSEQ, along with the UIDs in the mailbox), so that the next sync
+only needs to ask the server about what has changed since.
+
+Instances of these classes are returned by pygmail.mailbox.Mailbox.sync"""
+
+import re
+from pygmail.message import parse_metadata
+from pygmail.utilities import encode_sequence_set, decode_sequence_set
+
+# Extracts the values out of the response to a STATUS command, such as
+# '"INBOX" (MESSAGES 42 UIDNEXT 100 UIDVALIDITY 1 HIGHESTMODSEQ 555)'
+STATUS_ITEM_PATTERN = re.compile(r'([A-Z]+) (\d+)')
+
+
+def parse_status(response):
+    """Parses the data section of the response to a STATUS command
+
+    Args:
+        response -- The data section of an imaplib2 STATUS response
+
+    Returns:
+        A dict mapping each returned status item (ie "UIDNEXT") to its
+        integer value
+    """
+    line = response[0] or ''
+    items_start = line.rfind('(')
+    return dict((name, int(value)) for name, value
+                in STATUS_ITEM_PATTERN.findall(line[items_start:]))
+
+
+def parse_changes(response):
+    """Parses the data section of the response to a UID FETCH for the
+    items (UID FLAGS X-GM-LABELS) with a CHANGEDSINCE modifier
+
+    Args:
+        response -- The data section of an imaplib2 FETCH response
+
+    Returns:
+        A dict mapping the uid of each changed message (as a string) to a
+        dict with the message's new "flags" (a tuple), raw "labels" string,
+        and "modseq" (an int, or None if not returned)
+    """
+    changes = {}
+    for line in response:
+        if not isinstance(line, basestring):
+            continue
+        record = parse_metadata(line)
+        if record is None or record.uid is None:
+            continue
+        changes[record.uid] = dict(flags=record.flags or (),
+                                   labels=record.labels or '',
+                                   modseq=record.modseq)
+    return changes
+
+
+class SyncState(object):
+    """The state of a mailbox, as of the last time it was synced.  Instances
+    can be persisted between runs with to_dict / from_dict"""
+
+    def __init__(self, uidvalidity=None, uidnext=None, highestmodseq=None,
+                 uids=None):
+        """
+        Keyword Args:
+            uidvalidity   -- The UIDVALIDITY of the mailbox
+            uidnext       -- The UIDNEXT of the mailbox
+            highestmodseq -- The HIGHESTMODSEQ of the mailbox, or None if the
+                             server doesn't support CONDSTORE
+            uids          -- An iterable of the UIDs in the mailbox
+        """
+        self.uidvalidity = uidvalidity
+        self.uidnext = uidnext
+        self.highestmodseq = highestmodseq
+        self.uids = set(int(uid) for uid in uids or ())
+
+    def __str__(self):
+        return "<SyncState: %s/%s, %d messages>" % (
+            self.uidvalidity, self.uidnext, len(self.uids))
+
+    def to_dict(self):
+        """Returns a dict version of the state, containing only basic types,
+        suitable for storing as JSON, pickling, etc.  The UIDs are stored as
+        a compressed IMAP sequence set"""
+        return dict(uidvalidity=self.uidvalidity, uidnext=self.uidnext,
+                    highestmodseq=self.highestmodseq,
+                    uids=encode_sequence_set(self.uids))
+
+    @classmethod
+    def from_dict(cls, values):
+        """Rebuilds a state object from the result of to_dict
+
+        Args:
+            values -- A dict, as returned from SyncState.to_dict
+
+        Returns:
+            A pygmail.sync.SyncState instance
+        """
+        uids = values.get('uids')
+        return cls(uidvalidity=values.get('uidvalidity'),
+                   uidnext=values.get('uidnext'),
+                   highestmodseq=values.get('highestmodseq'),
+                   uids=decode_sequence_set(uids) if uids else ())
+
+
+class SyncResult(object):
+    """Describes what changed in a mailbox between two syncs.
+
+    Instances have the following properties:
+        state    -- the pygmail.sync.SyncState of the mailbox after the sync,
+                    which should be passed to the next sync
+        reset    -- True if the previous state couldn't be used (because
+                    there wasn't one, or the mailbox's UIDVALIDITY changed),
+                    in which case every message is reported as new
+        new      -- a sorted list of the uids of messages added since the
+                    last sync
+        changed  -- a dict of uid to new flags / labels for messages whose
+                    flags or labels changed since the last sync (see
+                    parse_changes), or None if the server doesn't support
+                    CONDSTORE and so changes can't be tracked
+        vanished -- a sorted list of the uids of messages removed from the
+                    mailbox since the last sync
+    """
+
+    def __init__(self, state, reset=False):
+        self.state = state
+        self.reset = reset
+        self.new = []
+        self.changed = {}
+        self.vanished = []
+
+    def __str__(self):
+        return "<SyncResult: %d new, %s changed, %d vanished>" % (
+            len(self.new), "?" if self.changed is None else len(self.changed),
+            len(self.vanished))
@@ -1,24 +1,15 @@
-"""Functions for interacting with the toranado IO loop and parsing responses
-from the imaplib2 library"""
+"""Functions for interacting with the event loop (by default, the toranado IO
+loop) and parsing responses from the imaplib2 library"""
 
+import base64
 import logging
+import random
+import re
+import threading
 import time
+import traceback
 from datetime import timedelta
 
-def extract_first_bodystructure(structure):
-    stack = 0
-    index = 0
-    for i in structure:
-        if i == "(":
-            stack += 1
-        elif i == ")":
-            stack -= 1
-        index += 1
-        if stack == 0:
-            return structure[:index]
-    return None
-
-
 def extract_data(imap_response):
     """Returns the data section the tuple returned from an imaplib2 request.
     This function assumes that the given tuple is in the correct format
@@ -52,9 +43,390 @@ def extract_type(imap_response):
         return imap_response[0]
 
 
+def response_size(data):
+    """Returns the number of bytes in the data section of an imaplib2
+    response, including the contents of any literals
+
+    Args:
+        data -- The data portion of an imaplib2 response, as returned by
+                extract_data
+
+    Returns:
+        The total length of all strings in the response
+    """
+    size = 0
+    for part in data or ():
+        if isinstance(part, tuple):
+            size += sum(len(sub_part) for sub_part in part if sub_part)
+        elif part:
+            size += len(part)
+    return size
+
+
+def encode_sequence_set(ids):
+    """Builds an IMAP sequence set out of a collection of message ids or
+    uids, collapsing runs of consecutive ids into ranges.  Since the order
+    of messages in a sequence set has no meaning to the server, the ids
+    are sorted and duplicates are dropped.
+
+    >>> encode_sequence_set(['1', '2', '3', '5', '7', '8'])
+    '1:3,5,7:8'
+
+    >>> encode_sequence_set([9, 4, 3, 4])
+    '3:4,9'
+
+    Args:
+        ids -- An iterable of message ids or uids, as strings or ints
+
+    Returns:
+        A string sequence set, suitable for FETCH, STORE, COPY, etc.
+    """
+    numbers = sorted(set(int(an_id) for an_id in ids))
+    ranges = []
+    index = 0
+    count = len(numbers)
+    while index < count:
+        first = last = numbers[index]
+        index += 1
+        while index < count and numbers[index] == last + 1:
+            last = numbers[index]
+            index += 1
+        if first == last:
+            ranges.append(str(first))
+        else:
+            ranges.append("%d:%d" % (first, last))
+    return ",".join(ranges)
+
+
+def decode_sequence_set(sequence_set, maximum=None):
+    """Expands an IMAP sequence set into the list of ids it describes, in
+    the order they appear in the set.
+
+    >>> decode_sequence_set('1:3,5,9:8')
+    ['1', '2', '3', '5', '8', '9']
+
+    >>> decode_sequence_set('4:*', maximum=6)
+    ['4', '5', '6']
+
+    Args:
+        sequence_set -- An IMAP sequence set string
+
+    Keyword Args:
+        maximum -- The value to use for "*" (the largest id in the mailbox).
+                   If None, sequence sets containing "*" can't be decoded
+
+    Returns:
+        A list of ids, as strings
+
+    Raises:
+        ValueError if the sequence set is malformed, or contains "*" and no
+        maximum was given
+    """
+    def _number(value):
+        if value == "*":
+            if maximum is None:
+                raise ValueError("Can't expand '*' without a maximum")
+            return int(maximum)
+        return int(value)
+
+    ids = []
+    for part in sequence_set.split(","):
+        if ":" in part:
+            first, last = part.split(":")
+            first, last = _number(first), _number(last)
+            if first > last:
+                first, last = last, first
+            ids.extend(str(an_id) for an_id in xrange(first, last + 1))
+        else:
+            ids.append(str(_number(part)))
+    return ids
+
+
+class AdaptiveChunker(object):
+    """Picks how many messages to request in each FETCH command.  The chunk
+    size is adjusted after each request, based on how long the request took
+    and how many bytes per message came back, aiming for requests that take
+    about target_secs and return about target_bytes.  Failed requests halve
+    the chunk size.
+    """
+
+    def __init__(self, size=100, minimum=1, maximum=1000, target_secs=2.0,
+                 target_bytes=4 * 1024 * 1024):
+        """
+        Keyword Args:
+            size         -- The number of messages to request in the first
+                            chunk
+            minimum      -- The smallest chunk size that will be used
+            maximum      -- The largest chunk size that will be used
+            target_secs  -- The number of seconds each request should take
+            target_bytes -- The number of bytes each response should contain
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_secs = target_secs
+        self.target_bytes = target_bytes
+        self.size = self._clamp(size)
+
+    def _clamp(self, size):
+        return int(max(self.minimum, min(self.maximum, size)))
+
+    def record(self, num_messages, secs, num_bytes):
+        """Records the result of a successful request, and adjusts the chunk
+        size to use for the next one.  The chunk size will at most double
+        after each request.
+
+        Args:
+            num_messages -- The number of messages requested
+            secs         -- How many seconds the request took
+            num_bytes    -- The size of the response, in bytes
+        """
+        if num_messages < 1:
+            return
+        candidates = [self.size * 2]
+        if secs > 0:
+            candidates.append(self.target_secs * num_messages / secs)
+        if num_bytes > 0:
+            candidates.append(self.target_bytes * num_messages / float(num_bytes))
+        self.size = self._clamp(min(candidates))
+
+    def failed(self):
+        """Records that a request failed, halving the chunk size"""
+        self.size = self._clamp(self.size / 2)
+
+
+class RetrySchedule(object):
+    """Decides how long to wait between attempts at an operation that is
+    expected to succeed eventually (such as finding a message that was
+    just copied into a mailbox).  Delays grow exponentially, and are
+    randomly shortened by up to the jitter fraction, so that many
+    connections retrying at once don't do so in lockstep.
+
+    >>> schedule = RetrySchedule(attempts=3, initial_secs=1, jitter=0)
+    >>> [schedule.delay(attempt) for attempt in (1, 2, 3)]
+    [1.0, 2.0, 4.0]
+    >>> schedule.should_retry(2), schedule.should_retry(3)
+    (True, False)
+    """
+
+    def __init__(self, attempts=5, initial_secs=0.25, max_secs=4.0,
+                 factor=2.0, jitter=0.5):
+        """
+        Keyword Args:
+            attempts     -- The total number of attempts to make, including
+                            the first, or None to retry forever
+            initial_secs -- How long to wait after the first failed attempt
+            max_secs     -- The longest to wait between any two attempts
+            factor       -- How much longer to wait after each failed attempt
+            jitter       -- The largest fraction of each delay that can be
+                            randomly cut off of it
+        """
+        self.attempts = attempts
+        self.initial_secs = initial_secs
+        self.max_secs = max_secs
+        self.factor = factor
+        self.jitter = jitter
+
+    def should_retry(self, attempt):
+        """Checks whether another attempt should be made, after the given
+        number of attempts have failed"""
+        return self.attempts is None or attempt < self.attempts
+
+    def delay(self, attempt):
+        """Returns the number of seconds to wait before the next attempt, after
+        the given number of attempts (1 or more) have failed"""
+        secs = min(self.max_secs,
+                   self.initial_secs * self.factor ** (attempt - 1))
+        return float(secs) * (1 - self.jitter * random.random())
+
+
+# The most blocking calls (such as opening new connections) that backends
+# without their own thread pool run at once, off of their event loops
+BLOCKING_WORKERS = 8
+
+_blocking_executor = None
+_blocking_executor_lock = threading.Lock()
+
+
+def blocking_executor():
+    """Returns the bounded, shared thread pool that blocking calls are run on
+    by backends that don't have a thread pool of their own, creating it the
+    first time it's needed
+
+    Returns:
+        A concurrent.futures.ThreadPoolExecutor with BLOCKING_WORKERS threads
+    """
+    global _blocking_executor
+    with _blocking_executor_lock:
+        if _blocking_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS)
+        return _blocking_executor
+
+
+def _logged(func):
+    """Wraps a function handed to a concurrent.futures executor, so that any
+    exception it raises is logged (as the tornado IOLoop does for its
+    callbacks), instead of being silently stored on a Future no one is
+    holding"""
+    def inner():
+        try:
+            return func()
+        except Exception:
+            _log("Exception in callback %r\n%s" % (func, traceback.format_exc()))
+    return inner
+
+
+class EventLoopBackend(object):
+    """Base class for the event loops pygmail can run its asyncronous
+    (callback based) operations on.  Backends are registered by name with
+    register_backend, and the active backend is chosen with set_backend.
+
+    Subclasses must implement schedule.  The default implementation of
+    run_in_thread runs blocking functions on the backend's executor (by
+    default, the thread pool returned by blocking_executor, so that a burst
+    of connection opens doesn't start a thread for each one), and hands the
+    result back to the event loop through schedule.
+    """
+
+    # The concurrent.futures.Executor blocking calls are run on, or None to
+    # use the shared pool returned by blocking_executor
+    executor = None
+
+    def schedule(self, func, secs=None):
+        """Schedules a function for future calling on the event loop.  This
+        method must be safe to call from any thread, since imaplib2 calls
+        its callbacks from its own threads.
+
+        Args:
+            func -- the function to schedule for execution
+
+        Keyword Args:
+            secs -- The number of seconds in the future that the function
+                    should be called on. If None, "func" function is schedule
+                    for execution ASAP
+        """
+        raise NotImplementedError()
+
+    def run_in_thread(self, func, callback):
+        """Calls a blocking function off of the event loop, and then calls the
+        given callback with its result on the event loop.
+
+        Args:
+            func     -- a function taking no arguments, which may block
+            callback -- the function that should receive the result of "func"
+        """
+        def _worker():
+            rs = func()
+            self.schedule(lambda: callback(rs))
+        (self.executor or blocking_executor()).submit(_logged(_worker))
+
+
+class TornadoBackend(EventLoopBackend):
+    """Runs callbacks on the (global) tornado IOLoop instance"""
+
+    def __init__(self, io_loop=None):
+        """
+        Keyword Args:
+            io_loop -- The tornado IOLoop to use.  If None, the global
+                       IOLoop.instance() is used
+        """
+        if io_loop is None:
+            import tornado.ioloop
+            io_loop = tornado.ioloop.IOLoop.instance()
+        self.io_loop = io_loop
+
+    def schedule(self, func, secs=None):
+        if secs:
+            self.io_loop.add_timeout(timedelta(seconds=secs), func)
+        else:
+            self.io_loop.add_callback(func)
+
+
+class ThreadPoolBackend(EventLoopBackend):
+    """Runs callbacks, and any blocking calls, on a concurrent.futures thread
+    pool.  This allows plain, blocking worker code to run operations against
+    many accounts at once (by passing callbacks) without running an event
+    loop.  Note that with this backend, callbacks are called on the pool's
+    threads, not the thread that started the operation.
+    """
+
+    def __init__(self, max_workers=8, executor=None):
+        """
+        Keyword Args:
+            max_workers -- The number of threads to run in the pool.  Ignored
+                           if an executor is provided
+            executor    -- An existing concurrent.futures.Executor to use
+        """
+        if executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.executor = executor
+
+    def schedule(self, func, secs=None):
+        if secs:
+            timer = threading.Timer(secs, self.executor.submit, (_logged(func),))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.executor.submit(_logged(func))
+
+    def run_in_thread(self, func, callback):
+        self.executor.submit(_logged(lambda: callback(func())))
+
+
+# Registry of the event loop backends that can be selected by name, and the
+# currently active backend.  The active backend is created lazily, so that
+# tornado isn't imported unless its used
+BACKENDS = dict(
+    tornado=TornadoBackend,
+    threads=ThreadPoolBackend
+)
+_backend = None
+
+
+def register_backend(name, backend_class):
+    """Makes a new event loop backend available to set_backend
+
+    Args:
+        name          -- the name the backend can be selected by
+        backend_class -- a subclass of EventLoopBackend
+    """
+    BACKENDS[name] = backend_class
+
+
+def set_backend(backend, **kwargs):
+    """Sets the event loop that pygmail's asyncronous operations are run on.
+
+    Note that any keyword arguments are passed along to the backend's
+    constructor, if a backend name is given (ex
+    set_backend("threads", max_workers=32))
+
+    Args:
+        backend -- either the name of a registered backend ("tornado" or
+                   "threads" by default), or an EventLoopBackend instance
+
+    Returns:
+        The now active EventLoopBackend instance
+    """
+    global _backend
+    if isinstance(backend, EventLoopBackend):
+        _backend = backend
+    else:
+        _backend = BACKENDS[backend](**kwargs)
+    return _backend
+
+
+def get_backend():
+    """Returns the active EventLoopBackend instance, creating the default
+    (tornado) backend if none has been set"""
+    if _backend is None:
+        return set_backend("tornado")
+    return _backend
+
+
 def schedule_func(func, secs=None):
-    """Schedules a function for future calling on the event loop.  Currently
-    the only event loop supported is the tornado one.
+    """Schedules a function for future calling on the event loop of the
+    active backend (by default, the tornado IOLoop)
 
     Args:
         func -- the function to schedule for execution
@@ -64,12 +436,7 @@ def schedule_func(func, secs=None):
                 be called on. If None, "func" function is schedule for execution
                 ASAP
     """
-    import tornado
-    io_loop = tornado.ioloop.IOLoop.instance()
-    if secs:
-        io_loop.add_timeout(timedelta(seconds=secs), func)
-    else:
-        io_loop.add_callback(func)
+    get_backend().schedule(func, secs)
 
 
 def _log(msg, log_name="tornado.application"):
@@ -89,7 +456,8 @@ def _cmd_in(func, secs, is_async, *args, **kwargs):
     """Calls a function in a given amount of time, either by sleeping / blocking
     the thread, or by scheduling a callback on the event loop.  This funciton is
     used as the point of indirection to support both async and blocking
-    functionality.
+    functionality.  In async mode the call is scheduled on the active event
+    loop backend (see set_backend).
 
     Note that the unnamed arguments and keyword arguments will be provided
     as arguments to the main function being called
@@ -109,6 +477,39 @@ def _cmd_in(func, secs, is_async, *args, **kwargs):
         return func(*args, **kwargs)
 
 
+def _cmd_retry(func, secs, is_async, connection, *args, **kwargs):
+    """Calls a function after waiting up to a given amount of time, waking
+    up early if the server reports a change to the mailbox selected on the
+    given connection.  The wait is done with an IMAP IDLE command (timing
+    out after "secs" seconds), so a retry that's waiting for a message to
+    show up in a mailbox happens as soon as the server sends EXISTS, instead
+    of after a fixed sleep.  If the connection can't IDLE, this behaves
+    like _cmd_in.
+
+    Note that the unnamed arguments and keyword arguments will be provided
+    as arguments to the main function being called
+
+    Args:
+        func        -- the main function that should be called
+        secs        -- the longest number of seconds to wait before the
+                       "func" function is called
+        is_async    -- truth-y value, describing whether the function should
+                       be called asyncronously (in the event loop) or
+                       syncronously / blocking
+        connection  -- an imaplib2 connection with a mailbox selected, or
+                       None to always wait the full amount of time
+    """
+    if connection is not None and 'IDLE' in getattr(connection, 'capabilities', ()):
+        def _on_idle(imap_response):
+            return func(*args, **kwargs)
+
+        try:
+            return _cmd_cb(connection.idle, _on_idle, is_async, timeout=secs)
+        except Exception:
+            pass
+    return _cmd_in(func, secs, is_async, *args, **kwargs)
+
+
 def _cmd(func=None, arg=None):
     """Point of indirection where a function is either called immediatly (with)
     the provided arguments (when called in blocking mode), or scheduled for
@@ -183,6 +584,43 @@ def _cmd_cb(main_func, callback, is_async, *args, **kwargs):
             return callback(rs)
 
 
+def _cmd_thread(main_func, callback, is_async, *args, **kwargs):
+    """Point of indirection for functions that block on network IO (and so
+    can't be handed a callback), such as opening a new socket.  In async mode
+    the function is run off of the event loop by the active backend, and its
+    result is delivered to the callback on the event loop.  In blocking mode
+    this behaves like _cmd_cb.
+
+    Exceptions raised by the main function are caught and handed to the
+    callback as the result, so that they can be handled in the same way
+    in both modes.
+
+    Note that the unnamed arguments and keyword arguments will be provided
+    as arguments to the main function being called, NOT the callback function
+
+    Args:
+        main_func   -- the blocking function that should be called
+        callback    -- the function that should receive the result of the
+                       main_func function
+        is_async    -- truth-y value, describing whether the function should
+                       be called off the event loop or syncronously / blocking
+
+    Returns:
+        If being called asyncronously, nothing is returned.  If called
+        syncronously, the result of the callback function is returned
+    """
+    def _call():
+        try:
+            return main_func(*args, **kwargs)
+        except Exception as e:
+            return e
+
+    if is_async:
+        get_backend().run_in_thread(_call, callback)
+    else:
+        return callback(_call())
+
+
 ### Parsing Utilities, "adapted" from
 ### http://pydoc.net/Python/gocept.imapapi/0.5/gocept.imapapi.parser/
 
@@ -194,82 +632,39 @@ def iterate_pairs(iterable):
         yield iterable.next(), iterable.next()
 
 
-ATOM_CHARS = [chr(i) for i in xrange(32, 256) if chr(i) not in r'(){%*"\ ]']
-
-
-class ParseError(Exception):
-    def __init__(self, msg, data):
-        Exception.__init__(self, "%s in '%s' at index %s." %
-                           (msg, data.string, data.index))
-
-
-class LookAheadStringIter(object):
-    """String iterator that allows looking one character ahead.
-
-    >>> i = LookAheadStringIter('abxxxcd')
-    >>> i.ahead
-    'a'
-    >>> i.next()
-    'a'
-    >>> i.ahead
-    'b'
-    >>> i.next()
-    'b'
-    >>> i.read(3)
-    'xxx'
-    >>> i.ahead
-    'c'
-    >>> i.next()
-    'c'
-    >>> i.ahead
-    'd'
-    >>> i.next()
-    'd'
-    >>> i.ahead
-    >>> i.next()
-    Traceback (most recent call last):
-    StopIteration
-    >>> i.read()
-    ''
-    >>> i.next()
-    Traceback (most recent call last):
-    StopIteration
-    """
-
-    index = 0
-
-    def __init__(self, string):
-        self.string = string
+ATOM_CHARS = frozenset(chr(i) for i in xrange(32, 256)
+                       if chr(i) not in '(){%*"\\ ]')
 
-    @property
-    def ahead(self):
-        if self.string is not None:
-            try:
-                return self.string[self.index]
-            except IndexError:
-                pass
+# The characters that can be sent in an astring without quoting it (RFC 3501's
+# ASTRING-CHAR, which is ATOM-CHAR plus "]", limited to 7 bit ASCII)
+ASTRING_CHARS = frozenset(chr(i) for i in xrange(33, 127)
+                          if chr(i) not in '(){%*"\\')
 
-    def next(self):
-        try:
-            result = self.string[self.index]
-        except IndexError:
-            raise StopIteration
-        self.index += 1
-        return result
+# Matches a single token of an IMAP response (and any spaces before it),
+# starting at a given position.  Atoms stop at "[", so that attribute
+# specifiers like BODY[HEADER.FIELDS (FROM)]<0> are matched as a single token
+TOKEN_PATTERN = re.compile(r'''
+    \ *(?:
+      (?P<atom>[^(){%*"\\\ \]\[\x00-\x1f]+)
+      (?:\[(?P<msgtext>[^(){%*"\\\ \]\[\x00-\x1f]*)
+         (?:\ \((?P<header_list>[^()]*)\))?
+       \](?P<range><[\d.]*>)?)?
+    | "(?P<quoted>(?:[^"\\]|\\.)*)"
+    | (?P<open>\()
+    | (?P<close>\))
+    | \\(?P<flag>\*|[^(){%*"\\\ \]\[\x00-\x1f]*)
+    | \{(?P<literal>\d+)\}\r\n
+    | (?P<end>$)
+    )
+''', re.VERBOSE)
 
-    def read(self, count=None):
-        if count is None:
-            result = self.string[self.index:]
-            self.index = len(self.string)
-        else:
-            result = self.string[self.index:self.index+count]
-            self.index += count
-        return result
+QUOTED_ESCAPE_PATTERN = re.compile(r'\\(["\\])')
 
-    def __iter__(self):
-        return self
 
-_ = LookAheadStringIter
+class ParseError(Exception):
+    def __init__(self, msg, string, index):
+        Exception.__init__(self, "%s in '%s' at index %s." %
+                           (msg, string, index))
 
 
 class Atom(object):
@@ -384,187 +779,14 @@ class AttributeSpec(object):
         return result
 
 
-def read_quoted(data):
-    """Read a quoted string from an IMAP response.
-
-    >>> read_quoted(_('"asdf"'))
-    'asdf'
-
-    >>> read_quoted(_('"asdf\\\\" " "foo"'))
-    'asdf" '
-
-    """
-    assert data.next() == '"'
-    result = ''
-    for c in data:
-        if c == '"':
-            break
-        if c == '\\' and data.ahead in ('"', '\\'):
-            c = data.next()
-        result += c
-    else:
-        raise ParseError('Unexpected end of quoted string', data)
-    return result
-
-
-def read_literal(data):
-    r"""Read a literal string from an IMAP response.
-
-    >>> read_literal(_('{4}\r\nasdf'))
-    'asdf'
-
-    >>> read_literal(_('{4}\r\na\\s\x1adf'))
-    'a\\s\x1a'
-
-    >>> read_literal(_('{0}\r\n'))
-    ''
-
-    """
-    assert data.next() == '{'
-    count = ''
-    for c in data:
-        if c == '}':
-            break
-        count += c
-    if not (data.ahead and data.next() == '\r' and
-            data.ahead and data.next() == '\n'):
-        raise ParseError('Syntax error in literal string', data)
-    try:
-        count = int(count)
-    except ValueError:
-        raise ParseError(
-            'Non-integer token for length of literal string', data)
-
-    result = data.read(count)
-    if len(result) < count:
-        raise ParseError('Unexpected end of literal string', data)
-    return result
-
-
-def read_list(data):
-    """Read a parenthesized list from an IMAP response.
-
-    >>> read_list(_('(foo "bar")'))
-    [<IMAP atom foo>, 'bar']
-
-    >>> read_list(_('(foo "bar" (baz)) qux'))
-    [<IMAP atom foo>, 'bar', [<IMAP atom baz>]]
-
-    """
-    assert data.next() == '('
-    result = list(parse_recursive(data))
-    if not data.ahead or data.next() != ')':
-        raise ParseError('Unexpected end of list', data)
-    return result
-
-
-def read_atom(data):
-    """Read an atom or attribute specification from an IMAP response.
-
-    Like atoms, this internal function of the parser does not care about NIL
-    and integer literals.
-
-    >>> read_atom(_('foo'))
-    <IMAP atom foo>
-
-    >>> read_atom(_('bar baz'))
-    <IMAP atom bar>
-
-    >>> read_atom(_('NIL'))
-    <IMAP atom NIL>
-
-    >>> read_atom(_('123'))
-    <IMAP atom 123>
-
-    >>> read_atom(_('BODY[]'))
-    <AttributeSpec BODY[]>
-
-    >>> read_atom(_('BODY[HEADER]'))
-    <AttributeSpec BODY[HEADER]>
-
-    >>> read_atom(_('BODY[HEADER.FIELDS (FROM)]'))
-    <AttributeSpec BODY[HEADER.FIELDS (FROM)]>
-
-    >>> read_atom(_('BODY[HEADER.FIELDS (FROM)]<0>'))
-    <AttributeSpec BODY[HEADER.FIELDS (FROM)]<0>>
-
-    """
-    assert data.ahead in ATOM_CHARS
-    result = ''
-    while data.ahead in ATOM_CHARS:
-        c = data.next()
-        if c == '[':
-            break
-        else:
-            result += c
-    else:
-        return Atom(result)
-
-    if data.ahead == ']':
-        msgtext = ''
-    else:
-        msgtext = read_atom(data)
-    if data.ahead == ' ':
-        data.next()
-        header_list = read_list(data)
-    else:
-        header_list = None
-    if data.ahead != ']':
-        raise ParseError('Unexpected end of header list', data)
-    data.next()
-    if data.ahead == '<':
-        range = read_atom(data)
-    else:
-        range = None
-    return AttributeSpec(result, msgtext, header_list, range)
-
-
-def read_flag(data):
-    """Read a flag from an IMAP response.
-
-    >>> read_flag(_('\\\\Flag'))
-    <IMAP flag \\Flag>
-
-    """
-    assert data.next() == '\\'
-    return Flag(read_atom(data).value)
-
-
-def parse_recursive(data):
-    """Parse an IMAP response until the end of the current nested list.
-
-    This loop is designed in such a way that the read_* functions always
-    operate on expressions that include all delimiting characters such as
-    quotes, braces and parentheses, and always consume them entirely.
-
-    """
-    while True:
-        c = data.ahead
-        if c == '"':
-            yield read_quoted(data)
-        elif c == '{':
-            yield read_literal(data)
-        elif c == '(':
-            yield read_list(data)
-        elif c == '\\':
-            yield read_flag(data)
-        elif c in ATOM_CHARS:
-            yield read_atom(data)
-
-        c = data.ahead
-        if c == ' ':
-            data.next()
-        elif c in (')', None):
-            break
-        elif c == '(':
-            continue
-        else:
-            raise ParseError('Syntax error %s' % c, data)
-
-
 def parse(data):
     r"""Parse an IMAP response with no regard to numerals and NIL.
 
+    The response is read with a single regular expression, one token at
+    a time, and nested lists are tracked with an explicit stack, so parsing
+    takes time linear in the length of the response, and malformed input
+    raises a ParseError instead of looping or recursing without end.
+
     >>> parse('')
     []
 
@@ -572,29 +794,97 @@ def parse(data):
     [<IMAP atom foo>, 'bar']
 
     >>> parse('(\\Noselect \\Marked) "/" INBOX/Foo/bar')
-    [[<IMAP flag \Noselect>, <IMAP flag \Marked>], '/',
-     <IMAP atom INBOX/Foo/bar>]
+    [[<IMAP flag \Noselect>, <IMAP flag \Marked>], '/', <IMAP atom INBOX/Foo/bar>]
 
     >>> parse('''(UID 17 RFC822 {58}\r\n\
     ... From: foo@example.com
     ... Subject: Test
     ...
     ... This is a test mail.
-    ...  FLAGS (\\Deleted))''')
-    [[<IMAP atom UID>, <IMAP atom 17>, <IMAP atom RFC822>,
-     'From: foo@example.com\nSubject: Test\n\nThis is a test mail.\n',
-     <IMAP atom FLAGS>, [<IMAP flag \Deleted>]]]
+    ...  FLAGS (\\Deleted))''')[0][3]
+    'From: foo@example.com\nSubject: Test\n\nThis is a test mail.\n'
 
     >>> parse(r'(BODYSTRUCTURE ("TEXT" "PLAIN")("TEXT" "HTML"))')
     [[<IMAP atom BODYSTRUCTURE>, ['TEXT', 'PLAIN'], ['TEXT', 'HTML']]]
     >>> parse(r'(BODYSTRUCTURE ("TEXT" "PLAIN") ("TEXT" "HTML"))')
     [[<IMAP atom BODYSTRUCTURE>, ['TEXT', 'PLAIN'], ['TEXT', 'HTML']]]
 
+    >>> parse('"asdf\\" " \\*')
+    ['asdf" ', <IMAP flag \*>]
+
+    >>> parse('BODY[] BODY[HEADER.FIELDS (FROM)]<0> BODY[1]')
+    [<AttributeSpec BODY[]>, <AttributeSpec BODY[HEADER.FIELDS (FROM)]<0>>, <AttributeSpec BODY[1]>]
+
+    >>> parse('(foo "bar"')
+    Traceback (most recent call last):
+    ParseError: Unexpected end of list in '(foo "bar"' at index 10.
+
+    Args:
+        data -- A string containing (part of) an IMAP response
+
+    Returns:
+        A list of the values in the response.  Strings (quoted or literal)
+        are returned as strs, parenthesized lists as lists, and atoms,
+        flags and attribute specifiers as Atom, Flag and AttributeSpec
+        instances
+
+    Raises:
+        ParseError if the response isn't well formed
     """
-    data = LookAheadStringIter(data)
-    result = list(parse_recursive(data))
-    if data.ahead:
-        raise ParseError('Inconsistent nesting of lists', data)
+    result = []
+    stack = []
+    index = 0
+    length = len(data)
+    match_token = TOKEN_PATTERN.match
+    while index < length:
+        match = match_token(data, index)
+        if not match:
+            index = len(data) - len(data[index:].lstrip(' '))
+            if data[index] == '"':
+                raise ParseError('Unexpected end of quoted string', data, index)
+            elif data[index] == '{':
+                raise ParseError('Syntax error in literal string', data, index)
+            raise ParseError('Syntax error %s' % data[index], data, index)
+        index = match.end()
+        kind = match.lastgroup
+
+        if kind == 'atom':
+            value = Atom(match.group('atom'))
+        elif kind == 'quoted':
+            value = match.group('quoted')
+            if '\\' in value:
+                value = QUOTED_ESCAPE_PATTERN.sub(r'\1', value)
+        elif kind == 'open':
+            stack.append(result)
+            result = []
+            continue
+        elif kind == 'close':
+            if not stack:
+                raise ParseError('Inconsistent nesting of lists', data, index - 1)
+            value = result
+            result = stack.pop()
+        elif kind == 'flag':
+            value = Flag(match.group('flag'))
+        elif kind == 'literal':
+            count = int(match.group('literal'))
+            value = data[index:index + count]
+            if len(value) < count:
+                raise ParseError('Unexpected end of literal string', data, length)
+            index += count
+        elif kind == 'end':
+            break
+        else:
+            msgtext = match.group('msgtext')
+            header_list = match.group('header_list')
+            range = match.group('range')
+            value = AttributeSpec(
+                match.group('atom'), Atom(msgtext) if msgtext else '',
+                None if header_list is None else parse(header_list),
+                None if range is None else Atom(range))
+        result.append(value)
+
+    if stack:
+        raise ParseError('Unexpected end of list', data, length)
     return result
 
 
@@ -626,6 +916,91 @@ def astring(value):
         raise ValueError('%r cannot be read as an astring.' % value)
 
 
+def quote_astring(value):
+    """Formats a value to be sent to the server as an astring, such as a
+    mailbox or label name in a command.  This is the reverse of astring.
+
+    Values made up of just atom characters are sent as atoms, and everything
+    else is sent as a quoted string.  Unicode values are encoded with IMAP's
+    modified UTF-7, as gmail expects for mailbox and label names.
+
+    >>> quote_astring('foo')
+    'foo'
+
+    >>> quote_astring('foo bar')
+    '"foo bar"'
+
+    >>> print quote_astring(Flag('Inbox'))
+    "\\\\Inbox"
+
+    >>> quote_astring(Atom('NIL'))
+    '"NIL"'
+
+    >>> quote_astring(u'caf\\xe9')
+    'caf&AOk-'
+
+    >>> quote_astring('')
+    '""'
+
+    Args:
+        value -- A str, unicode, Atom or Flag value
+
+    Returns:
+        The value, formatted as an IMAP astring
+
+    Raises:
+        ValueError if the value contains line breaks, and so would need to
+        be sent as a literal
+    """
+    if isinstance(value, Atom):
+        value = str(value)
+    elif isinstance(value, str):
+        try:
+            value.decode('ascii')
+        except UnicodeDecodeError:
+            value = encode_modified_utf7(value.decode('utf-8'))
+    else:
+        value = encode_modified_utf7(value)
+
+    if '\r' in value or '\n' in value:
+        raise ValueError('%r cannot be sent as a quoted string.' % value)
+    if value and value.upper() != 'NIL' and all(c in ASTRING_CHARS for c in value):
+        return value
+    return '"%s"' % (value.replace('\\', '\\\\').replace('"', '\\"'),)
+
+
+def encode_modified_utf7(value):
+    """Encodes a unicode string with the modified version of UTF-7 that IMAP
+    uses for mailbox names (RFC 3501, section 5.1.3).
+
+    >>> encode_modified_utf7(u'Entw\\xfcrfe & Co')
+    'Entw&APw-rfe &- Co'
+
+    Args:
+        value -- A unicode string
+
+    Returns:
+        An ASCII str
+    """
+    encoded = []
+    pending = []
+
+    def _flush():
+        if pending:
+            chunk = base64.b64encode(u''.join(pending).encode('utf-16-be'))
+            encoded.append('&%s-' % (chunk.rstrip('=').replace('/', ','),))
+            del pending[:]
+
+    for c in value:
+        if 0x20 <= ord(c) <= 0x7e:
+            _flush()
+            encoded.append('&-' if c == '&' else str(c))
+        else:
+            pending.append(c)
+    _flush()
+    return ''.join(encoded)
+
+
 def nstring(value):
     """Interpret a parsed value as an nstring.
 
@@ -0,0 +1,384 @@
+"""Support for being notified of changes to a mailbox as they happen, using
+IMAP IDLE, instead of polling the mailbox on a timer.
+
+A Watcher keeps its own, dedicated IMAP connection open with the gmail
+server (outside of the account's connection pool, since a connection in
+IDLE can't be used for anything else), with the watched mailbox selected.
+The changes the server reports while IDLE-ing are handed to the watcher's
+callback as MailboxEvent objects.
+
+Instances of these classes are returned by pygmail.mailbox.Mailbox.watch"""
+
+import re
+import time
+import pygmail.errors
+from pygmail.pool import PooledConnection
+from pygmail.utilities import extract_data, RetrySchedule, _cmd_cb, _cmd, _cmd_in, _cmd_thread, _log
+from pygmail.errors import is_error, is_auth_error, check_connection_state, IMAPError
+
+# Gmail ends IDLE sessions that have been open for around 30 minutes
+# (RFC 2177 asks clients to re-issue IDLE at least every 29 minutes), but
+# quietly drops idle connections well before that in practice, so IDLE is
+# re-issued every 9 minutes by default
+IDLE_REFRESH_SECS = 9 * 60
+
+# The untagged responses that describe a change to the selected mailbox
+EVENT_TYPES = ('EXISTS', 'RECENT', 'EXPUNGE', 'FETCH')
+
+# Splits the data of an untagged FETCH response, such as
+# '12 (FLAGS (\Seen) X-GM-LABELS ("\\Inbox"))', into the message sequence
+# number and the returned data items
+FETCH_EVENT_PATTERN = re.compile(r'^(\d+) \((.*)\)$', re.DOTALL)
+
+
+class MailboxEvent(object):
+    """A single change to a watched mailbox, as reported by the server.
+
+    Instances have the following properties:
+        type   -- one of "EXISTS", "RECENT", "EXPUNGE" or "FETCH"
+        number -- for EXISTS and RECENT events, the new number of messages
+                  in the mailbox.  For EXPUNGE and FETCH events, the sequence
+                  number of the message that was removed / changed.  Note
+                  that each EXPUNGE shifts down the sequence numbers of the
+                  messages after it.
+        data   -- for FETCH events, the raw data items the server sent
+                  (usually the message's new FLAGS), and otherwise None
+    """
+
+    def __init__(self, type, number, data=None):
+        self.type = type
+        self.number = number
+        self.data = data
+
+    def __str__(self):
+        return "<MailboxEvent: %s %d>" % (self.type, self.number)
+
+
+def parse_events(responses):
+    """Converts the untagged responses collected by an imaplib2 connection
+    into MailboxEvent objects, ignoring responses that don't describe a
+    change to the selected mailbox.
+
+    Args:
+        responses -- An iterable of (type, data list) pairs, as returned by
+                     imaplib2's pop_untagged_responses
+
+    Returns:
+        A list of zero or more pygmail.watch.MailboxEvent objects, in the
+        order the server sent them
+    """
+    events = []
+    for typ, data in responses:
+        if typ not in EVENT_TYPES:
+            continue
+        for item in data:
+            if isinstance(item, tuple):
+                item = item[0]
+            if not item:
+                continue
+            if typ == 'FETCH':
+                match = FETCH_EVENT_PATTERN.match(item)
+                if match:
+                    events.append(MailboxEvent(typ, int(match.group(1)),
+                                               match.group(2)))
+            elif item.isdigit():
+                events.append(MailboxEvent(typ, int(item)))
+    return events
+
+
+class Watcher(object):
+    """Watches a single mailbox for changes with IMAP IDLE.
+
+    Once started, the watcher selects the mailbox on its own connection and
+    IDLEs on it, calling on_event with a list of MailboxEvent objects each
+    time the server reports changes.  IDLE is re-issued every refresh_secs
+    seconds so that the server doesn't end the session, and if the
+    connection is dropped, a new one is opened and the mailbox reselected
+    (waiting about reconnect_secs seconds before the first attempt, and
+    about twice as long after each failed attempt, up to max_reconnect_secs,
+    with the delays jittered so that many watchers dropped at once don't
+    all reconnect at the same moment).
+
+    Since changes made while the watcher was reconnecting aren't reported,
+    an EXISTS event with the current message count is delivered each time
+    the mailbox is (re)selected, so that callers can tell when they should
+    resync (see pygmail.mailbox.Mailbox.sync).
+    """
+
+    def __init__(self, mailbox, on_event, refresh_secs=IDLE_REFRESH_SECS,
+                 reconnect_secs=5, max_reconnect_secs=300):
+        """
+        Args:
+            mailbox  -- The pygmail.mailbox.Mailbox instance to watch
+            on_event -- A function that will be called with a list of
+                        pygmail.watch.MailboxEvent objects each time the
+                        server reports changes to the mailbox
+
+        Keyword Args:
+            refresh_secs       -- How long to stay in a single IDLE command
+                                  before re-issuing it
+            reconnect_secs     -- How long to wait before reconnecting after
+                                  the connection has been dropped
+            max_reconnect_secs -- The longest to wait between reconnection
+                                  attempts
+        """
+        self.mailbox = mailbox
+        self.on_event = on_event
+        self.refresh_secs = refresh_secs
+        self.reconnect_schedule = RetrySchedule(
+            attempts=None, initial_secs=reconnect_secs,
+            max_secs=max_reconnect_secs)
+
+        # The pygmail.pool.PooledConnection holding the connection currently
+        # being used to IDLE, or None if the watcher isn't connected
+        self.slot = None
+
+        # Whether the watcher has been asked to stop watching the mailbox
+        self.stopped = False
+
+        self._callback = None
+        self._reconnect_attempts = 0
+
+    def __str__(self):
+        return "<Watcher: %s>" % (self.mailbox.name,)
+
+    def start(self, callback=None):
+        """Connects to the gmail server, selects the watched mailbox and
+        starts IDLE-ing on it.
+
+        In async mode this returns immediately, and the callback is called
+        once the watcher stops.  In blocking mode this call doesn't return
+        until the watcher is stopped (by calling stop() from on_event, or
+        from another thread).
+
+        Returns:
+            True once the watcher has been stopped, or an error object
+            if the mailbox couldn't be watched (such as a
+            pygmail.errors.AuthError if the account's credentials weren't
+            accepted, or an error from the first attempt to select the
+            mailbox)
+        """
+        self.stopped = False
+        self._callback = callback
+
+        if callback:
+            return self._connect(callback=self._on_first_connection)
+
+        connection = self._connect()
+        if is_error(connection):
+            return connection
+        while not self.stopped:
+            try:
+                imap_response = self.slot.conn.idle(timeout=self.refresh_secs)
+            except Exception, e:
+                imap_response = IMAPError(e)
+            if not self._handle_idle(imap_response):
+                connection = self._reconnect()
+                if is_error(connection):
+                    return connection
+        return self._close()
+
+    def stop(self):
+        """Stops watching the mailbox, ending the current IDLE command and
+        logging out of the watcher's connection.  This can be called from
+        inside on_event, or from any other thread.
+
+        Returns:
+            False if the watcher had already been stopped, and otherwise True
+        """
+        if self.stopped:
+            return False
+        self.stopped = True
+
+        # Sending any other command makes imaplib2 end the current IDLE,
+        # which in turn wakes up the watcher so it can log out
+        if self.slot and self.slot.connected:
+            try:
+                self.slot.conn.noop(callback=lambda imap_response: None)
+            except Exception:
+                pass
+        return True
+
+    def _connect(self, callback=None):
+        """Opens and authenticates a new connection for the watcher, and
+        selects the watched mailbox on it.
+
+        Returns:
+            The selected imaplib2 connection on success, and an error object
+            otherwise
+        """
+        # A connection left over from an earlier, failed attempt is thrown
+        # away, instead of leaking its socket and threads
+        self._discard(self.slot, bool(callback))
+        slot = PooledConnection()
+        self.slot = slot
+
+        @pygmail.errors.check_imap_response(callback)
+        def _on_select(imap_response):
+            slot.selected = self.mailbox
+            self._reconnect_attempts = 0
+
+            # Whatever the server reported while selecting the mailbox is
+            # superseded by the count in the SELECT response itself.  imaplib2's
+            # pop_untagged_responses is a generator, so it has to be run for
+            # anything to actually be dropped
+            list(slot.conn.pop_untagged_responses())
+            msg_count = int(extract_data(imap_response)[0])
+            self.on_event([MailboxEvent('EXISTS', msg_count)])
+            return _cmd(callback, slot.conn)
+
+        @pygmail.errors.check_imap_state(callback)
+        def _on_connection(connection):
+            return _cmd_cb(connection.select, _on_select, bool(callback),
+                           self.mailbox.name)
+
+        return _cmd_cb(self.mailbox.account.connect_slot, _on_connection,
+                       bool(callback), slot)
+
+    def _reconnect(self, callback=None):
+        """Waits out the current reconnection delay, and then tries to open
+        and select a new connection, repeating (with an increasing delay)
+        until a connection is made, the watcher is stopped, or the account's
+        credentials are rejected.
+
+        Returns:
+            The selected imaplib2 connection on success, True if the watcher
+            was stopped while reconnecting, and an AuthError if the account's
+            credentials are no longer accepted
+        """
+        self._discard(self.slot, bool(callback))
+        self.slot = None
+
+        def _on_connection(connection):
+            if self.stopped:
+                if is_error(connection):
+                    return _cmd(callback, True)
+                else:
+                    return self._close(callback=callback)
+            elif not is_error(connection) or is_auth_error(connection):
+                return _cmd(callback, connection)
+            elif callback:
+                return self._reconnect(callback=callback)
+            else:
+                return None
+
+        while True:
+            self._reconnect_attempts += 1
+            delay = self.reconnect_schedule.delay(self._reconnect_attempts)
+            _log("Watcher for %s disconnected, reconnecting in %.1f seconds" % (
+                self.mailbox.name, delay))
+            if callback:
+                return _cmd_in(self._connect, delay, True,
+                               callback=_on_connection)
+            time.sleep(delay)
+            if self.stopped:
+                return True
+            connection = _on_connection(self._connect())
+            if connection is not None:
+                return connection
+
+    def _discard(self, slot, is_async):
+        """Logs out of a connection the watcher is done with (usually one that
+        has already been dropped), so that its socket and imaplib2's reader
+        and writer threads don't outlive it.  Errors are ignored, and in async
+        mode the logout is done off of the event loop, since logging out of
+        a dead connection can block until it times out.
+
+        Args:
+            slot     -- The pygmail.pool.PooledConnection to throw away, or None
+            is_async -- Whether the watcher is running in async mode
+        """
+        if slot is None or slot.conn is None:
+            return
+        slot.connected = False
+        slot.selected = None
+
+        def _on_logout(rs):
+            if isinstance(rs, Exception):
+                try:
+                    slot.conn.shutdown()
+                except Exception:
+                    pass
+
+        _cmd_thread(slot.conn.logout, _on_logout, is_async)
+
+    def _handle_idle(self, imap_response):
+        """Delivers any changes reported during the last IDLE command to
+        on_event.
+
+        Args:
+            imap_response -- The response to the IDLE command, or an error
+                             object if the command couldn't be issued
+
+        Returns:
+            True if the connection can be used to IDLE again, and False if
+            the connection needs to be replaced
+        """
+        conn = self.slot.conn
+        if is_error(imap_response):
+            error = imap_response
+        else:
+            error = pygmail.errors.check_for_response_error(imap_response)
+        error = error or check_connection_state(conn, "idle")
+
+        try:
+            events = parse_events(conn.pop_untagged_responses())
+        except Exception:
+            events = []
+        if events:
+            self.on_event(events)
+
+        if error and __debug__:
+            _log("IDLE on %s failed: %s" % (self.mailbox.name, error.msg))
+        return not error
+
+    def _on_first_connection(self, connection):
+        if is_error(connection):
+            return _cmd(self._callback, connection)
+        else:
+            return self._idle()
+
+    def _on_reconnection(self, connection):
+        if connection is True:
+            return _cmd(self._callback, True)
+        elif is_error(connection):
+            return _cmd(self._callback, connection)
+        else:
+            return self._idle()
+
+    def _on_idle(self, imap_response):
+        if self.stopped:
+            return self._close(callback=self._callback)
+        elif self._handle_idle(imap_response):
+            return self._idle()
+        else:
+            return self._reconnect(callback=self._on_reconnection)
+
+    def _idle(self):
+        if self.stopped:
+            return self._close(callback=self._callback)
+        try:
+            return _cmd_cb(self.slot.conn.idle, self._on_idle, True,
+                           timeout=self.refresh_secs)
+        except Exception, e:
+            return self._on_idle(IMAPError(e))
+
+    def _close(self, callback=None):
+        """Logs out of the watcher's connection
+
+        Returns:
+            True, regardless of whether the server said goodbye
+        """
+        slot, self.slot = self.slot, None
+
+        def _on_logout(imap_response):
+            slot.connected = False
+            slot.selected = None
+            return _cmd(callback, True)
+
+        if slot is None or not slot.connected:
+            return _cmd(callback, True)
+        try:
+            return _cmd_cb(slot.conn.logout, _on_logout, bool(callback))
+        except Exception:
+            return _on_logout(None)
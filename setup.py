@@ -22,5 +22,5 @@ setup(
         'Programming Language :: Python :: 2.7',
     ],
     keywords='email development',
-    install_requires=['imaplib2', 'google-api-python-client']
+    install_requires=['imaplib2', 'google-api-python-client', 'futures']
 )